@@ -0,0 +1,81 @@
+'''
+Runs inside gdb, after gdbpg.py has been sourced: times pgprint on the
+workloads of pgtree and writes the timings as JSON. Driven by run.py, which
+passes its settings as a JSON string in BENCH_CONFIG.
+'''
+import json
+import os
+import shutil
+import time
+
+config = json.loads(BENCH_CONFIG)
+
+# Keep the schema cache of the benchmark out of the user's one, cold runs
+# delete it
+SCHEMA_CACHE_DIR = config['schema_cache_dir']
+
+def reset_caches(cache):
+    '''cold: nothing is known yet, like the first pgprint of a session
+       disk: the struct layouts are read from the schema cache on disk, like
+             the first pgprint of a later session on the same build
+       warm: type metadata is known, like a pgprint after stepping
+       memoized: nothing is reset, like printing the same tree again'''
+    if cache in ['cold', 'disk']:
+        clear_type_metadata_cache()
+    if cache == 'cold':
+        shutil.rmtree(SCHEMA_CACHE_DIR, ignore_errors=True)
+    if cache in ['cold', 'disk', 'warm']:
+        clear_formatted_subtree_cache()
+
+def time_pgprint(expression, cache, runs):
+    command = 'pgprint --output %s %s' % (config['sink'], expression)
+    # disk needs the schema cache to be written first
+    if cache in ['disk', 'memoized']:
+        gdb.execute(command)
+
+    timings = []
+    for i in range(runs):
+        reset_caches(cache)
+        start = time.perf_counter()
+        gdb.execute(command)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def run_workloads(mode):
+    results = []
+    for name, expression in config['workloads']:
+        for cache in config['caches']:
+            timings = sorted(time_pgprint(expression, cache, config['runs']))
+            results.append({
+                'workload': name,
+                'expression': expression,
+                'mode': mode,
+                'cache': cache,
+                'runs': len(timings),
+                'min': timings[0],
+                'median': timings[len(timings) // 2],
+                'max': timings[-1],
+                'output_bytes': os.path.getsize(config['sink']),
+            })
+            gdb.write('%-10s %-5s %-9s %8.3fs\n' % (name, mode, cache, timings[len(timings) // 2]))
+    return results
+
+gdb.execute('set confirm off')
+gdb.execute('set pagination off')
+gdb.execute('file %s' % config['binary'])
+
+results = []
+if config['mode'] == 'live':
+    gdb.execute('break bench_ready')
+    gdb.execute('run %s' % ' '.join(str(a) for a in config['args']))
+    if config.get('core'):
+        gdb.execute('gcore %s' % config['core'])
+    if config['time']:
+        results = run_workloads('live')
+    gdb.execute('kill')
+else:
+    gdb.execute('core-file %s' % config['core'])
+    results = run_workloads('core')
+
+with open(config['results'], 'w') as f:
+    json.dump(results, f)
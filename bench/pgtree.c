@@ -0,0 +1,710 @@
+/*
+ * pgtree.c
+ *	  A tiny stand-in for a PostgreSQL backend, used to benchmark gdbpg.
+ *
+ * The structs below have the names and shapes gdbpg expects from a real
+ * server (Node tags, List, Plan and PlanState inheritance, TargetEntry, Var,
+ * TupleTableSlot with a GPDB 6 style tuple descriptor), but only the fields
+ * needed to exercise the formatter. main() builds the workloads into global
+ * variables and then calls bench_ready(), where the driver sets its
+ * breakpoint.
+ *
+ * Build with -DOLD_STYLE_LIST to get the linked List of PostgreSQL 12 and
+ * older (and GPDB), instead of the array based one.
+ *
+ *	  usage: pgtree [depth] [width] [natts] [list_length]
+ */
+#include <stdbool.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+
+typedef unsigned int Oid;
+typedef unsigned int Index;
+typedef int16_t AttrNumber;
+typedef int16_t int16;
+typedef int32_t int32;
+typedef uintptr_t Datum;
+typedef double Cost;
+
+typedef enum NodeTag
+{
+	T_Invalid = 0,
+
+	/* plan nodes */
+	T_Plan = 100,
+	T_Result,
+	T_Scan,
+	T_SeqScan,
+	T_Agg,
+	T_HashJoin,
+	T_Join,
+
+	/* plan state nodes */
+	T_PlanState = 200,
+	T_ResultState,
+	T_ScanState,
+	T_SeqScanState,
+	T_AggState,
+	T_HashJoinState,
+	T_JoinState,
+	T_EState,
+
+	/* primitive nodes */
+	T_Var = 300,
+	T_Const,
+	T_OpExpr,
+	T_TargetEntry,
+
+	/* tuple table */
+	T_TupleTableSlot = 400,
+
+	/* lists */
+	T_List = 500,
+	T_IntList,
+	T_OidList
+} NodeTag;
+
+typedef struct Node
+{
+	NodeTag		type;
+} Node;
+
+typedef struct Bitmapset
+{
+	int			nwords;
+	uint32_t	words[];
+} Bitmapset;
+
+/* ----------------
+ *		List
+ * ----------------
+ */
+#ifdef OLD_STYLE_LIST
+typedef struct ListCell ListCell;
+
+typedef struct List
+{
+	NodeTag		type;
+	int			length;
+	ListCell   *head;
+	ListCell   *tail;
+} List;
+
+struct ListCell
+{
+	union
+	{
+		void	   *ptr_value;
+		int			int_value;
+		Oid			oid_value;
+	}			data;
+	ListCell   *next;
+};
+#else
+typedef union ListCell
+{
+	void	   *ptr_value;
+	int			int_value;
+	Oid			oid_value;
+} ListCell;
+
+typedef struct List
+{
+	NodeTag		type;
+	int			length;
+	int			max_length;
+	ListCell   *elements;
+	ListCell	initial_elements[];
+} List;
+#endif
+
+/* ----------------
+ *		Expressions
+ * ----------------
+ */
+typedef struct Expr
+{
+	NodeTag		type;
+} Expr;
+
+typedef struct Var
+{
+	Expr		xpr;
+	Index		varno;
+	AttrNumber	varattno;
+	Oid			vartype;
+	int32		vartypmod;
+	Oid			varcollid;
+	Index		varlevelsup;
+	Index		varnoold;
+	AttrNumber	varoattno;
+	int			location;
+} Var;
+
+typedef struct Const
+{
+	Expr		xpr;
+	Oid			consttype;
+	int32		consttypmod;
+	Oid			constcollid;
+	int			constlen;
+	Datum		constvalue;
+	bool		constisnull;
+	bool		constbyval;
+	int			location;
+} Const;
+
+typedef struct OpExpr
+{
+	Expr		xpr;
+	Oid			opno;
+	Oid			opfuncid;
+	Oid			opresulttype;
+	bool		opretset;
+	Oid			opcollid;
+	Oid			inputcollid;
+	List	   *args;
+	int			location;
+} OpExpr;
+
+typedef struct TargetEntry
+{
+	Expr		xpr;
+	Expr	   *expr;
+	AttrNumber	resno;
+	char	   *resname;
+	Index		ressortgroupref;
+	Oid			resorigtbl;
+	AttrNumber	resorigcol;
+	bool		resjunk;
+} TargetEntry;
+
+/* ----------------
+ *		Plan nodes
+ * ----------------
+ */
+typedef struct Plan
+{
+	NodeTag		type;
+	Cost		startup_cost;
+	Cost		total_cost;
+	double		plan_rows;
+	int			plan_width;
+	bool		parallel_aware;
+	int			plan_node_id;
+	List	   *targetlist;
+	List	   *qual;
+	struct Plan *lefttree;
+	struct Plan *righttree;
+	List	   *initPlan;
+	Bitmapset  *extParam;
+	Bitmapset  *allParam;
+} Plan;
+
+typedef struct Result
+{
+	Plan		plan;
+	Node	   *resconstantqual;
+} Result;
+
+typedef struct Scan
+{
+	Plan		plan;
+	Index		scanrelid;
+} Scan;
+
+typedef struct SeqScan
+{
+	Scan		scan;
+} SeqScan;
+
+typedef enum JoinType
+{
+	JOIN_INNER,
+	JOIN_LEFT,
+	JOIN_FULL,
+	JOIN_RIGHT
+} JoinType;
+
+typedef struct Join
+{
+	Plan		plan;
+	JoinType	jointype;
+	bool		inner_unique;
+	List	   *joinqual;
+} Join;
+
+typedef struct HashJoin
+{
+	Join		join;
+	List	   *hashclauses;
+} HashJoin;
+
+typedef enum AggStrategy
+{
+	AGG_PLAIN,
+	AGG_SORTED,
+	AGG_HASHED,
+	AGG_MIXED
+} AggStrategy;
+
+typedef struct Agg
+{
+	Plan		plan;
+	AggStrategy aggstrategy;
+	int			numCols;
+	AttrNumber *grpColIdx;
+	long		numGroups;
+} Agg;
+
+/* ----------------
+ *		Tuple table
+ * ----------------
+ */
+typedef struct nameData
+{
+	char		data[64];
+} NameData;
+
+typedef struct FormData_pg_attribute
+{
+	Oid			attrelid;
+	NameData	attname;
+	Oid			atttypid;
+	int16		attlen;
+	int16		attnum;
+	int32		atttypmod;
+	bool		attbyval;
+	char		attalign;
+	bool		attnotnull;
+} FormData_pg_attribute;
+
+typedef FormData_pg_attribute *Form_pg_attribute;
+
+typedef struct tupleDesc
+{
+	int			natts;
+	Oid			tdtypeid;
+	int32		tdtypmod;
+	int			tdrefcount;
+	Form_pg_attribute *attrs;
+} *TupleDesc;
+
+typedef struct TupleTableSlot
+{
+	NodeTag		type;
+	bool		tts_isempty;
+	bool		tts_shouldFree;
+	TupleDesc	tts_tupleDescriptor;
+	int			PRIVATE_tts_nvalid;
+	Datum	   *PRIVATE_tts_values;
+	bool	   *PRIVATE_tts_isnull;
+} TupleTableSlot;
+
+/* ----------------
+ *		Plan state nodes
+ * ----------------
+ */
+typedef struct EState
+{
+	NodeTag		type;
+	int			es_processed;
+	List	   *es_range_table;
+} EState;
+
+typedef struct Instrumentation
+{
+	bool		running;
+	double		startup;
+	double		total;
+	double		ntuples;
+	double		nloops;
+} Instrumentation;
+
+typedef struct PlanState
+{
+	NodeTag		type;
+	Plan	   *plan;
+	EState	   *state;
+	Instrumentation *instrument;
+	List	   *targetlist;
+	List	   *qual;
+	struct PlanState *lefttree;
+	struct PlanState *righttree;
+	TupleTableSlot *ps_ResultTupleSlot;
+} PlanState;
+
+typedef struct ResultState
+{
+	PlanState	ps;
+	bool		rs_done;
+} ResultState;
+
+typedef struct ScanState
+{
+	PlanState	ps;
+	TupleTableSlot *ss_ScanTupleSlot;
+} ScanState;
+
+typedef struct SeqScanState
+{
+	ScanState	ss;
+} SeqScanState;
+
+typedef struct JoinState
+{
+	PlanState	ps;
+	JoinType	jointype;
+	List	   *joinqual;
+} JoinState;
+
+typedef struct HashJoinState
+{
+	JoinState	js;
+	List	   *hashclauses;
+} HashJoinState;
+
+typedef struct AggState
+{
+	ScanState	ss;
+	List	   *aggs;
+	int			numaggs;
+	AggStrategy aggstrategy;
+	bool		agg_done;
+} AggState;
+
+/* ----------------
+ *		Workloads, inspected by the benchmark driver
+ * ----------------
+ */
+
+/* Agg on top of a join tree of SeqScans */
+Plan	   *bench_plan;
+
+/* the executor state tree of bench_plan */
+PlanState  *bench_planstate;
+
+/* one long target list */
+List	   *bench_tlist;
+
+/* a join tree where both sides of every join are the same subtree */
+Plan	   *bench_shared;
+
+/* a single slot with a wide tuple */
+TupleTableSlot *bench_slot;
+
+static int	depth = 6;
+static int	width = 8;
+static int	natts = 16;
+static int	list_length = 10000;
+static int	next_plan_node_id = 0;
+
+#define OUTER_VAR 65001
+
+static void *
+palloc0(size_t size)
+{
+	void	   *p = calloc(1, size);
+
+	if (p == NULL)
+	{
+		fprintf(stderr, "out of memory\n");
+		exit(1);
+	}
+	return p;
+}
+
+#define makeNode(_type_) \
+	((_type_ *) newNode(sizeof(_type_), T_##_type_))
+
+static Node *
+newNode(size_t size, NodeTag tag)
+{
+	Node	   *result = palloc0(size);
+
+	result->type = tag;
+	return result;
+}
+
+static char *
+pstrdup(const char *s)
+{
+	char	   *result = palloc0(strlen(s) + 1);
+
+	strcpy(result, s);
+	return result;
+}
+
+#ifdef OLD_STYLE_LIST
+static List *
+lappend(List *list, void *datum)
+{
+	ListCell   *cell = palloc0(sizeof(ListCell));
+
+	cell->data.ptr_value = datum;
+	if (list == NULL)
+	{
+		list = makeNode(List);
+		list->head = cell;
+	}
+	else
+		list->tail->next = cell;
+	list->tail = cell;
+	list->length++;
+	return list;
+}
+#else
+static List *
+lappend(List *list, void *datum)
+{
+	if (list == NULL)
+	{
+		list = makeNode(List);
+		list->max_length = 4;
+		list->elements = palloc0(list->max_length * sizeof(ListCell));
+	}
+	else if (list->length == list->max_length)
+	{
+		list->max_length *= 2;
+		list->elements = realloc(list->elements,
+								 list->max_length * sizeof(ListCell));
+	}
+	list->elements[list->length++].ptr_value = datum;
+	return list;
+}
+#endif
+
+static Var *
+make_var(Index varno, AttrNumber attno)
+{
+	Var		   *var = makeNode(Var);
+
+	var->varno = varno;
+	var->varattno = attno;
+	var->vartype = 23;
+	var->vartypmod = -1;
+	var->varnoold = varno;
+	var->varoattno = attno;
+	var->location = -1;
+	return var;
+}
+
+static List *
+make_tlist(Index varno, int n)
+{
+	List	   *tlist = NULL;
+	char		name[32];
+	int			i;
+
+	for (i = 1; i <= n; i++)
+	{
+		TargetEntry *tle = makeNode(TargetEntry);
+
+		snprintf(name, sizeof(name), "col%d", i);
+		tle->expr = (Expr *) make_var(varno, i);
+		tle->resno = i;
+		tle->resname = pstrdup(name);
+		tle->resorigtbl = 16384 + varno;
+		tle->resorigcol = i;
+		tlist = lappend(tlist, tle);
+	}
+	return tlist;
+}
+
+static List *
+make_qual(Index varno)
+{
+	OpExpr	   *op = makeNode(OpExpr);
+	Const	   *c = makeNode(Const);
+
+	c->consttype = 23;
+	c->consttypmod = -1;
+	c->constlen = 4;
+	c->constvalue = 42;
+	c->constbyval = true;
+	c->location = -1;
+
+	op->opno = 96;
+	op->opfuncid = 65;
+	op->opresulttype = 16;
+	op->args = lappend(lappend(NULL, make_var(varno, 1)), c);
+	op->location = -1;
+	return lappend(NULL, op);
+}
+
+static void
+init_plan(Plan *plan, int level)
+{
+	plan->startup_cost = level;
+	plan->total_cost = 1000.0 * (level + 1);
+	plan->plan_rows = 100 * (level + 1);
+	plan->plan_width = 4 * width;
+	plan->plan_node_id = next_plan_node_id++;
+}
+
+/* a join tree of the given depth, with SeqScans as leaves */
+static Plan *
+make_join_tree(int level, bool shared)
+{
+	HashJoin   *join;
+
+	if (level >= depth)
+	{
+		SeqScan    *scan = makeNode(SeqScan);
+
+		init_plan(&scan->scan.plan, level);
+		scan->scan.scanrelid = level;
+		scan->scan.plan.targetlist = make_tlist(level, width);
+		scan->scan.plan.qual = make_qual(level);
+		return (Plan *) scan;
+	}
+
+	join = makeNode(HashJoin);
+	init_plan(&join->join.plan, level);
+	join->join.jointype = JOIN_INNER;
+	join->join.plan.targetlist = make_tlist(OUTER_VAR, width);
+	join->join.plan.lefttree = make_join_tree(level + 1, shared);
+	if (shared)
+		join->join.plan.righttree = join->join.plan.lefttree;
+	else
+		join->join.plan.righttree = make_join_tree(level + 1, shared);
+	join->hashclauses = make_qual(OUTER_VAR);
+	return (Plan *) join;
+}
+
+static TupleTableSlot *
+make_slot(int n)
+{
+	TupleTableSlot *slot = makeNode(TupleTableSlot);
+	TupleDesc	desc = palloc0(sizeof(struct tupleDesc));
+	int			i;
+
+	desc->natts = n;
+	desc->tdtypmod = -1;
+	desc->attrs = palloc0(n * sizeof(Form_pg_attribute));
+	slot->PRIVATE_tts_values = palloc0(n * sizeof(Datum));
+	slot->PRIVATE_tts_isnull = palloc0(n * sizeof(bool));
+	for (i = 0; i < n; i++)
+	{
+		Form_pg_attribute attr = palloc0(sizeof(FormData_pg_attribute));
+
+		snprintf(attr->attname.data, sizeof(attr->attname.data), "col%d", i + 1);
+		attr->attrelid = 16384;
+		attr->atttypid = 20;
+		attr->attlen = 8;
+		attr->attnum = i + 1;
+		attr->atttypmod = -1;
+		attr->attbyval = true;
+		attr->attalign = 'd';
+		desc->attrs[i] = attr;
+
+		slot->PRIVATE_tts_values[i] = i * 1000;
+		slot->PRIVATE_tts_isnull[i] = (i % 7 == 6);
+	}
+	slot->tts_tupleDescriptor = desc;
+	slot->PRIVATE_tts_nvalid = n;
+	return slot;
+}
+
+static void
+init_planstate(PlanState *ps, Plan *plan, EState *estate)
+{
+	ps->plan = plan;
+	ps->state = estate;
+	ps->instrument = palloc0(sizeof(Instrumentation));
+	ps->instrument->total = plan->total_cost / 1000;
+	ps->instrument->ntuples = plan->plan_rows;
+	ps->instrument->nloops = 1;
+	ps->ps_ResultTupleSlot = make_slot(natts);
+}
+
+static PlanState *
+make_planstate(Plan *plan, EState *estate)
+{
+	PlanState  *ps;
+
+	switch (plan->type)
+	{
+		case T_SeqScan:
+			{
+				SeqScanState *scan = makeNode(SeqScanState);
+
+				ps = (PlanState *) scan;
+				init_planstate(ps, plan, estate);
+				scan->ss.ss_ScanTupleSlot = make_slot(natts);
+				break;
+			}
+		case T_HashJoin:
+			{
+				HashJoinState *join = makeNode(HashJoinState);
+
+				ps = (PlanState *) join;
+				init_planstate(ps, plan, estate);
+				join->js.jointype = ((Join *) plan)->jointype;
+				break;
+			}
+		case T_Agg:
+			{
+				AggState   *agg = makeNode(AggState);
+
+				ps = (PlanState *) agg;
+				init_planstate(ps, plan, estate);
+				agg->aggstrategy = ((Agg *) plan)->aggstrategy;
+				agg->numaggs = 1;
+				break;
+			}
+		default:
+			fprintf(stderr, "unexpected plan node %d\n", plan->type);
+			exit(1);
+	}
+
+	if (plan->lefttree)
+		ps->lefttree = make_planstate(plan->lefttree, estate);
+	if (plan->righttree)
+		ps->righttree = make_planstate(plan->righttree, estate);
+	return ps;
+}
+
+/* the driver sets a breakpoint here, once all workloads are built */
+void
+bench_ready(void)
+{
+	__asm__ volatile("" ::: "memory");
+}
+
+int
+main(int argc, char **argv)
+{
+	Agg		   *agg;
+	EState	   *estate;
+
+	if (argc > 1)
+		depth = atoi(argv[1]);
+	if (argc > 2)
+		width = atoi(argv[2]);
+	if (argc > 3)
+		natts = atoi(argv[3]);
+	if (argc > 4)
+		list_length = atoi(argv[4]);
+
+	agg = makeNode(Agg);
+	init_plan(&agg->plan, 0);
+	agg->aggstrategy = AGG_HASHED;
+	agg->numCols = 1;
+	agg->numGroups = 1000;
+	agg->plan.targetlist = make_tlist(OUTER_VAR, width);
+	agg->plan.lefttree = make_join_tree(1, false);
+	bench_plan = (Plan *) agg;
+
+	estate = makeNode(EState);
+	bench_planstate = make_planstate(bench_plan, estate);
+
+	bench_tlist = make_tlist(1, list_length);
+	bench_shared = make_join_tree(1, true);
+	bench_slot = make_slot(natts);
+
+	bench_ready();
+	return 0;
+}
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+'''
+Benchmark gdbpg: build the pgtree stand-in backend, stop it once its trees
+are built and time pgprint on each of them, both on the live process and on
+a core file of it. Results are written as JSON, and can be compared with the
+results of an earlier commit:
+
+    python3 bench/run.py
+    python3 bench/run.py --compare bench/results/<commit>.json
+'''
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+# workload name -> expression given to pgprint
+WORKLOADS = [
+    ('plan', 'bench_plan'),
+    ('planstate', 'bench_planstate'),
+    ('tlist', 'bench_tlist'),
+    ('shared', 'bench_shared'),
+    ('slot', 'bench_slot'),
+]
+
+CACHES = ['cold', 'disk', 'warm', 'memoized']
+
+def git(*args):
+    try:
+        return subprocess.check_output(['git'] + list(args), cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def gdb_version(gdb):
+    output = subprocess.check_output([gdb, '--version']).decode()
+    return output.splitlines()[0]
+
+def build(workdir, old_style_lists):
+    binary = os.path.join(workdir, 'pgtree')
+    command = ['gcc', '-g', '-O0', '-o', binary, os.path.join(BENCH_DIR, 'pgtree.c')]
+    if old_style_lists:
+        command.append('-DOLD_STYLE_LIST')
+    subprocess.check_call(command)
+    return binary
+
+def run_gdb(args, config):
+    command = [args.gdb, '-batch', '-nx',
+               '-ex', 'python BENCH_CONFIG = %r' % json.dumps(config),
+               '-x', os.path.join(REPO_DIR, 'gdbpg.py'),
+               '-x', os.path.join(BENCH_DIR, 'gdb_bench.py')]
+    subprocess.check_call(command, stdout=None if args.verbose else subprocess.DEVNULL)
+    with open(config['results']) as f:
+        return json.load(f)
+
+def run(args):
+    workdir = tempfile.mkdtemp(prefix='gdbpg-bench-')
+    try:
+        config = {
+            'binary': build(workdir, args.old_style_lists),
+            'args': [args.depth, args.width, args.natts, args.list_length],
+            'core': os.path.join(workdir, 'pgtree.core'),
+            'sink': os.path.join(workdir, 'output.txt'),
+            'results': os.path.join(workdir, 'results.json'),
+            'schema_cache_dir': os.path.join(workdir, 'schema-cache'),
+            'workloads': [w for w in WORKLOADS if not args.workload or w[0] in args.workload],
+            'caches': args.cache or CACHES,
+            'runs': args.runs,
+        }
+
+        # The live run also writes the core file used by the core run
+        results = run_gdb(args, dict(config, mode='live', time='live' in args.mode))
+        if 'core' in args.mode:
+            results += run_gdb(args, dict(config, mode='core'))
+        return results
+    finally:
+        shutil.rmtree(workdir)
+
+def compare(baseline, current):
+    '''print the median of each result next to the one in baseline'''
+    old = {}
+    for r in baseline['results']:
+        old[(r['workload'], r['mode'], r['cache'])] = r
+
+    print('%-10s %-5s %-9s %10s %10s %8s' % ('workload', 'mode', 'cache', 'old (s)', 'new (s)', 'change'))
+    for r in current['results']:
+        o = old.get((r['workload'], r['mode'], r['cache']))
+        if o is None:
+            continue
+        change = (r['median'] - o['median']) / o['median'] * 100 if o['median'] else 0
+        print('%-10s %-5s %-9s %10.3f %10.3f %+7.1f%%' %
+              (r['workload'], r['mode'], r['cache'], o['median'], r['median'], change))
+
+def main():
+    parser = argparse.ArgumentParser(description='benchmark gdbpg pgprint')
+    parser.add_argument('--depth', type=int, default=6,
+                        help='depth of the join trees (default 6)')
+    parser.add_argument('--width', type=int, default=8,
+                        help='target list length of every plan node (default 8)')
+    parser.add_argument('--natts', type=int, default=16,
+                        help='attributes of every tuple slot (default 16)')
+    parser.add_argument('--list-length', type=int, default=10000,
+                        help='length of the bench_tlist target list (default 10000)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='runs of every workload, the median is reported (default 5)')
+    parser.add_argument('--workload', action='append', choices=[w[0] for w in WORKLOADS],
+                        help='only run this workload (can be repeated)')
+    parser.add_argument('--cache', action='append', choices=CACHES,
+                        help='only run with this cache state (can be repeated)')
+    parser.add_argument('--mode', action='append', choices=['live', 'core'],
+                        help='only run on the live process or the core file (can be repeated)')
+    parser.add_argument('--old-style-lists', action='store_true',
+                        help='build pgtree with PostgreSQL 12 style linked lists')
+    parser.add_argument('--gdb', default='gdb', help='gdb binary to use')
+    parser.add_argument('--output', metavar='FILE',
+                        help='results file (default bench/results/<commit>.json)')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results with an earlier results file')
+    parser.add_argument('--verbose', action='store_true', help='show the gdb output')
+    args = parser.parse_args()
+    args.mode = args.mode or ['live', 'core']
+
+    commit = git('rev-parse', 'HEAD')
+    report = {
+        'commit': commit,
+        'dirty': bool(git('status', '--porcelain', '--untracked-files=no')),
+        'gdb': gdb_version(args.gdb),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': {
+            'depth': args.depth,
+            'width': args.width,
+            'natts': args.natts,
+            'list_length': args.list_length,
+            'runs': args.runs,
+            'old_style_lists': args.old_style_lists,
+        },
+        'results': run(args),
+    }
+
+    output = args.output
+    if output is None:
+        os.makedirs(os.path.join(BENCH_DIR, 'results'), exist_ok=True)
+        output = os.path.join(BENCH_DIR, 'results', '%s.json' % (commit or 'unknown')[:12])
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('results written to %s' % output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,5 +1,23 @@
-import gdb
+import argparse
+import contextlib
+import csv
+import datetime
+try:
+    import gdb
+    import gdb.printing
+    import gdb.types
+except ImportError:
+    # Imported by pgrender.py, outside of gdb: only the parts that do not
+    # talk to gdb (output writers, decoders, PrintLimits) can be used
+    gdb = None
+import io
+import json
+import os
+import re
 import string
+import struct
+import sys
+import time
 
 # Visibility options
 NOT_NULL = "not_null"
@@ -41,9 +59,16 @@ DEFAULT_DISPLAY_METHODS = {
             'struct ItemPointerData': 'format_item_pointer_data_field',
     },
     'show_hidden': False,
-    'max_recursion_depth': 30
+    'max_recursion_depth': 30,
+    # Strings longer than this are cut off and marked with '...'
+    'max_string_length': 4096,
 }
 
+# Inferior memory is read in chunks that never cross a page boundary, so a
+# string ending right before an unmapped page can still be read
+MEMORY_PAGE_SIZE = 4096
+STRING_CHUNK_SIZE = 256
+
 # TODO: generate these overrides in a yaml config file
 FORMATTER_OVERRIDES = {
     'A_Expr': {
@@ -141,18 +166,8 @@ FORMATTER_OVERRIDES = {
             'inputcollid': {'visibility': "not_null"},
         },
     },
-    'EquivalenceClass': {
-        'fields': {
-            # TODO: These fields are nice to dump recursively, but
-            # they potentially have backwards references to their parents.
-            # Need a way to detect this condition and stop dumping
-            'ec_sources': {'formatter': 'minimal_format_node_field', },
-            'ec_derives': {'formatter': 'minimal_format_node_field', },
-        },
-    },
     'EState': {
         'fields':{
-            'es_plannedstmt': {'visibility': "never_show"},
             # TODO: These fields crash gdbpg.py
             'es_sharenode': {'visibility': "never_show"},
         },
@@ -162,11 +177,6 @@ FORMATTER_OVERRIDES = {
             'ecxt_estate': {'visibility': "never_show"},
         },
     },
-    'IndexOptInfo': {
-        'fields': {
-            'rel': {'formatter': 'minimal_format_node_field', }
-        },
-    },
     'FuncExpr': {
         'fields':{
             'args': {'skip_tag': True},
@@ -193,9 +203,8 @@ FORMATTER_OVERRIDES = {
             'tableSpaceName': {'visibility': 'not_null'},
         },
     },
-    # TODO: It would be nice to be able to recurse into memory contexts and
-    #       print the tree, but need to make its own NodeFormatter in order
-    #       to make its output look like a tree
+    # Only the names of the related contexts are printed here, pgmemctx
+    # prints the whole tree
     'MemoryContextData': {
         'fields':{
             'methods': {
@@ -260,9 +269,14 @@ FORMATTER_OVERRIDES = {
         'fields':{
             'parent_root': {'formatter': 'minimal_format_node_field'},
             'subroots': {'formatter': 'minimal_format_node_list'},
-            # TODO: Broken. Need to make dumping these fields possible
-            'simple_rel_array': {'visibility': 'never_show'},
-            'simple_rte_array': {'visibility': 'never_show'},
+            'simple_rel_array': {
+                    'formatter': 'format_node_array_field',
+                    'field_type': 'node_field',
+                },
+            'simple_rte_array': {
+                    'formatter': 'format_node_array_field',
+                    'field_type': 'node_field',
+                },
             'upper_rels': {'formatter': 'minimal_format_node_field'},
             'upper_targets': {'formatter': 'minimal_format_node_field'},
         },
@@ -512,8 +526,430 @@ for node in PlanNodes:
 JoinNodes = ['NestLoop', 'MergeJoin', 'HashJoin', 'Join', 'NestLoopState',
              'MergeJoinState', 'HashJoinState', 'JoinState']
 
+ListNodes = ['List', 'IntList', 'OidList', 'XidList']
+
+ValueNodes = ['Value', 'Integer', 'Float', 'String', 'BitString', 'Null', 'Boolean']
+
+# Node tag categories
+PLAN_NODE = "plan"
+PATH_NODE = "path"
+STATE_NODE = "state"
+JOIN_NODE = "join"
+LIST_NODE = "list"
+VALUE_NODE = "value"
+
+NODE_CATEGORIES = [
+    (PLAN_NODE, PlanNodes),
+    (PATH_NODE, PathNodes),
+    (STATE_NODE, StateNodes),
+    (JOIN_NODE, JoinNodes),
+    (LIST_NODE, ListNodes),
+    (VALUE_NODE, ValueNodes),
+]
+
 recursion_depth = 0
 
+# Nodes already written by the current pgprint, address -> node type. A node
+# reached a second time (shared subtree or a back pointer such as
+# IndexOptInfo.rel) is written as a reference to the first occurrence.
+visited_nodes = {}
+# Where each of them was written, as the labels leading to it such as
+# [planTree][lefttree], so that references can say where to look
+visited_node_paths = {}
+
+# Subtrees formatted since the inferior last stopped, shared by all pgprint
+# invocations until then. (inferior, thread, address, node type, options) ->
+# FormattedSubtree
+formatted_subtree_cache = {}
+formatted_subtree_generation = 0
+# Number of writer operations held by formatted_subtree_cache
+formatted_subtree_cache_size = 0
+
+# Subtrees writing more operations than this are not cached, and the writer
+# keeps no more than this many recorded operations at any time
+MAX_CAPTURED_OPERATIONS = 20000
+
+# Stop adding to formatted_subtree_cache once it holds this many operations
+MAX_CACHED_OPERATIONS = 1000000
+
+# Subtrees being formatted right now, innermost last
+subtree_captures = []
+
+# Subtrees left out of the output of pgprint, handle number -> ElidedSubtree,
+# and the handle number of each of them. Forgotten when the inferior runs, as
+# they may not be there anymore.
+elided_subtrees = {}
+elided_subtree_handles = {}
+next_elided_subtree_handle = 1
+
+# Keep only the last this many handles
+MAX_ELIDED_SUBTREES = 100000
+
+# PgPrintProfiler of the running pgprint --profile, if any
+active_profiler = None
+
+# Like pgprint, most of this file compares str() of pointers with '0x0',
+# which would go through the pretty-printers. They step aside while this is
+# more than zero, see suspended_pretty_printers().
+pretty_printers_suspended = 0
+
+# Struct name -> whether it starts with a NodeTag, for the pretty-printers
+node_struct_types = {}
+
+# Field layout and classification of every node type seen so far, shared by
+# all NodeFormatter instances. Keyed by (type name, objfile, pseudo node) and
+# flushed whenever gdb loads or drops an objfile, since the struct layouts may
+# have changed underneath us.
+type_metadata_cache = {}
+
+# gdb.lookup_type results, see lookup_type()
+type_cache = {}
+
+# NodeTag value -> NodeTagInfo, read from the NodeTag enum on first use
+node_tag_table = None
+
+# struct module byte order character of the target, see target_byte_order()
+byte_order = None
+
+# Type descriptions and NodeTags of the program being debugged are kept in
+# SCHEMA_CACHE_DIR/<build-id>.json, so later sessions (and every core dumped
+# by the same build) do not have to walk the debug info again. Set to None to
+# disable.
+SCHEMA_CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache'),
+                                'gdbpg')
+SCHEMA_CACHE_VERSION = 1
+
+# SchemaCache of the program being debugged, see get_schema_cache()
+schema_cache = None
+schema_cache_loaded = False
+
+def clear_type_metadata_cache(event=None):
+    global node_tag_table
+    global byte_order
+    global schema_cache, schema_cache_loaded
+
+    type_metadata_cache.clear()
+    type_cache.clear()
+    node_struct_types.clear()
+    struct_layouts.clear()
+    plan_type_chains.clear()
+    node_tag_table = None
+    byte_order = None
+
+    save_schema_cache()
+    schema_cache = None
+    schema_cache_loaded = False
+
+if gdb is not None:
+    gdb.events.new_objfile.connect(clear_type_metadata_cache)
+    gdb.events.clear_objfiles.connect(clear_type_metadata_cache)
+
+def clear_formatted_subtree_cache(event=None):
+    global formatted_subtree_generation, formatted_subtree_cache_size
+
+    formatted_subtree_cache.clear()
+    formatted_subtree_cache_size = 0
+    formatted_subtree_generation += 1
+
+def clear_elided_subtrees(event=None):
+    # Handles are not reused, so an old one cannot name a different subtree
+    elided_subtrees.clear()
+    elided_subtree_handles.clear()
+
+# Anything formatted so far may be stale once the inferior ran or its memory
+# was modified
+if gdb is not None:
+    for event_registry in [gdb.events.stop, gdb.events.memory_changed, gdb.events.inferior_call_post,
+                           gdb.events.new_objfile, gdb.events.clear_objfiles]:
+        event_registry.connect(clear_formatted_subtree_cache)
+        event_registry.connect(clear_elided_subtrees)
+
+class ElidedSubtree(object):
+    '''A node, or the elements start to end of a List, left out of the
+    output. pgexpand prints it from here.'''
+
+    def __init__(self, address, type_name, start=None, end=None):
+        self.address = address
+        self.type_name = type_name
+        self.start = start
+        self.end = end
+
+    def key(self):
+        return (self.address, self.type_name, self.start, self.end)
+
+    def value(self):
+        # Not every tag has a struct of its name (Integer is a Value before
+        # PostgreSQL 15), write_node() finds the type from the tag
+        if self.start is not None:
+            return gdb.Value(self.address).cast(lookup_type('List').pointer())
+        return gdb.Value(self.address).cast(lookup_type('Node').pointer())
+
+def elided_subtree_handle(address, type_name, start=None, end=None):
+    '''the handle, such as '$n12', of a subtree left out of the output'''
+    global next_elided_subtree_handle
+
+    key = (address, type_name, start, end)
+    number = elided_subtree_handles.get(key)
+    if number is None:
+        number = next_elided_subtree_handle
+        next_elided_subtree_handle += 1
+        elided_subtree_handles[key] = number
+        elided_subtrees[number] = ElidedSubtree(address, type_name, start, end)
+        # Forget the oldest handles of a large output
+        if len(elided_subtrees) > MAX_ELIDED_SUBTREES:
+            oldest = next(iter(elided_subtrees))
+            del elided_subtree_handles[elided_subtrees.pop(oldest).key()]
+    return '$n%d' % number
+
+class PendingLabel(object):
+    def __init__(self, text, indent):
+        self.text = text
+        self.indent = indent
+        self.resolved = False
+        self.pieces = []
+
+class OutputWriter(object):
+    '''Streams formatted output, inserting the current indentation at the
+    start of every line (the incremental equivalent of add_indent).
+
+    A label such as '[planTree] ' is printed on the same line as the node
+    that follows it if that node fits on one line, otherwise the node goes
+    on the following lines, indented one more level. To decide that without
+    formatting the node into a string first, the writer holds back the
+    label and the first line of the node until either a newline shows up or
+    the label is ended.'''
+
+    def __init__(self, write=None, indent=0):
+        if write is None:
+            write = gdb.write
+        self._write = write
+        self._labels = []
+        self._at_line_start = True
+        self.indent_level = indent
+        # Number of characters handed to write(), including held back ones
+        self.written = 0
+        # Operations are recorded into log while a capture is active. Only
+        # the last MAX_CAPTURED_OPERATIONS are kept, _recorded counts all of
+        # them, so log[0] is operation number _recorded - len(log).
+        self.log = []
+        self._recorded = 0
+        self._captures = 0
+
+    def indent(self, count=1):
+        self.indent_level += count
+
+    def dedent(self, count=1):
+        self.indent_level -= count
+
+    def write(self, text):
+        self._record('write', text)
+        self.written += len(text)
+        self._deliver(len(self._labels), text, self.indent_level)
+
+    def begin_label(self, text):
+        self._record('begin_label', text)
+        self._labels.append(PendingLabel(text, self.indent_level))
+        self.indent_level += 1
+
+    def end_label(self):
+        self._record('end_label', None)
+        label = self._labels.pop()
+        self.indent_level = label.indent
+        if not label.resolved:
+            # Everything fit on one line
+            level = len(self._labels)
+            self._deliver(level, label.text, label.indent)
+            for text, indent in label.pieces:
+                self._deliver(level, text, indent)
+
+    def close(self):
+        while len(self._labels) > 0:
+            self.end_label()
+
+    def label_path(self):
+        '''the labels of the output being written, such as [planTree][lefttree]'''
+        return ''.join(label.text.strip() for label in self._labels)
+
+    def begin_capture(self):
+        '''start recording the operations on this writer, returns the
+        position of the first one. Captures can be nested.'''
+        self._captures += 1
+        return self._recorded
+
+    def end_capture(self, start):
+        '''stop the innermost capture, returns the operations it recorded
+        since 'start', or None if there were too many to keep'''
+        self._captures -= 1
+        first = self._recorded - len(self.log)
+        operations = None
+        if start >= first:
+            operations = self.log[start - first:]
+        if self._captures == 0:
+            self.log = []
+        return operations
+
+    def replay(self, operations, base_indent):
+        '''repeat recorded operations, relative to the current indentation
+        instead of base_indent'''
+        indent = self.indent_level
+        for operation, text, operation_indent in operations:
+            self.indent_level = indent + operation_indent - base_indent
+            if operation == 'write':
+                self.write(text)
+            elif operation == 'begin_label':
+                self.begin_label(text)
+            else:
+                self.end_label()
+        self.indent_level = indent
+
+    def _record(self, operation, text):
+        if self._captures > 0:
+            self.log.append((operation, text, self.indent_level))
+            self._recorded += 1
+            # The captures that started before what is dropped can no longer
+            # be cached, end_capture() tells them
+            if len(self.log) > MAX_CAPTURED_OPERATIONS:
+                del self.log[:MAX_CAPTURED_OPERATIONS // 2]
+
+    def _deliver(self, level, text, indent):
+        while level > 0:
+            label = self._labels[level - 1]
+            level -= 1
+            if label.resolved:
+                continue
+
+            if '\n' not in text:
+                label.pieces.append((text, indent))
+                return
+
+            # The labelled output spans several lines: release the label on
+            # its own line followed by everything held back so far
+            label.resolved = True
+            pieces = label.pieces
+            label.pieces = None
+            self._deliver(level, label.text, label.indent)
+            self._deliver(level, '\n', label.indent)
+            for piece_text, piece_indent in pieces:
+                self._deliver(level, piece_text, piece_indent)
+
+        self._output(text, indent)
+
+    def _output(self, text, indent):
+        out = []
+        for lineno, line in enumerate(text.split('\n')):
+            if lineno > 0:
+                out.append('\n')
+                self._at_line_start = True
+            if line != '':
+                if self._at_line_start:
+                    out.append('\t' * indent)
+                    self._at_line_start = False
+                out.append(line)
+
+        self._write(''.join(out))
+
+def render_to_string(write_method, *args, **kwargs):
+    '''call a write_* function and return its output as a string'''
+    output = io.StringIO()
+    writer = OutputWriter(output.write)
+    write_method(writer, *args, **kwargs)
+    writer.close()
+    return output.getvalue()
+
+class JsonNodeWriter(object):
+    '''
+    Streams a tree of nodes as JSON, as it is walked. Every node is a record
+
+        {"type": ..., "address": ..., "fields": {...}}
+
+    where "fields" holds everything that is not a node: formatted scalar
+    fields, NULL pointers and Oid lists. The nodes below it are either nested
+    in a "children" object (json), or written as records of their own, one
+    per line, pointing to their parent with "parent", "field" and "index"
+    (ndjson). Nothing but the path to the current node is kept in memory.
+    '''
+
+    def __init__(self, write=None, ndjson=False):
+        if write is None:
+            write = gdb.write
+        self._output = write
+        self.ndjson = ndjson
+        # Number of characters written so far
+        self.written = 0
+        # One entry per open node or list: [kind, items written, address of
+        # the node, field name of the list]
+        self._stack = []
+        # Field of the next node, see begin_child()
+        self._field = None
+
+    def begin_node(self, record):
+        index = None
+        if self._stack and self._stack[-1][0] == 'list':
+            index = self._stack[-1][1]
+            self._stack[-1][1] += 1
+            if index > 0 and not self.ndjson:
+                self._write(',')
+
+        if self.ndjson:
+            # Where the node is in the tree
+            record = dict(record)
+            if self._stack:
+                record['parent'] = self._stack[-1][2]
+                if index is not None:
+                    record['field'] = self._stack[-1][3]
+                    record['index'] = index
+                else:
+                    record['field'] = self._field
+            self._write(json.dumps(record) + '\n')
+        else:
+            self._write(json.dumps(record)[:-1])
+        self._stack.append(['node', 0, record.get('address'), None])
+
+    def end_node(self):
+        kind, children, address, field = self._stack.pop()
+        if not self.ndjson:
+            if children > 0:
+                self._write('}')
+            self._write('}')
+            if not self._stack:
+                self._write('\n')
+
+    def leaf(self, record):
+        '''a node without children'''
+        self.begin_node(record)
+        self.end_node()
+
+    def begin_child(self, name):
+        self._field = name
+        if not self.ndjson:
+            if self._stack[-1][1] == 0:
+                self._write(',"children":{')
+            else:
+                self._write(',')
+            self._stack[-1][1] += 1
+            self._write(json.dumps(name) + ':')
+
+    def end_child(self):
+        pass
+
+    def begin_list(self, name):
+        self.begin_child(name)
+        if not self.ndjson:
+            self._write('[')
+        self._stack.append(['list', 0, self._stack[-1][2], name])
+
+    def end_list(self):
+        self._stack.pop()
+        if not self.ndjson:
+            self._write(']')
+
+    def close(self):
+        pass
+
+    def _write(self, text):
+        self.written += len(text)
+        self._output(text)
+
 def format_type(t, indent=0):
     'strip the leading T_ from the node type tag'
 
@@ -524,6 +960,79 @@ def format_type(t, indent=0):
 
     return add_indent(t, indent)
 
+def lookup_type(type_name):
+    '''gdb.lookup_type, remembered until the objfiles change'''
+    t = type_cache.get(type_name)
+    if t is None:
+        t = gdb.lookup_type(type_name)
+        type_cache[type_name] = t
+    return t
+
+class NodeTagInfo(object):
+    '''What we know about a single NodeTag value: its name, the struct used
+    for nodes with that tag, its categories and how to write it'''
+
+    def __init__(self, value, tag):
+        self.value = value
+        self.tag = tag
+        self.name = format_type(tag)
+        self.categories = set()
+        for category, names in NODE_CATEGORIES:
+            if self.name in names:
+                self.categories.add(category)
+
+        self.write_method = NODE_TAG_WRITE_METHODS.get(self.name)
+        if self.write_method is None:
+            if self.categories & set([PLAN_NODE, PATH_NODE, STATE_NODE]):
+                self.write_method = write_plan_state_node
+            else:
+                self.write_method = write_generic_node
+
+        self._struct_type = None
+        self._struct_type_looked_up = False
+
+    @property
+    def struct_type(self):
+        # Not every tag has a struct of the same name (T_Integer is a Value
+        # in older versions), so only look it up when somebody asks
+        if not self._struct_type_looked_up:
+            self._struct_type_looked_up = True
+            try:
+                self._struct_type = lookup_type(self.name)
+            except gdb.error:
+                self._struct_type = None
+        return self._struct_type
+
+def get_node_tag_table():
+    global node_tag_table
+
+    if node_tag_table is None:
+        cache = get_schema_cache()
+        tags = None
+        if cache is not None:
+            tags = cache.node_tags
+        if tags is None:
+            tags = [[f.enumval, f.name] for f in lookup_type('NodeTag').strip_typedefs().fields()]
+            if cache is not None:
+                cache.node_tags = tags
+                cache.dirty = True
+
+        node_tag_table = {}
+        for value, tag in tags:
+            node_tag_table[value] = NodeTagInfo(value, tag)
+
+    return node_tag_table
+
+def get_node_tag_info(node):
+    '''NodeTagInfo of a value that is known to be a node'''
+    tag = cast(node, 'Node')['type']
+    info = get_node_tag_table().get(int(tag))
+    if info is None:
+        # Not a valid NodeTag, probably garbage memory
+        info = NodeTagInfo(int(tag), str(tag))
+
+    return info
+
 def get_base_datatype(l):
     if isinstance(l, gdb.Type):
         stripped_type = l.strip_typedefs()
@@ -556,6 +1065,44 @@ def is_old_style_list(l):
     except:
         return False
 
+# struct format of the value stored in each ListCell, by list node type
+LIST_ELEMENT_FORMATS = {
+    'List': 'pointer',
+    'IntList': 'i',
+    'OidList': 'I',
+    'XidList': 'I',
+}
+
+def read_list_elements(lst, start=0, count=None):
+    '''decode the 'elements' array of a new style List with a single memory
+    read, returns a Python list of pointers (as int), ints or Oids. Only
+    'count' elements from 'start' on are read if given.'''
+    lst = cast(lst, 'List')
+    length = int(lst['length'])
+    if count is None or start + count > length:
+        count = length - start
+    if count <= 0:
+        return []
+
+    element_format = LIST_ELEMENT_FORMATS.get(get_node_tag_info(lst).name, 'pointer')
+    if element_format == 'pointer':
+        element_format = pointer_struct_format()
+
+    cell_size = lookup_type('ListCell').sizeof
+    padding = cell_size - struct.calcsize(element_format)
+    cell_format = target_byte_order() + element_format + ('%dx' % padding if padding > 0 else '')
+
+    data = read_memory(int(lst['elements']) + start * cell_size, count * cell_size)
+    return [cell[0] for cell in struct.iter_unpack(cell_format, data)]
+
+def skip_list_cells(item, count):
+    '''follow the 'next' pointers of an old style List 'count' times,
+    without reading the cells' data'''
+    while count > 0 and str(item) != '0x0':
+        item = item['next']
+        count -= 1
+    return item
+
 def format_oid_list(lst, indent=0):
     'format list containing Oid values directly (not warapped in Node)'
 
@@ -563,63 +1110,113 @@ def format_oid_list(lst, indent=0):
     if (str(lst) == '0x0'):
         return '(NIL)'
 
-    # we'll collect the formatted items into a Python list
+    items = [str(item) for item in read_limited_oid_list(lst)]
+    return add_indent('[%s]' % ', '.join(items), indent)
+
+def read_oid_list(lst, start=0, count=None):
+    '''the values of an OidList or IntList as a Python list, only 'count'
+    of them from 'start' on if given'''
     tlist = []
     if is_old_style_list(lst):
-        item = lst['head']
+        value_field = 'oid_value'
+        if is_a(lst, 'IntList'):
+            value_field = 'int_value'
+
+        item = skip_list_cells(lst['head'], start)
 
         # walk the list until we reach the last item
         while str(item) != '0x0':
+            if count is not None and len(tlist) >= count:
+                break
 
             # get item from the list and just grab 'oid_value as int'
-            tlist.append(int(item['data']['oid_value']))
+            tlist.append(int(item['data'][value_field]))
 
             # next item
             item = item['next']
     else:
-        for col in range(0, lst['length']):
-            element = lst['elements'][col]
-            tlist.append(int(element['oid_value']))
-
-    return add_indent(str(tlist), indent)
+        tlist = read_list_elements(lst, start, count)
 
+    return tlist
 
-def format_node_list(lst, indent=0, newline=False):
-    'format list containing Node values'
+def read_limited_oid_list(lst):
+    '''read_oid_list() within print_limits.max_list_items, with the number
+    of values left out as a string such as '<10 items elided>' in their
+    place'''
+    length = int(cast(lst, 'List')['length'])
+    head, tail = list_window(length, print_limits.max_list_items)
+    if head == length:
+        return read_oid_list(lst)
 
-    # handle NULL pointer (for List we return NIL)
-    if (str(lst) == '0x0'):
-        return add_indent('(NULL)', indent)
+    return (read_oid_list(lst, 0, head) + ['<%d items elided>' % (tail - head)] +
+            read_oid_list(lst, tail, length - tail))
 
-    # we'll collect the formatted items into a Python list
-    tlist = []
 
+def iterate_node_list(lst, start=0, count=None):
+    '''yield the elements of a List containing Node values, as (Node *).
+    Only 'count' elements from 'start' on are yielded if given.'''
     if is_old_style_list(lst):
-        item = lst['head']
+        item = skip_list_cells(lst['head'], start)
 
         # walk the list until we reach the last item
         while str(item) != '0x0':
+            if count is not None:
+                if count <= 0:
+                    break
+                count -= 1
 
             # we assume the list contains Node instances, so grab a reference
             # and cast it to (Node*)
-            node = cast(item['data']['ptr_value'], 'Node')
-
-            # append the formatted Node to the result list
-            tlist.append(format_node(node))
+            yield cast(item['data']['ptr_value'], 'Node')
 
             # next item
             item = item['next']
     else:
-        for col in range(0, lst['length']):
-            element = lst['elements'][col]
-            node = cast(element['ptr_value'], 'Node')
-            tlist.append(format_node(node))
+        node_type = lookup_type('Node').pointer()
+        for pointer in read_list_elements(lst, start, count):
+            yield gdb.Value(pointer).cast(node_type)
+
+def format_node_list(lst, indent=0, newline=False):
+    'format list containing Node values'
 
-    retval = str(tlist)
     if newline:
-        retval = "\n".join([str(t) for t in tlist])
+        output = io.StringIO()
+        writer = OutputWriter(output.write, indent)
+        write_node_list(writer, lst)
+        return output.getvalue()
 
-    return add_indent(retval, indent)
+    # handle NULL pointer (for List we return NIL)
+    if (str(lst) == '0x0'):
+        return add_indent('(NULL)', indent)
+
+    # we'll collect the formatted items into a Python list
+    tlist = []
+    for node in iterate_limited_node_list(lst):
+        if isinstance(node, ElidedListItems):
+            tlist.append(str(node))
+        else:
+            tlist.append(format_node(node))
+
+    return add_indent(str(tlist), indent)
+
+def write_node_list(writer, lst, first=0, last=None):
+    '''write list containing Node values, one per line (only elements first
+    to last if given)'''
+
+    # handle NULL pointer (for List we return NIL)
+    if (str(lst) == '0x0'):
+        writer.write('(NULL)')
+        return
+
+    first_item = True
+    for node in iterate_limited_node_list(lst, first, last):
+        if not first_item:
+            writer.write('\n')
+        if isinstance(node, ElidedListItems):
+            writer.write(str(node))
+        else:
+            write_node(writer, node)
+        first_item = False
 
 
 def format_char(value):
@@ -650,103 +1247,429 @@ def format_node_array(array, start_idx, length, indent=0):
 
     return add_indent(("\n".join(items)), indent)
 
+class PrintLimits(object):
+    '''
+    How much a single pgprint may print. Nodes nested deeper than max_depth,
+    list elements beyond the first and last max_list_items / 2, and anything
+    reached after max_bytes of output or max_seconds are replaced by a marker
+    with the address of what was left out. What is left out is not read from
+    the inferior either. None means no limit.
+    '''
+
+    def __init__(self, max_depth=None, max_list_items=None, max_bytes=None, max_seconds=None):
+        if max_depth is None:
+            max_depth = DEFAULT_DISPLAY_METHODS['max_recursion_depth']
+        self.max_depth = max_depth
+        self.max_list_items = max_list_items
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self._writer = None
+        self._deadline = None
+        # Set once the output ran out of bytes or time
+        self._exhausted = None
+
+    def start(self, writer):
+        '''start counting the output written to 'writer' and the time'''
+        self._writer = writer
+        if self.max_seconds is not None:
+            self._deadline = time.perf_counter() + self.max_seconds
+
+    def exhausted(self):
+        '''why nothing more may be printed ('max_bytes_exceeded' or
+        'max_seconds_exceeded'), or None'''
+        if self._exhausted is None and self._writer is not None:
+            if self.max_bytes is not None and self._writer.written >= self.max_bytes:
+                self._exhausted = 'max_bytes_exceeded'
+            elif self._deadline is not None and time.perf_counter() >= self._deadline:
+                self._exhausted = 'max_seconds_exceeded'
+        return self._exhausted
+
+    def fits(self, size):
+        '''can 'size' more characters be written without running out of bytes'''
+        if self.max_bytes is None or self._writer is None:
+            return True
+        return self._writer.written + size <= self.max_bytes
+
+    def key(self):
+        '''the limits the output of a subtree depends on, other than the
+        ones that taint it'''
+        return (self.max_depth, self.max_list_items)
+
+# Limits of the running pgprint
+print_limits = PrintLimits()
+
 def max_depth_exceeded():
     global recursion_depth
-    if recursion_depth >= DEFAULT_DISPLAY_METHODS['max_recursion_depth']:
+    if recursion_depth >= print_limits.max_depth:
         return True
     return False
 
+def truncation_reason():
+    '''why the node about to be written must be left out, or None'''
+    if max_depth_exceeded():
+        return 'max_depth_exceeded'
+    return print_limits.exhausted()
+
+def list_window(length, max_items):
+    '''the elements of a list of 'length' elements shown with a limit of
+    max_items: returns (end of the head, start of the tail), the elements in
+    between are left out'''
+    if max_items is None or length <= max_items:
+        return length, length
+    head = (max_items + 1) // 2
+    return head, length - (max_items - head)
+
+class ElidedListItems(object):
+    '''Elements start to end (exclusive) of a list, left out of the output'''
+
+    def __init__(self, lst, start, end, reason):
+        self.address = int(lst)
+        self.start = start
+        self.end = end
+        self.reason = reason
+        self.handle = elided_subtree_handle(self.address, 'List', start, end)
+
+    def __str__(self):
+        return 'List 0x%x [%d:%d] <%s, %d items elided> %s' % (
+            self.address, self.start, self.end, self.reason, self.end - self.start, self.handle)
+
+    def json_record(self):
+        return {'type': 'List', 'address': '0x%x' % self.address, 'truncated': self.reason,
+                'start': self.start, 'end': self.end, 'handle': self.handle}
+
+def iterate_limited_node_list(lst, first=0, last=None):
+    '''iterate_node_list() within print_limits: yields the elements to print
+    as (Node *), and an ElidedListItems in place of those left out. Only the
+    elements first to last (exclusive) are considered if given.'''
+    length = int(cast(lst, 'List')['length'])
+    if last is not None:
+        length = min(length, last)
+    head, tail = list_window(length - first, print_limits.max_list_items)
+
+    index = first
+    reason = None
+    for start, end in [(first, first + head), (first + tail, length)]:
+        reason = print_limits.exhausted()
+        if reason is not None:
+            break
+        for node in iterate_node_list(lst, start, end - start):
+            reason = print_limits.exhausted()
+            if reason is not None:
+                break
+            if index < start:
+                yield ElidedListItems(lst, index, start, 'max_list_items_exceeded')
+                index = start
+            yield node
+            index += 1
+        if reason is not None:
+            break
+
+    if index < length:
+        if reason is None:
+            reason = 'max_list_items_exceeded'
+        else:
+            taint_subtree_captures()
+        yield ElidedListItems(lst, index, length, reason)
+
 def format_node(node, indent=0):
     'format a single Node instance (only selected Node types supported)'
 
-    # Check the recursion depth
-    global recursion_depth
-    if max_depth_exceeded():
+    output = io.StringIO()
+    writer = OutputWriter(output.write, indent)
+    write_node(writer, node)
+    return output.getvalue()
+
+class FormattedSubtree(object):
+    '''The output of a node and everything below it, kept as the writer
+    operations that produced it so it can be replayed at any indentation'''
+
+    def __init__(self, depth):
+        self.operations = None
+        self.base_indent = None
+        self.base_path = None
+        # Paths of the nodes written, relative to base_path
+        self.paths = {}
+        # Number of characters written
+        self.size = None
+        self.generation = formatted_subtree_generation
+        # Nodes written in this subtree, address -> node type
+        self.nodes = {}
+        # How deep the subtree goes below its root
+        self.height = 0
+        self._depth = depth
+        # Set if the output depends on something outside the subtree
+        self.tainted = False
+
+    def node_written(self, address, name, path, depth):
+        self.nodes[address] = name
+        self.paths[address] = path[len(self.base_path):]
+        self.height = max(self.height, depth - self._depth)
+
+    def can_replay(self):
+        if recursion_depth + self.height >= print_limits.max_depth:
+            return False
+        if not print_limits.fits(self.size):
+            return False
+        # Nodes printed already would have to be back-references now
+        for address in self.nodes:
+            if address in visited_nodes:
+                return False
+        return True
+
+    def replay(self, writer):
+        base_path = writer.label_path()
+        visited_nodes.update(self.nodes)
+        for address, path in self.paths.items():
+            visited_node_paths[address] = base_path + path
+        for capture in subtree_captures:
+            capture.nodes.update(self.nodes)
+            for address, path in self.paths.items():
+                capture.paths[address] = (base_path + path)[len(capture.base_path):]
+            capture.height = max(capture.height, recursion_depth + self.height - capture._depth)
+        writer.replay(self.operations, self.base_indent)
+
+def formatting_options_key():
+    '''the display settings that the formatted output depends on'''
+    return tuple(sorted([(k, v) for k, v in DEFAULT_DISPLAY_METHODS.items()
+                         if not isinstance(v, dict)])) + print_limits.key()
+
+def subtree_cache_key(address, name):
+    '''formatted_subtree_cache key of a node: the same address may hold
+    something else in another inferior, and is read through the registers of
+    the selected thread'''
+    thread = gdb.selected_thread()
+    return (gdb.selected_inferior().num, thread.num if thread is not None else None,
+            address, name, formatting_options_key())
+
+def format_node_reference(address, name, path):
+    '''what is written instead of a node written before, at path'''
+    return '-> @0x%x (%s, see %s above)' % (address, name, path or 'the root')
+
+def taint_subtree_captures(address=None):
+    '''mark the subtrees being formatted as not cacheable because they refer
+    to 'address' outside of them, or got cut short when address is None'''
+    for capture in subtree_captures:
+        if address is None or address not in capture.nodes:
+            capture.tainted = True
+
+def write_node(writer, node):
+    'write a single Node instance (only selected Node types supported)'
+
+    global recursion_depth, formatted_subtree_cache_size
+    if str(node) == '0x0':
+        writer.write('(NULL)')
+        return
+
+    # Check the recursion depth and the output budget
+    reason = truncation_reason()
+    if reason is not None:
+        taint_subtree_captures()
         if is_node(node):
             node = cast(node, 'Node')
-            return "%s %s <max_depth_exceeded>" % (format_type(node['type']), str(node))
+            name = get_node_tag_info(node).name
+            writer.write("%s %s <%s> %s" % (name, str(node), reason,
+                                            elided_subtree_handle(int(node), name)))
         else:
-            return "%s <max_depth_exceeded>" % str(node)
-
+            writer.write("%s <%s>" % (str(node), reason))
+        return
+
+    tag_info = get_node_tag_info(node)
+
+    address = int(node)
+    if address in visited_nodes:
+        taint_subtree_captures(address)
+        writer.write(format_node_reference(address, visited_nodes[address],
+                                           visited_node_paths.get(address, '')))
+        return
+
+    cache_key = subtree_cache_key(address, tag_info.name)
+    cached = formatted_subtree_cache.get(cache_key)
+    if cached is not None and cached.can_replay():
+        cached.replay(writer)
+        return
+
+    visited_nodes[address] = tag_info.name
+    path = writer.label_path()
+    visited_node_paths[address] = path
+
+    capture = None
+    capture_start = None
+    if formatted_subtree_cache_size < MAX_CACHED_OPERATIONS:
+        capture = FormattedSubtree(recursion_depth)
+        capture.base_indent = writer.indent_level
+        capture.base_path = path
+        capture_start = writer.begin_capture()
+        capture.size = writer.written
+        subtree_captures.append(capture)
+    for c in subtree_captures:
+        c.node_written(address, tag_info.name, path, recursion_depth)
+
+    if active_profiler is not None:
+        active_profiler.begin_node(tag_info.name)
     recursion_depth += 1
+    try:
+        tag_info.write_method(writer, node)
+    finally:
+        recursion_depth -= 1
+        if active_profiler is not None:
+            active_profiler.end_node()
+        if capture is not None:
+            subtree_captures.pop()
+            capture.operations = writer.end_capture(capture_start)
+            capture.size = writer.written - capture.size
+
+    if capture is not None and capture.operations is not None and not capture.tainted and \
+            capture.generation == formatted_subtree_generation:
+        formatted_subtree_cache[cache_key] = capture
+        formatted_subtree_cache_size += len(capture.operations)
+
+def write_node_json(out, node):
+    '''write a single Node instance, and the nodes below it, to a
+    JsonNodeWriter'''
 
+    global recursion_depth
     if str(node) == '0x0':
-        return add_indent('(NULL)', indent)
+        out.leaf({'type': None, 'address': '0x0'})
+        return
 
-    retval = ''
+    reason = truncation_reason()
+    if reason is not None:
+        node = cast(node, 'Node')
+        name = get_node_tag_info(node).name
+        out.leaf({'type': name, 'address': '0x%x' % int(node), 'truncated': reason,
+                  'handle': elided_subtree_handle(int(node), name)})
+        return
 
-    if is_a(node, 'A_Const'):
-        node = cast(node, 'A_Const')
+    tag_info = get_node_tag_info(node)
 
-        retval = format_a_const(node)
+    address = int(node)
+    if address in visited_nodes:
+        out.leaf({'type': visited_nodes[address], 'address': '0x%x' % address, 'ref': True})
+        return
+    visited_nodes[address] = tag_info.name
 
-    elif is_a(node, 'List'):
-        node = cast(node, 'List')
+    recursion_depth += 1
+    try:
+        json_method = NODE_TAG_JSON_METHODS.get(tag_info.name)
+        if json_method is not None:
+            json_method(out, node)
+        else:
+            NodeFormatter(node).write_json(out)
+    finally:
+        recursion_depth -= 1
+
+def json_list_node(out, node):
+    lst = cast(node, 'List')
+    out.begin_node({'type': 'List', 'address': '0x%x' % int(lst), 'fields': {'length': int(lst['length'])}})
+    out.begin_list('items')
+    write_node_list_json(out, lst)
+    out.end_list()
+    out.end_node()
+
+def write_node_list_json(out, lst, first=0, last=None):
+    '''write the elements of a List containing Node values (only first to
+    last if given) to the open list of a JsonNodeWriter'''
+    for item in iterate_limited_node_list(lst, first, last):
+        if isinstance(item, ElidedListItems):
+            out.leaf(item.json_record())
+        else:
+            write_node_json(out, item)
+
+def json_string_node(out, node):
+    out.leaf({'type': 'String', 'address': '0x%x' % int(node),
+              'fields': {'str': getchars(cast(node, 'Value')['val']['str'])}})
+
+def json_integer_node(out, node):
+    out.leaf({'type': 'Integer', 'address': '0x%x' % int(node),
+              'fields': {'ival': int(cast(node, 'Value')['val']['ival'])}})
+
+def json_oid_list_node(out, node):
+    out.leaf({'type': get_node_tag_info(node).name, 'address': '0x%x' % int(node),
+              'fields': {'items': read_limited_oid_list(node)}})
+
+def json_a_const_node(out, node):
+    out.leaf({'type': 'A_Const', 'address': '0x%x' % int(node),
+              'fields': {'val': format_node(cast(node, 'A_Const')['val'].address)}})
+
+# JSON counterparts of NODE_TAG_WRITE_METHODS
+NODE_TAG_JSON_METHODS = {
+    'A_Const': json_a_const_node,
+    'List': json_list_node,
+    'String': json_string_node,
+    'Integer': json_integer_node,
+    'OidList': json_oid_list_node,
+    'IntList': json_oid_list_node,
+}
 
-        retval = format_node_list(node, 0, True)
+# Formatted values that are plain numbers or booleans, see json_value()
+JSON_NUMBER_RE = re.compile(r'^-?(0|[1-9][0-9]*)(\.[0-9]+)?([eE][-+]?[0-9]+)?$')
+
+def json_value(value):
+    '''a formatted field value as a JSON value'''
+    value = str(value)
+    if JSON_NUMBER_RE.match(value):
+        if '.' in value or 'e' in value or 'E' in value:
+            return float(value)
+        return int(value)
+    if value == 'true':
+        return True
+    if value == 'false':
+        return False
+    return value
 
-    elif is_a(node, 'String'):
-        node = cast(node, 'Value')
+def write_a_const_node(writer, node):
+    writer.write(format_a_const(cast(node, 'A_Const')))
 
-        retval = 'String [%s]' % getchars(node['val']['str'])
+def write_list_node(writer, node):
+    write_node_list(writer, cast(node, 'List'))
 
-    elif is_a(node, 'Integer'):
-        node = cast(node, 'Value')
+def write_string_node(writer, node):
+    writer.write('String [%s]' % getchars(cast(node, 'Value')['val']['str']))
 
-        retval = 'Integer [%s]' % node['val']['ival']
+def write_integer_node(writer, node):
+    writer.write('Integer [%s]' % cast(node, 'Value')['val']['ival'])
 
-    elif is_a(node, 'OidList'):
-        retval = 'OidList: %s' % format_oid_list(node)
+def write_oid_list_node(writer, node):
+    writer.write('OidList: %s' % format_oid_list(node))
 
-    elif is_a(node, 'IntList'):
-        retval = 'IntList: %s' % format_oid_list(node)
+def write_int_list_node(writer, node):
+    writer.write('IntList: %s' % format_oid_list(node))
 
-    elif is_pathnode(node):
-        node_formatter = PlanStateFormatter(node)
-        retval += node_formatter.format()
+def write_plan_state_node(writer, node):
+    node_formatter = PlanStateFormatter(node)
+    node_formatter.write(writer)
 
-    elif is_plannode(node):
-        node_formatter = PlanStateFormatter(node)
-        retval += node_formatter.format()
+def write_generic_node(writer, node):
+    node_formatter = NodeFormatter(node)
+    node_formatter.write(writer)
 
-    elif is_statenode(node):
-        node_formatter = PlanStateFormatter(node)
-        retval += node_formatter.format()
+# Node types that are not written by a NodeFormatter
+NODE_TAG_WRITE_METHODS = {
+    'A_Const': write_a_const_node,
+    'List': write_list_node,
+    'String': write_string_node,
+    'Integer': write_integer_node,
+    'OidList': write_oid_list_node,
+    'IntList': write_int_list_node,
+}
 
-    else:
-        node_formatter = NodeFormatter(node)
-        retval += node_formatter.format()
+def is_node_category(node, category):
+    if not is_node(node):
+        return False
 
-    recursion_depth -= 1
-    return add_indent(str(retval), indent)
+    return category in get_node_tag_info(node).categories
 
 def is_pathnode(node):
-    for nodestring in PathNodes:
-        if is_a(node, nodestring):
-            return True
-
-    return False
+    return is_node_category(node, PATH_NODE)
 
 def is_plannode(node):
-    for nodestring in PlanNodes:
-        if is_a(node, nodestring):
-            return True
-
-    return False
+    return is_node_category(node, PLAN_NODE)
 
 def is_statenode(node):
-    for nodestring in StateNodes:
-        if is_a(node, nodestring):
-            return True
-
-    return False
+    return is_node_category(node, STATE_NODE)
 
 def is_joinnode(node):
-    for nodestring in JoinNodes:
-        if is_a(node, nodestring):
-            return True
-
-    return False
+    return is_node_category(node, JOIN_NODE)
 
 def format_a_const(node, indent=0):
     retval = "A_Const [%(val)s]" % {
@@ -760,9 +1683,8 @@ def is_a(n, t):
 
     if not is_node(n):
         return False
-    n = cast(n, 'Node')
 
-    return (str(n['type']) == ('T_' + t))
+    return get_node_tag_info(n).name == t
 
 def is_xpr(l):
     try:
@@ -783,7 +1705,7 @@ def is_node(l):
         return False
 
 def is_type(value, type_name, is_pointer):
-    t = gdb.lookup_type(type_name)
+    t = lookup_type(type_name)
     if(is_pointer):
         t = t.pointer()
     return (str(value.type) == str(t))
@@ -794,13 +1716,12 @@ def cast(node, type_name):
     '''wrap the gdb cast to proper node type'''
 
     # lookup the type with name 'type_name' and cast the node to it
-    t = gdb.lookup_type(type_name)
+    t = lookup_type(type_name)
     return node.cast(t.pointer())
 
 def get_base_node_type(node):
     if is_node(node):
-        node = cast(node, "Node")
-        return format_type(node['type'])
+        return get_node_tag_info(node).name
 
     return None
 
@@ -812,25 +1733,95 @@ def add_indent(val, indent, add_newline=False):
     retval += "\n".join([(("\t" * indent) + l) for l in val.split("\n")])
     return retval
 
-def getchars(arg):
-    if (str(arg) == '0x0'):
-        return str(arg)
+def read_memory(address, length):
+    '''read 'length' bytes of inferior memory at 'address' in one go'''
+    return gdb.selected_inferior().read_memory(address, length).tobytes()
 
-    retval = '"'
+def target_byte_order():
+    '''struct module byte order character ('<' or '>') of the target'''
+    global byte_order
 
-    i=0
-    while arg[i] != ord("\0"):
-        character = int(arg[i].cast(gdb.lookup_type("char")))
+    if byte_order is None:
+        endian = gdb.execute('show endian', to_string=True)
+        if 'big endian' in endian:
+            byte_order = '>'
+        else:
+            byte_order = '<'
+    return byte_order
+
+def pointer_struct_format():
+    if lookup_type('void').pointer().sizeof == 8:
+        return 'Q'
+    return 'I'
+
+def read_c_string(address, max_length):
+    '''read a NUL terminated string, returns (bytes, truncated)'''
+    chunks = []
+    length = 0
+    chunk_size = STRING_CHUNK_SIZE
+    while length < max_length:
+        page_left = MEMORY_PAGE_SIZE - (address % MEMORY_PAGE_SIZE)
+        size = min(chunk_size, page_left, max_length - length)
+
+        chunk = read_memory(address, size)
+        nul = chunk.find(b'\0')
+        if nul >= 0:
+            chunks.append(chunk[:nul])
+            return b''.join(chunks), False
+
+        chunks.append(chunk)
+        length += size
+        address += size
+        chunk_size = MEMORY_PAGE_SIZE
+
+    return b''.join(chunks), True
+
+def escape_chars(data):
+    retval = ''
+    for character in bytearray(data):
         if chr(character) in string.printable:
             retval += "%c" % chr(character)
         else:
             retval += "\\x%x" % character
-        i += 1
+    return retval
 
-    retval += '"'
+def getchars(arg):
+    max_length = DEFAULT_DISPLAY_METHODS['max_string_length']
+    arg_type = arg.type.strip_typedefs()
+    if arg_type.code == gdb.TYPE_CODE_ARRAY:
+        # Fixed size buffer such as NameData, there is no pointer to follow
+        if arg.address is None:
+            return getchars_slow(arg)
+        address = int(arg.address)
+        max_length = min(max_length, arg_type.sizeof)
+    else:
+        address = int(arg)
+        if address == 0:
+            return '0x0'
+
+    try:
+        data, truncated = read_c_string(address, max_length)
+    except gdb.MemoryError:
+        return "0x%x <cannot access memory>" % address
+
+    retval = '"%s"' % escape_chars(data)
+    if truncated and arg_type.code != gdb.TYPE_CODE_ARRAY:
+        retval += '...'
 
     return retval
 
+def getchars_slow(arg):
+    '''character by character version of getchars, for arrays that do not
+    live in inferior memory'''
+    data = bytearray()
+    for i in range(arg.type.strip_typedefs().sizeof):
+        character = int(arg[i].cast(lookup_type("unsigned char")))
+        if character == 0:
+            break
+        data.append(character)
+
+    return '"%s"' % escape_chars(data)
+
 def get_node_fields(node):
     nodefields = [("Node", True), ("Expr", True)]
     type_name = str(node['type']).replace("T_", "")
@@ -943,48 +1934,57 @@ def format_item_pointer_data_field(node, field):
     return "(%s,%s)" % (block_id, node[field]['ip_posid'])
 
 def format_optional_node_field(node, fieldname, cast_to=None, skip_tag=False, print_null=False, indent=1):
+    return render_to_string(write_optional_node_field, node, fieldname, cast_to, skip_tag, print_null, indent)
+
+def write_optional_node_field(writer, node, fieldname, cast_to=None, skip_tag=False, print_null=False, indent=1):
     if cast_to != None:
         node = cast(node, cast_to)
 
     if str(node[fieldname]) != '0x0':
-        node_output = format_node(node[fieldname])
-
+        writer.indent(indent)
+        writer.write('\n')
         if skip_tag == True:
-            return add_indent('%s' % node_output, indent, True)
+            write_node(writer, node[fieldname])
         else:
-            retval = '[%s] ' % fieldname
-            if node_output.count('\n') > 0:
-                node_output = add_indent(node_output, 1, True)
-            retval += node_output
-            return add_indent(retval , indent, True)
+            writer.begin_label('[%s] ' % fieldname)
+            write_node(writer, node[fieldname])
+            writer.end_label()
+        writer.dedent(indent)
     elif print_null == True:
-        return add_indent("[%s] (NULL)" % fieldname, indent, True)
-
-    return ''
+        writer.indent(indent)
+        writer.write("\n[%s] (NULL)" % fieldname)
+        writer.dedent(indent)
 
 def format_optional_node_list(node, fieldname, cast_to=None, skip_tag=False, newLine=True, print_null=False, indent=1):
+    return render_to_string(write_optional_node_list, node, fieldname, cast_to, skip_tag, newLine, print_null, indent)
+
+def write_optional_node_list(writer, node, fieldname, cast_to=None, skip_tag=False, newLine=True, print_null=False, indent=1):
     if cast_to != None:
         node = cast(node, cast_to)
 
-    retval = ''
     indent_add = 0
     if str(node[fieldname]) != '0x0':
         if is_a(node[fieldname], 'OidList') or is_a(node[fieldname], 'IntList'):
-            return format_optional_oid_list(node, fieldname, skip_tag, newLine, print_null, indent)
+            writer.write(format_optional_oid_list(node, fieldname, skip_tag, newLine, print_null, indent))
+            return
 
         if skip_tag == False:
-            retval += add_indent('[%s]' % fieldname, indent, True)
+            writer.indent(indent)
+            writer.write('\n[%s]' % fieldname)
+            writer.dedent(indent)
             indent_add = 1
 
         if newLine == True:
-            retval += '\n'
-            retval += '%s' % format_node_list(node[fieldname], indent + indent_add, newLine)
+            writer.write('\n')
+            writer.indent(indent + indent_add)
+            write_node_list(writer, node[fieldname])
+            writer.dedent(indent + indent_add)
         else:
-            retval += ' %s' % format_node_list(node[fieldname], 0, newLine)
+            writer.write(' %s' % format_node_list(node[fieldname], 0, newLine))
     elif print_null == True:
-        return add_indent("[%s] (NIL)" % fieldname, indent, True)
-
-    return retval
+        writer.indent(indent)
+        writer.write("\n[%s] (NIL)" % fieldname)
+        writer.dedent(indent)
 
 def format_optional_oid_list(node, fieldname, skip_tag=False, newLine=False, print_null=False, indent=1):
     retval = ''
@@ -1079,31 +2079,17 @@ def minimal_format_node_list_field(node, fieldname, cast_to=None, skip_tag=False
     # we'll collect the formatted items into a Python list
     tlist = []
 
-    if is_old_style_list(lst):
-        item = lst['head']
-
-        # walk the list until we reach the last item
-        while str(item) != '0x0':
-            lstnode = cast(item['data']['ptr_value'], 'Node')
-            nodetype = get_base_node_type(lstnode)
-            lstnode = cast(lstnode, nodetype)
+    for lstnode in iterate_limited_node_list(lst):
+        if isinstance(lstnode, ElidedListItems):
+            tlist.append(str(lstnode))
+            continue
 
-            val = "(%s)%s" % (lstnode.type, node[fieldname])
-            # append the formatted Node to the result list
-            tlist.append(val)
+        nodetype = get_base_node_type(lstnode)
+        lstnode = cast(lstnode, nodetype)
 
-            # next item
-            item = item['next']
-    else:
-        for col in range(0, lst['length']):
-            element = lst['elements'][col]
-            lstnode = cast(item['data']['ptr_value'], 'Node')
-            nodetype = get_base_node_type(lstnode)
-            lstnode = cast(lstnode, nodetype)
-
-            val = "(%s)%s" % (lstnode.type, node[fieldname])
-
-            tlist.append(val)
+        val = "(%s)%s" % (lstnode.type, lstnode)
+        # append the formatted Node to the result list
+        tlist.append(val)
 
     if newLine:
         retval = "\n".join([str(t) for t in tlist])
@@ -1123,23 +2109,118 @@ def minimal_format_memory_context_data_field(node, fieldname, cast_to=None, skip
     return retval
 
 def format_pseudo_node_field(node, fieldname, cast_to=None, skip_tag=False, print_null=False, indent=1):
+    return render_to_string(write_pseudo_node_field, node, fieldname, cast_to, skip_tag, print_null, indent)
+
+def write_pseudo_node_field(writer, node, fieldname, cast_to=None, skip_tag=False, print_null=False, indent=1):
     if str(node[fieldname]) != '0x0':
-        node_type = node[fieldname].type.strip_typedefs()
         formatter = NodeFormatter(node[fieldname], pseudo_node=True)
-        node_output = formatter.format()
 
+        writer.indent(indent)
+        writer.write('\n')
         if skip_tag == True:
-            return add_indent('%s' % node_output, indent, True)
+            formatter.write(writer)
         else:
-            retval = '[%s] ' % fieldname
-            if node_output.count('\n') > 0:
-                node_output = add_indent(node_output, 1, True)
-            retval += node_output
-            return add_indent(retval , indent, True)
+            writer.begin_label('[%s] ' % fieldname)
+            formatter.write(writer)
+            writer.end_label()
+        writer.dedent(indent)
     elif print_null == True:
-        return add_indent("[%s] (NULL)" % fieldname, indent, True)
+        writer.indent(indent)
+        writer.write("\n[%s] (NULL)" % fieldname)
+        writer.dedent(indent)
+
+# Arrays of node pointers printed by format_node_array_field, and the field
+# of the same struct holding their length
+NODE_ARRAY_LENGTH_FIELDS = {
+    'simple_rel_array': 'simple_rel_array_size',
+    'simple_rte_array': 'simple_rel_array_size',
+}
+
+def format_node_array_field(node, fieldname, cast_to=None, skip_tag=False, print_null=False, indent=1):
+    return render_to_string(write_node_array_field, node, fieldname, cast_to, skip_tag, print_null, indent)
+
+def write_node_array_field(writer, node, fieldname, cast_to=None, skip_tag=False, print_null=False, indent=1):
+    '''an array of node pointers such as PlannerInfo.simple_rel_array, one
+    [index] per element. NULL elements (index 0, and the relations that
+    are not base relations) are left out.'''
+    if cast_to != None:
+        node = cast(node, cast_to)
 
-    return ''
+    array = node[fieldname]
+    if str(array) == '0x0':
+        if print_null == True:
+            writer.indent(indent)
+            writer.write("\n[%s] (NULL)" % fieldname)
+            writer.dedent(indent)
+        return
+
+    writer.indent(indent)
+    writer.write('\n[%s]' % fieldname)
+    writer.indent(1)
+    for index in range(int(node[NODE_ARRAY_LENGTH_FIELDS[fieldname]])):
+        element = array[index]
+        if str(element) == '0x0':
+            continue
+        writer.write('\n')
+        writer.begin_label('[%d] ' % index)
+        write_node(writer, element)
+        writer.end_label()
+    writer.dedent(indent + 1)
+
+# Display methods that can stream their output through an OutputWriter
+# instead of returning a string
+DISPLAY_WRITE_METHODS = {
+    'format_optional_node_field': 'write_optional_node_field',
+    'format_optional_node_list': 'write_optional_node_list',
+    'format_pseudo_node_field': 'write_pseudo_node_field',
+    'format_node_array_field': 'write_node_array_field',
+}
+
+# JSON output of fields holding nodes. The first function returns the value
+# to store in the "fields" of the node (None: nothing to store), the second
+# one writes the nodes below it, if any. Display methods not listed here
+# store the text they format.
+def json_optional_node_field_value(node, fieldname):
+    if str(node[fieldname]) == '0x0':
+        return None
+    return NotImplemented
+
+def write_json_optional_node_field(out, node, fieldname):
+    out.begin_child(fieldname)
+    write_node_json(out, node[fieldname])
+    out.end_child()
+
+def json_optional_node_list_value(node, fieldname):
+    if str(node[fieldname]) == '0x0':
+        return None
+    if is_a(node[fieldname], 'OidList') or is_a(node[fieldname], 'IntList'):
+        return read_limited_oid_list(node[fieldname])
+    return NotImplemented
+
+def write_json_optional_node_list(out, node, fieldname):
+    out.begin_list(fieldname)
+    write_node_list_json(out, node[fieldname])
+    out.end_list()
+
+def write_json_node_array_field(out, node, fieldname):
+    # NULL elements are kept, so that the index of the others is right
+    out.begin_list(fieldname)
+    array = node[fieldname]
+    for index in range(int(node[NODE_ARRAY_LENGTH_FIELDS[fieldname]])):
+        write_node_json(out, array[index])
+    out.end_list()
+
+def write_json_pseudo_node_field(out, node, fieldname):
+    out.begin_child(fieldname)
+    NodeFormatter(node[fieldname], pseudo_node=True).write_json(out)
+    out.end_child()
+
+DISPLAY_JSON_METHODS = {
+    'format_optional_node_field': (json_optional_node_field_value, write_json_optional_node_field),
+    'format_optional_node_list': (json_optional_node_list_value, write_json_optional_node_list),
+    'format_pseudo_node_field': (json_optional_node_field_value, write_json_pseudo_node_field),
+    'format_node_array_field': (json_optional_node_field_value, write_json_node_array_field),
+}
 
 # ---
 # TupleTableSlot related dumpers
@@ -1188,18 +2269,363 @@ def get_tts_nullmap(node, nullmap_field, natts):
     if str(node[nullmap_field]) == '0x0':
         return None
 
+    # The whole array in one read
     nullmap = []
     nullmap_byte = []
-    for col in range(0, natts):
-        if node[nullmap_field][col] not in [0,1]:
+    for byte in bytearray(read_memory(int(node[nullmap_field]), natts)):
+        if byte not in [0, 1]:
             nullmap.append(None)
         else:
-            nullmap.append((int(node[nullmap_field][col]) == 1))
+            nullmap.append(byte == 1)
 
-        nullmap_byte.append('0x%x' % node[nullmap_field][col])
+        nullmap_byte.append('0x%x' % byte)
 
     return nullmap, nullmap_byte
 
+# Elements of an array printed at most, the rest is replaced by '...'
+MAX_ARRAY_ELEMENTS = 100
+
+TYPALIGN_BYTES = {'c': 1, 's': 2, 'i': 4, 'd': 8}
+MAXIMUM_ALIGNOF = 8
+VARHDRSZ = 4
+
+# Dates and timestamps count from 2000-01-01, INT_MIN and INT_MAX are the
+# infinities
+POSTGRES_EPOCH = datetime.datetime(2000, 1, 1)
+NUMERIC_NBASE_DIGITS = 4
+
+# Columns of the TupleDescs seen so far, address -> [(type OID, DATUM_TYPES
+# entry or None)]. Forgotten when the inferior runs.
+tuple_desc_columns_cache = {}
+
+def clear_tuple_desc_columns_cache(event=None):
+    tuple_desc_columns_cache.clear()
+
+if gdb is not None:
+    for event_registry in [gdb.events.stop, gdb.events.memory_changed, gdb.events.inferior_call_post,
+                           gdb.events.new_objfile, gdb.events.clear_objfiles]:
+        event_registry.connect(clear_tuple_desc_columns_cache)
+
+def varlena_header_size(first, order):
+    '''how many bytes parse_varlena_header() needs for a varlena starting
+    with the byte 'first': 1 for short varlenas, 2 for TOAST pointers and
+    4 for the others'''
+    if order == '<':
+        if first == 0x01:
+            return 2
+        return 1 if first & 0x01 else 4
+    if first == 0x80:
+        return 2
+    return 1 if first & 0x80 else 4
+
+def parse_varlena_header(data, order):
+    '''(kind, header size, total size) of the varlena at the start of data,
+    kind is 'plain', 'compressed' or 'external' (a TOAST pointer, of unknown
+    size)'''
+    first = bytearray(data[:1])[0]
+    if order == '<':
+        if first == 0x01:
+            return 'external', 2, None
+        if first & 0x01:
+            return 'plain', 1, first >> 1
+        header = struct.unpack('<I', data[:4])[0]
+        if header & 0x03 == 0x02:
+            return 'compressed', 8, header >> 2
+        return 'plain', 4, header >> 2
+
+    if first == 0x80:
+        return 'external', 2, None
+    if first & 0x80:
+        return 'plain', 1, first & 0x7f
+    header = struct.unpack('>I', data[:4])[0]
+    if header & 0xc0000000 == 0x40000000:
+        return 'compressed', 8, header & 0x3fffffff
+    return 'plain', 4, header & 0x3fffffff
+
+def read_varlena(address, order):
+    '''(kind, payload, truncated) of the varlena at address. The payload is
+    cut at max_string_length, and read in one go unless the varlena crosses
+    a page boundary.'''
+    limit = DEFAULT_DISPLAY_METHODS['max_string_length'] + 8
+    size = max(8, min(limit, MEMORY_PAGE_SIZE - address % MEMORY_PAGE_SIZE))
+    data = read_memory(address, size)
+
+    kind, header_size, total_size = parse_varlena_header(data, order)
+    if kind != 'plain':
+        return kind, b'', False
+    if total_size > len(data) and len(data) < limit:
+        data = read_memory(address, min(total_size, limit))
+    return kind, data[header_size:total_size], total_size > len(data)
+
+def datum_bytes(datum, datum_type, order):
+    '''(kind, bytes, truncated) of a Datum of the given DATUM_TYPES entry'''
+    length = datum_type['len']
+    if length == -1:
+        return read_varlena(datum, order)
+
+    # Fixed length types no wider than a Datum are passed by value (int8,
+    # float8 and the timestamps only where Datums are 8 bytes)
+    if length <= lookup_type('Datum').sizeof and length in INTEGER_STRUCT_FORMATS:
+        value = datum & ((1 << (8 * length)) - 1)
+        return 'plain', struct.pack(order + INTEGER_STRUCT_FORMATS[length].upper(), value), False
+    return 'plain', read_memory(datum, length), False
+
+def decode_bool_datum(data, order):
+    return 'true' if bytearray(data)[0] else 'false'
+
+def decode_int_datum(data, order):
+    return str(struct.unpack(order + INTEGER_STRUCT_FORMATS[len(data)], data)[0])
+
+def decode_oid_datum(data, order):
+    return str(struct.unpack(order + 'I', data)[0])
+
+def decode_float_datum(data, order):
+    return repr(struct.unpack(order + ('f' if len(data) == 4 else 'd'), data)[0])
+
+def decode_text_datum(data, order):
+    return '"%s"' % escape_chars(data)
+
+def decode_name_datum(data, order):
+    return '"%s"' % escape_chars(data.split(b'\0')[0])
+
+def decode_bytea_datum(data, order):
+    return '\\x' + ''.join('%02x' % byte for byte in bytearray(data))
+
+def decode_uuid_datum(data, order):
+    digits = ''.join('%02x' % byte for byte in bytearray(data))
+    return '%s-%s-%s-%s-%s' % (digits[:8], digits[8:12], digits[12:16], digits[16:20], digits[20:])
+
+def decode_date_datum(data, order):
+    days = struct.unpack(order + 'i', data)[0]
+    if days == -2 ** 31:
+        return '-infinity'
+    if days == 2 ** 31 - 1:
+        return 'infinity'
+    try:
+        return (POSTGRES_EPOCH + datetime.timedelta(days=days)).strftime('%Y-%m-%d')
+    except OverflowError:
+        return '<%d days after 2000-01-01>' % days
+
+def decode_timestamp_datum(data, order):
+    microseconds = struct.unpack(order + 'q', data)[0]
+    if microseconds == -2 ** 63:
+        return '-infinity'
+    if microseconds == 2 ** 63 - 1:
+        return 'infinity'
+    try:
+        timestamp = POSTGRES_EPOCH + datetime.timedelta(microseconds=microseconds)
+    except OverflowError:
+        return '<%d microseconds after 2000-01-01>' % microseconds
+    if timestamp.microsecond:
+        return timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S')
+
+def decode_timestamptz_datum(data, order):
+    # Stored in UTC, the session time zone is not known here
+    return decode_timestamp_datum(data, order) + '+00'
+
+def decode_numeric_datum(data, order):
+    '''NumericData in the short (since 9.1) or long format, as get_str_from_var()'''
+    if len(data) < 2:
+        return '<truncated numeric>'
+    header = struct.unpack(order + 'H', data[:2])[0]
+    if header & 0xc000 == 0xc000:
+        return {0xd000: 'Infinity', 0xf000: '-Infinity'}.get(header, 'NaN')
+
+    if header & 0xc000 == 0x8000:
+        negative = bool(header & 0x2000)
+        dscale = (header & 0x1f80) >> 7
+        weight = header & 0x3f
+        if header & 0x40:
+            weight -= 0x40
+        digits_data = data[2:]
+    else:
+        negative = header & 0xc000 == 0x4000
+        dscale = header & 0x3fff
+        weight = struct.unpack(order + 'h', data[2:4])[0]
+        digits_data = data[4:]
+    digits = struct.unpack(order + '%dh' % (len(digits_data) // 2), digits_data[:len(digits_data) // 2 * 2])
+
+    # digits[i] is worth NBASE ** (weight - i)
+    def digit(position):
+        index = weight - position
+        if 0 <= index < len(digits):
+            return digits[index]
+        return 0
+
+    integer = ''.join('%04d' % digit(position) for position in range(max(weight, 0), -1, -1)).lstrip('0')
+    text = ('-' if negative else '') + (integer or '0')
+    if dscale > 0:
+        groups = (dscale + NUMERIC_NBASE_DIGITS - 1) // NUMERIC_NBASE_DIGITS
+        fraction = ''.join('%04d' % digit(-position) for position in range(1, groups + 1))
+        text += '.' + fraction[:dscale]
+    return text
+
+def align_array_offset(data, offset, element_type):
+    '''att_align_pointer() for an offset into the payload of an array, which
+    starts VARHDRSZ bytes into a MAXALIGNed allocation'''
+    if element_type['len'] == -1 and offset < len(data) and bytearray(data[offset:offset + 1])[0] != 0:
+        # A short varlena header, which is not aligned
+        return offset
+    alignment = TYPALIGN_BYTES[element_type['align']]
+    return (offset + VARHDRSZ + alignment - 1) // alignment * alignment - VARHDRSZ
+
+def nest_array_elements(elements, dims):
+    '''{...} of the elements of an array with the given dimensions'''
+    if len(dims) == 1:
+        return '{%s}' % ','.join(elements)
+    size = len(elements) // dims[0]
+    return '{%s}' % ','.join(nest_array_elements(elements[i * size:(i + 1) * size], dims[1:])
+                             for i in range(dims[0]))
+
+def decode_array_datum(data, order):
+    '''ArrayType, as array_out() would print it'''
+    if len(data) < 12:
+        return '<truncated array>'
+    ndim, dataoffset, elemtype = struct.unpack(order + 'iiI', data[:12])
+    if ndim == 0:
+        return '{}'
+    element_type = DATUM_TYPES.get(elemtype)
+    if element_type is None or element_type['decoder'] is decode_array_datum:
+        return '<array of type %d not_supported>' % elemtype
+    decode = element_type['decoder']
+
+    dims = struct.unpack(order + '%di' % ndim, data[12:12 + 4 * ndim])
+    lbounds = struct.unpack(order + '%di' % ndim, data[12 + 4 * ndim:12 + 8 * ndim])
+    nitems = 1
+    for dim in dims:
+        nitems *= dim
+
+    header_end = 12 + 8 * ndim
+    nullmap = None
+    if dataoffset != 0:
+        nullmap = bytearray(data[header_end:header_end + (nitems + 7) // 8])
+        offset = dataoffset - VARHDRSZ
+    else:
+        offset = (header_end + VARHDRSZ + MAXIMUM_ALIGNOF - 1) // MAXIMUM_ALIGNOF * MAXIMUM_ALIGNOF - VARHDRSZ
+
+    elements = []
+    complete = True
+    for index in range(nitems):
+        if index >= MAX_ARRAY_ELEMENTS:
+            complete = False
+            break
+        if nullmap is not None and not nullmap[index // 8] & (1 << (index % 8)):
+            elements.append('NULL')
+            continue
+
+        offset = align_array_offset(data, offset, element_type)
+        if element_type['len'] == -1:
+            if offset >= len(data) or \
+                    offset + varlena_header_size(bytearray(data[offset:offset + 1])[0], order) > len(data):
+                complete = False
+                break
+            kind, header_size, size = parse_varlena_header(data[offset:], order)
+            if kind != 'plain' or offset + size > len(data):
+                complete = False
+                break
+            value = data[offset + header_size:offset + size]
+        else:
+            size = element_type['len']
+            if offset + size > len(data):
+                complete = False
+                break
+            value = data[offset:offset + size]
+        elements.append(decode(value, order))
+        offset += size
+
+    if not complete:
+        return '{%s,...}' % ','.join(elements)
+
+    text = nest_array_elements(elements, dims)
+    if any(lbound != 1 for lbound in lbounds):
+        text = ''.join('[%d:%d]' % (lbound, lbound + dim - 1) for lbound, dim in zip(lbounds, dims)) + '=' + text
+    return text
+
+# How the Datums of a type are stored and which decode_*_datum function
+# formats them, by type OID. Decoders get the bytes of the value (the Datum
+# itself for types passed by value, the payload for varlenas) and the byte
+# order of the target. More types can be added here.
+DATUM_TYPES = {
+    16: {'name': 'bool', 'len': 1, 'align': 'c', 'decoder': decode_bool_datum},
+    17: {'name': 'bytea', 'len': -1, 'align': 'i', 'decoder': decode_bytea_datum},
+    19: {'name': 'name', 'len': 64, 'align': 'c', 'decoder': decode_name_datum},
+    20: {'name': 'int8', 'len': 8, 'align': 'd', 'decoder': decode_int_datum},
+    21: {'name': 'int2', 'len': 2, 'align': 's', 'decoder': decode_int_datum},
+    23: {'name': 'int4', 'len': 4, 'align': 'i', 'decoder': decode_int_datum},
+    25: {'name': 'text', 'len': -1, 'align': 'i', 'decoder': decode_text_datum},
+    26: {'name': 'oid', 'len': 4, 'align': 'i', 'decoder': decode_oid_datum},
+    700: {'name': 'float4', 'len': 4, 'align': 'i', 'decoder': decode_float_datum},
+    701: {'name': 'float8', 'len': 8, 'align': 'd', 'decoder': decode_float_datum},
+    1042: {'name': 'bpchar', 'len': -1, 'align': 'i', 'decoder': decode_text_datum},
+    1043: {'name': 'varchar', 'len': -1, 'align': 'i', 'decoder': decode_text_datum},
+    1082: {'name': 'date', 'len': 4, 'align': 'i', 'decoder': decode_date_datum},
+    1114: {'name': 'timestamp', 'len': 8, 'align': 'd', 'decoder': decode_timestamp_datum},
+    1184: {'name': 'timestamptz', 'len': 8, 'align': 'd', 'decoder': decode_timestamptz_datum},
+    1700: {'name': 'numeric', 'len': -1, 'align': 'i', 'decoder': decode_numeric_datum},
+    2950: {'name': 'uuid', 'len': 16, 'align': 'c', 'decoder': decode_uuid_datum},
+}
+
+# Array types of the types above, their element type is in the array itself
+for array_oid, array_name in [(1000, '_bool'), (1001, '_bytea'), (1003, '_name'), (1005, '_int2'),
+                              (1007, '_int4'), (1009, '_text'), (1014, '_bpchar'), (1015, '_varchar'),
+                              (1016, '_int8'), (1021, '_float4'), (1022, '_float8'), (1028, '_oid'),
+                              (1115, '_timestamp'), (1182, '_date'), (1185, '_timestamptz'),
+                              (1231, '_numeric'), (2951, '_uuid')]:
+    DATUM_TYPES[array_oid] = {'name': array_name, 'len': -1, 'align': 'i', 'decoder': decode_array_datum}
+
+class TupleDescColumn(object):
+    '''What decoding the values of a column takes, from its pg_attribute'''
+
+    def __init__(self, attr, number):
+        self.typid = int(attr['atttypid'])
+        self.datum_type = DATUM_TYPES.get(self.typid)
+        self.len = int(attr['attlen'])
+        self.align = chr(int(attr['attalign']))
+        self.dropped = bool(int(attr['attisdropped']))
+        try:
+            self.name = escape_chars(read_c_string(int(attr['attname'].address), 64)[0])
+        except (gdb.MemoryError, TypeError):
+            self.name = 'col%d' % number
+
+def tuple_desc_columns(descr):
+    '''the TupleDescColumn of every column of a TupleDesc, looked up once
+    per TupleDesc'''
+    address = int(descr)
+    columns = tuple_desc_columns_cache.get(address)
+    if columns is None:
+        columns = []
+        attrs = descr['attrs']
+        for col in range(int(descr['natts'])):
+            # An array of pointers before PostgreSQL 11, of structs since
+            attr = attrs[col]
+            if attr.type.strip_typedefs().code == gdb.TYPE_CODE_PTR:
+                attr = attr.dereference()
+            columns.append(TupleDescColumn(attr, col + 1))
+        tuple_desc_columns_cache[address] = columns
+    return columns
+
+def format_datum(datum, typid, datum_type):
+    '''a Datum (as an unsigned integer) of type typid, as '[type] value' '''
+    if datum_type is None:
+        return "<type %d not_supported>" % typid
+
+    order = target_byte_order()
+    try:
+        kind, data, truncated = datum_bytes(datum, datum_type, order)
+    except gdb.MemoryError:
+        return "[%s] <cannot access memory at 0x%x>" % (datum_type['name'], datum)
+    if kind != 'plain':
+        return "[%s] <%s>" % (datum_type['name'], kind)
+
+    return "[%s] %s" % (datum_type['name'], decode_datum_bytes(datum_type, data, truncated, order))
+
+def decode_datum_bytes(datum_type, data, truncated, order):
+    text = datum_type['decoder'](data, order)
+    if truncated:
+        text += '...'
+    return text
+
 def format_tts_values(node, field, cast_to=None, skip_tag=False, print_null=False, indent=1):
     if str(node['tts_tupleDescriptor']) == '0x0' or str(node[field]) == '0x0':
         if print_null:
@@ -1207,44 +2633,430 @@ def format_tts_values(node, field, cast_to=None, skip_tag=False, print_null=Fals
         else:
             return ''
 
-    descr = node['tts_tupleDescriptor'].dereference()
-    natts = descr['natts']
-    attrs = descr['attrs']
+    descr = node['tts_tupleDescriptor']
+    columns = tuple_desc_columns(descr)
+    natts = len(columns)
 
-    nullmap, nullmap_bytes = get_tts_nullmap(node, 'PRIVATE_tts_isnull', natts)
-
-    tts_values_list = []
+    # The Datums and the null flags are read in one go each, only values
+    # passed by reference take a read of their own
+    datum_size = lookup_type('Datum').sizeof
+    try:
+        data = read_memory(int(node[field]), natts * datum_size)
+        nullmap = get_tts_nullmap(node, 'PRIVATE_tts_isnull', natts)
+    except gdb.MemoryError:
+        return add_indent('[%s] <cannot access memory at %s>' % (field, node[field]), indent, True)
+    datum_format = target_byte_order() + INTEGER_STRUCT_FORMATS[datum_size].upper()
+    values = [value[0] for value in struct.iter_unpack(datum_format, data)]
+    if nullmap is not None:
+        nullmap = nullmap[0]
 
-    values = node[field]
     tts_values_list = []
-    for col in range(0, natts):
-        attr = attrs[col].dereference()
+    formatted_tuple_list = []
+    for col, column in enumerate(columns):
         tts_values_list.append("[%d] 0x%08x" % (col + 1, values[col]))
+        if nullmap is not None and nullmap[col]:
+            formatted = 'NULL'
+        else:
+            formatted = format_datum(values[col], column.typid, column.datum_type)
+        formatted_tuple_list.append("[%d] %s" % (col + 1, formatted))
 
-    values_retval = '\n'.join([line for line in tts_values_list])
-
-    formatted_tuple_list= []
-    for col in range(0, natts):
-        attr = attrs[col].dereference()
-        formatted_tuple_list.append("[%d] %s" % (col + 1, format_tuple_value(values[col], nullmap[col], attr)))
-
-    formatted_tuples_retval  = '\n'.join([line for line in formatted_tuple_list])
+    values_retval = '\n'.join(tts_values_list)
+    formatted_tuples_retval = '\n'.join(formatted_tuple_list)
 
     retval = '[%s]' % field + add_indent(values_retval, 1, True)
     retval += '\n[values_formatted_tuple]' + add_indent(formatted_tuples_retval, 1, True)
     return add_indent(retval, indent, True)
 
-def format_tuple_value(value, is_null, attr):
-    typid = attr['atttypid']
-
-    if is_null:
-        return 'NULL'
-    elif typid == 20:
-        return "[int8] %d" % value
-    elif typid == 701:
-        return "[float8] %s" % value.cast(gdb.lookup_type('float8'))
+# ---
+# Heap and minimal tuples, as buffered by tuplestores and tuplesorts
+
+# t_infomask2 and t_infomask bits
+HEAP_NATTS_MASK = 0x07ff
+HEAP_HASNULL = 0x0001
+
+# vartag of a TOAST pointer to an on-disk value, the others point to memory
+VARTAG_ONDISK = 18
+VARATT_EXTERNAL_SIZE = 16
+
+# Tuples are read in one go up to this size, values past it are cut off
+MAX_TUPLE_BYTES = 1024 * 1024
+
+# Largest read of an array of tuple pointers (or of SortTuples)
+TUPLE_POINTER_READ_SIZE = 64 * 1024
+
+def align_offset(offset, typalign):
+    alignment = TYPALIGN_BYTES[typalign]
+    return (offset + alignment - 1) // alignment * alignment
+
+def decode_tuple_attribute(data, offset, column, order, pointer_size):
+    '''(text, offset of the next attribute) of the attribute at offset in
+    the bytes of a tuple, as fetch_att(). The offset is None if the tuple
+    was cut off before the end of the attribute.'''
+    if column.len == -1:
+        # Short varlenas are not aligned, as att_align_pointer()
+        if offset >= len(data) or bytearray(data[offset:offset + 1])[0] == 0:
+            offset = align_offset(offset, column.align)
+        if offset >= len(data) or \
+                offset + varlena_header_size(bytearray(data[offset:offset + 1])[0], order) > len(data):
+            return '...', None
+        kind, header_size, size = parse_varlena_header(data[offset:], order)
+        if kind == 'external':
+            vartag = bytearray(data[offset + 1:offset + 2])[0]
+            size = 2 + (VARATT_EXTERNAL_SIZE if vartag == VARTAG_ONDISK else pointer_size)
+            return '<external>', offset + size
+        if kind == 'compressed':
+            return '<compressed>', offset + size
+        value = data[offset + header_size:offset + size]
+        truncated = offset + size > len(data)
+    elif column.len == -2:
+        # cstring
+        end = data.find(b'\0', offset)
+        if end < 0:
+            return '...', None
+        return '"%s"' % escape_chars(data[offset:end]), end + 1
     else:
-        return "<type %d not_supported>" % typid
+        offset = align_offset(offset, column.align)
+        size = column.len
+        if offset + size > len(data):
+            return '...', None
+        value = data[offset:offset + size]
+        truncated = False
+
+    if column.datum_type is None:
+        text = "<type %d not_supported>" % column.typid
+    else:
+        text = decode_datum_bytes(column.datum_type, value, truncated, order)
+    if truncated:
+        return text, None
+    return text, offset + size
+
+class TupleReader(object):
+    '''
+    Reads HeapTuples and MinimalTuples with one memory read each (plus one
+    for the HeapTupleData of a HeapTuple), and decodes their values with
+    the columns of a TupleDesc, as heap_deform_tuple(). Values are the
+    formatted text, None for NULLs.
+    '''
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.order = target_byte_order()
+        self.pointer_size = lookup_type('void').pointer().sizeof
+        self.header_layout = StructLayout('HeapTupleHeaderData')
+        self.minimal_layout = StructLayout('MinimalTupleData')
+        self.heap_tuple_layout = StructLayout('HeapTupleData')
+        # MINIMAL_TUPLE_OFFSET: a MinimalTuple is a HeapTupleHeader without
+        # its first bytes, t_hoff still counts them
+        self.minimal_tuple_offset = (self.header_layout.fields['t_infomask2'].offset -
+                                     self.minimal_layout.fields['t_infomask2'].offset)
+
+    def read_heap_tuple(self, address):
+        return self.deform(self.read_heap_tuple_data(address))
+
+    def read_heap_tuple_data(self, address):
+        '''the bytes of the tuple of a HeapTupleData, from its header on'''
+        raw = read_memory(address, self.heap_tuple_layout.sizeof)
+        length = self.heap_tuple_layout.integer(raw, 't_len')
+        return read_memory(self.heap_tuple_layout.pointer(raw, 't_data'), min(length, MAX_TUPLE_BYTES))
+
+    def header_oid(self, data):
+        '''the OID stored in the header of a tuple before PostgreSQL 12, or None'''
+        layout = self.header_layout
+        if not layout.integer(data, 't_infomask') & HEAP_HASOID:
+            return None
+        offset = layout.integer(data, 't_hoff') - 4
+        return struct.unpack(self.order + 'I', data[offset:offset + 4])[0]
+
+    def read_minimal_tuple(self, address):
+        size = max(self.minimal_layout.sizeof, MEMORY_PAGE_SIZE - address % MEMORY_PAGE_SIZE)
+        data = read_memory(address, min(size, MAX_TUPLE_BYTES))
+        length = self.minimal_layout.integer(data, 't_len')
+        if length > len(data):
+            data = read_memory(address, min(length, MAX_TUPLE_BYTES))
+        data = data[:length]
+        return self.deform(b'\0' * self.minimal_tuple_offset + data)
+
+    def deform(self, data):
+        '''the values of a tuple, given its bytes from the HeapTupleHeader on'''
+        layout = self.header_layout
+        natts = layout.integer(data, 't_infomask2') & HEAP_NATTS_MASK
+        nullmap = None
+        if layout.integer(data, 't_infomask') & HEAP_HASNULL:
+            bits_offset = layout.fields['t_bits'].offset
+            nullmap = bytearray(data[bits_offset:bits_offset + (natts + 7) // 8])
+
+        values = []
+        offset = layout.integer(data, 't_hoff')
+        for index, column in enumerate(self.columns):
+            # Columns added after the tuple was formed are missing from it
+            if index >= natts or (nullmap is not None and not nullmap[index // 8] & (1 << (index % 8))):
+                values.append(None)
+                continue
+            if offset is None:
+                values.append('...')
+                continue
+            text, offset = decode_tuple_attribute(data, offset, column, self.order, self.pointer_size)
+            values.append(text)
+        return values
+
+# ---
+# Expression trees as compact infix text, see pgexpr
+
+# Node structs are read in one go, up to this many bytes (never crossing a
+# page boundary); bigger ones take a second read
+EXPR_READ_SIZE = 128
+
+# Deeper expressions are cut off with '...'
+MAX_EXPR_DEPTH = 100
+
+VARNO_NAMES = {65000: 'INNER', 65001: 'OUTER', 65002: 'INDEX',
+               # PostgreSQL 16 made them negative
+               -1: 'INNER', -2: 'OUTER', -3: 'INDEX'}
+
+BOOL_EXPR_OPERATORS = {0: 'AND', 1: 'OR', 2: 'NOT'}
+
+# CoercionForm of casts that EXPLAIN does not show
+COERCE_IMPLICIT_CAST = 2
+
+# t_infomask bit of tuples with an OID in their header, before PostgreSQL 12
+HEAP_HASOID = 0x0008
+
+# StructLayout of every node type read by RawNode so far
+struct_layouts = {}
+
+# oid -> name of the operators and functions in the catalog caches, loaded
+# once per stop of the inferior
+catalog_names = {}
+
+def clear_catalog_names(event=None):
+    catalog_names.clear()
+
+if gdb is not None:
+    for event_registry in [gdb.events.stop, gdb.events.memory_changed, gdb.events.inferior_call_post,
+                           gdb.events.new_objfile, gdb.events.clear_objfiles]:
+        event_registry.connect(clear_catalog_names)
+
+# Longest bucket list of a catalog cache walked, in case its links are
+# corrupted
+MAX_CATCACHE_BUCKET_ENTRIES = 10000
+
+def load_catalog_cache_names(cache_id, name_column):
+    '''oid -> name of the entries of SysCache[cache_id] (such as OPEROID) that
+    the backend has loaded, empty if there is no catalog cache to look at'''
+    names = {}
+    try:
+        cache = gdb.parse_and_eval('SysCache')[int(gdb.parse_and_eval(cache_id))]
+        if int(cache) == 0:
+            return names
+        reader = TupleReader(tuple_desc_columns(cache['cc_tupdesc']))
+        column_names = [column.name for column in reader.columns]
+        name_index = column_names.index(name_column)
+        oid_index = column_names.index('oid') if 'oid' in column_names else None
+
+        buckets = cache['cc_bucket']
+        layout = get_struct_layout('CatCTup')
+        # The bucket lists link the cache_elem fields of the CatCTups
+        elem_offset = layout.fields['cache_elem'].offset
+        tuple_offset = layout.fields['tuple'].offset
+        nbuckets = int(cache['cc_nbuckets'])
+    except (gdb.error, gdb.MemoryError, ValueError, KeyError, struct.error):
+        return names
+
+    for bucket in range(nbuckets):
+        try:
+            head = int(buckets[bucket]['head'].address)
+            node = buckets[bucket]['head']['next']
+        except (gdb.error, gdb.MemoryError):
+            continue
+        # A corrupted next pointer may never lead back to the head
+        for i in range(MAX_CATCACHE_BUCKET_ENTRIES):
+            if int(node) == 0 or int(node) == head:
+                break
+            entry = int(node) - elem_offset
+            try:
+                node = node['next']
+            except (gdb.error, gdb.MemoryError):
+                break
+
+            # A garbage entry is skipped, the names of the others still count
+            try:
+                raw = read_memory(entry, layout.sizeof)
+                # Negative entries have no tuple, dead ones may be half gone
+                if any(layout.has_field(flag) and layout.integer(raw, flag) != 0
+                       for flag in ['negative', 'dead']):
+                    continue
+
+                data = reader.read_heap_tuple_data(entry + tuple_offset)
+                values = reader.deform(data)
+                if oid_index is not None:
+                    oid = values[oid_index]
+                else:
+                    oid = reader.header_oid(data)
+                name = values[name_index]
+                if oid is not None and name is not None:
+                    # decode_name_datum quotes it
+                    names[int(oid)] = name[1:-1]
+            except (gdb.error, gdb.MemoryError, ValueError, KeyError, struct.error):
+                continue
+    return names
+
+def catalog_name(cache_id, name_column, oid):
+    '''the name of an operator or function, or None if it is not in the
+    catalog cache of the backend'''
+    names = catalog_names.get(cache_id)
+    if names is None:
+        names = load_catalog_cache_names(cache_id, name_column)
+        catalog_names[cache_id] = names
+    return names.get(oid)
+
+def get_struct_layout(type_name):
+    layout = struct_layouts.get(type_name)
+    if layout is None:
+        layout = StructLayout(type_name)
+        struct_layouts[type_name] = layout
+    return layout
+
+class RawNode(object):
+    '''The raw bytes of a node and what its tag says it is'''
+
+    def __init__(self, address):
+        self.address = address
+        size = max(4, min(EXPR_READ_SIZE, MEMORY_PAGE_SIZE - address % MEMORY_PAGE_SIZE))
+        self.raw = read_memory(address, size)
+        tag_info = get_node_tag_table().get(struct.unpack(target_byte_order() + 'i', self.raw[:4])[0])
+        self.tag_info = tag_info
+        self.type_name = tag_info.name if tag_info is not None else None
+
+        self.layout = None
+        if tag_info is not None and tag_info.struct_type is not None:
+            self.layout = get_struct_layout(self.type_name)
+            if self.layout.sizeof > len(self.raw):
+                self.raw = read_memory(address, self.layout.sizeof)
+
+    def integer(self, field):
+        return self.layout.integer(self.raw, field, signed=True)
+
+    def pointer(self, field):
+        return self.layout.pointer(self.raw, field)
+
+def expr_list_elements(address):
+    '''the addresses of the elements of a List of nodes'''
+    if address == 0:
+        return []
+    lst = gdb.Value(address).cast(lookup_type('List').pointer())
+    return [int(element) for element in iterate_node_list(lst)]
+
+class ExprRenderer(object):
+    '''Renders expression trees as infix text, such as (1.3 > $1) AND f(2.1),
+    reading only the fields that takes'''
+
+    def __init__(self):
+        self.order = target_byte_order()
+
+    def render(self, address, depth=0):
+        if address == 0:
+            return 'NULL'
+        if depth >= MAX_EXPR_DEPTH:
+            return '...'
+        try:
+            node = RawNode(address)
+        except gdb.MemoryError:
+            return '<cannot access memory at 0x%x>' % address
+        if node.type_name is None:
+            return '<invalid node 0x%x>' % address
+
+        method = getattr(self, 'render_%s' % node.type_name, None)
+        if method is None or node.layout is None:
+            return '<%s>' % node.type_name
+        return method(node, depth + 1)
+
+    def render_args(self, address, depth):
+        return [self.render(element, depth) for element in expr_list_elements(address)]
+
+    def render_List(self, node, depth):
+        return ', '.join(self.render_args(node.address, depth))
+
+    def render_Var(self, node, depth):
+        varno = node.integer('varno')
+        text = '%s.%d' % (VARNO_NAMES.get(varno, varno), node.integer('varattno'))
+        levelsup = node.integer('varlevelsup')
+        if levelsup > 0:
+            text += '^%d' % levelsup
+        return text
+
+    def render_Const(self, node, depth):
+        if node.integer('constisnull'):
+            return 'NULL'
+        typid = node.integer('consttype') & 0xffffffff
+        datum_type = DATUM_TYPES.get(typid)
+        if datum_type is None:
+            return '<const of type %d>' % typid
+        try:
+            kind, data, truncated = datum_bytes(node.pointer('constvalue'), datum_type, self.order)
+        except gdb.MemoryError:
+            return '<cannot access memory>'
+        if kind != 'plain':
+            return '<%s>' % kind
+        return decode_datum_bytes(datum_type, data, truncated, self.order)
+
+    def render_Param(self, node, depth):
+        return '$%d' % node.integer('paramid')
+
+    def operator_name(self, opno):
+        return catalog_name('OPEROID', 'oprname', opno) or 'OPERATOR(%d)' % opno
+
+    def function_name(self, funcid):
+        return catalog_name('PROCOID', 'proname', funcid) or 'function%d' % funcid
+
+    def render_OpExpr(self, node, depth):
+        name = self.operator_name(node.integer('opno') & 0xffffffff)
+        args = self.render_args(node.pointer('args'), depth)
+        if len(args) == 1:
+            return '(%s %s)' % (name, args[0])
+        return '(%s)' % (' %s ' % name).join(args)
+
+    def render_DistinctExpr(self, node, depth):
+        return '(%s)' % ' IS DISTINCT FROM '.join(self.render_args(node.pointer('args'), depth))
+
+    def render_NullIfExpr(self, node, depth):
+        return 'NULLIF(%s)' % ', '.join(self.render_args(node.pointer('args'), depth))
+
+    def render_ScalarArrayOpExpr(self, node, depth):
+        name = self.operator_name(node.integer('opno') & 0xffffffff)
+        args = self.render_args(node.pointer('args'), depth) + ['?', '?']
+        return '(%s %s %s (%s))' % (args[0], name, 'ANY' if node.integer('useOr') else 'ALL', args[1])
+
+    def render_BoolExpr(self, node, depth):
+        operator = BOOL_EXPR_OPERATORS.get(node.integer('boolop'), '?')
+        args = self.render_args(node.pointer('args'), depth)
+        if operator == 'NOT':
+            return 'NOT %s' % ', '.join(args)
+        return '(%s)' % (' %s ' % operator).join(args)
+
+    def render_FuncExpr(self, node, depth):
+        args = self.render_args(node.pointer('args'), depth)
+        if node.integer('funcformat') == COERCE_IMPLICIT_CAST and len(args) == 1:
+            return args[0]
+        return '%s(%s)' % (self.function_name(node.integer('funcid') & 0xffffffff), ', '.join(args))
+
+    def render_Aggref(self, node, depth):
+        # The arguments are TargetEntries
+        args = self.render_args(node.pointer('args'), depth)
+        return '%s(%s)' % (self.function_name(node.integer('aggfnoid') & 0xffffffff), ', '.join(args) or '*')
+
+    def render_NullTest(self, node, depth):
+        test = 'IS NOT NULL' if node.integer('nulltesttype') else 'IS NULL'
+        return '(%s %s)' % (self.render(node.pointer('arg'), depth), test)
+
+    def render_RelabelType(self, node, depth):
+        return self.render(node.pointer('arg'), depth)
+
+    def render_CoerceViaIO(self, node, depth):
+        return self.render(node.pointer('arg'), depth)
+
+    def render_TargetEntry(self, node, depth):
+        return self.render(node.pointer('expr'), depth)
+
 #---
 
 def debug_format_regular_field(node, field):
@@ -1318,124 +3130,423 @@ def debug_format_pseudo_node_field(node, fieldname, cast_to=None, skip_tag=False
     return ret
 
 
-class NodeFormatter(object):
-    # Basic node information
-    _node = None
-    _parent_node = None
+def type_is_node(t):
+    '''type based equivalent of is_node(): does a value of type 't' (or the
+    struct it points to) have a 'type' or 'xpr' field'''
+    t = t.strip_typedefs()
+    if t.code == gdb.TYPE_CODE_PTR:
+        t = t.target().strip_typedefs()
 
-    _type_string = None
-    _base_type = None
-    _node_type = None
+    if t.code not in [gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION]:
+        return False
 
-    # String representations of individual fields in node
-    _all_fields = None
-    _regular_fields = None
-    _node_fields = None
-    _list_fields = None
-    _tree_fields = None
-    _ignore_field_types = None
+    for f in t.fields():
+        if f.name in ['type', 'xpr']:
+            return True
+    return False
 
-    # Some node types are sub-types of other fields, for example a JoinState inherits a PlanState
-    __nested_nodes = None
+def get_objfile_key(t):
+    # gdb.Type.objfile is only available in newer gdb versions
+    objfile = getattr(t, 'objfile', None)
+    if objfile is None:
+        return None
+    return objfile.filename
+
+def get_type_metadata(type_string, base_type, pseudo_node=False):
+    key = (type_string, get_objfile_key(base_type), pseudo_node)
+    metadata = type_metadata_cache.get(key)
+    if metadata is None:
+        metadata = NodeTypeMetadata(type_string, base_type, pseudo_node)
+        type_metadata_cache[key] = metadata
+    return metadata
+
+def describe_field(field):
+    '''what NodeTypeMetadata needs to know about a struct field, as a plain
+    dict that can be stored in the schema cache'''
+    t = field.type.strip_typedefs()
+    description = {
+        'name': field.name,
+        'type': str(field.type),
+        'basic_type': str(gdb.types.get_basic_type(field.type)),
+        'base_datatype': str(get_base_datatype(field.type)),
+        'bitpos': field.bitpos,
+        'bitsize': field.bitsize,
+        'sizeof': field.type.sizeof,
+        'code': t.code,
+        'signed': False,
+        'is_list': get_base_datatype(field.type) == get_base_datatype(lookup_type('List')),
+        'is_node': (get_base_datatype(field.type) == get_base_datatype(lookup_type('Node'))
+                    or type_is_node(field.type)),
+    }
 
-    _default_display_methods = None
-    _default_regular_visibility = None
-    _default_list_visibility = None
-    _default_node_visibility = None
-    _default_skip_tag = None
-    _formatter_overrides = None
-
-    # String representation of the types to match to generate the above lists
-    _list_types = None
-    _node_types = None
-    def __init__(self, node, typecast=None, pseudo_node=False):
-
-        # TODO: get node and list types from yaml config OR check each field
-        #       for a node 'signature'
-        # TODO: this should be done in a class method
-        self._list_types = ["List"]
-        self._node_types = ["Node"]
+    if t.code in [gdb.TYPE_CODE_INT, gdb.TYPE_CODE_ENUM]:
+        description['signed'] = is_signed_type(t)
+    if t.code == gdb.TYPE_CODE_ENUM:
+        description['enum'] = [[f.enumval, f.name] for f in t.fields()]
+    if t.code == gdb.TYPE_CODE_PTR:
+        target = t.target()
+        description['target_code'] = target.strip_typedefs().code
+        description['target_const'] = 'const' in str(target).split()
+
+    return description
+
+def is_main_objfile_type(t):
+    '''is 't' defined by the program itself (not by a shared library). With
+    separate debug info the type comes from the .debug objfile, whose owner
+    (or build-id) is the one of the program.'''
+    # gdb.Type.objfile is only available in newer gdb versions
+    objfile = getattr(t, 'objfile', None)
+    if objfile is None:
+        return True
+    main_objfile = get_main_objfile()
+    if main_objfile is None:
+        return False
+    if objfile == main_objfile or getattr(objfile, 'owner', None) == main_objfile:
+        return True
+    # gdb.Objfile.build_id is only available in newer gdb versions
+    build_id = getattr(main_objfile, 'build_id', None)
+    return build_id is not None and getattr(objfile, 'build_id', None) == build_id
+
+def get_type_description(type_string, base_type):
+    '''size and describe_field() of every field of a struct type'''
+    cache = None
+    if is_main_objfile_type(base_type) and (base_type.name or base_type.tag):
+        cache = get_schema_cache()
+    if cache is not None:
+        description = cache.types.get(type_string)
+        if description is not None:
+            return description
+
+    description = {
+        'sizeof': base_type.sizeof,
+        'fields': [describe_field(f) for f in base_type.fields()],
+    }
+    if cache is not None:
+        cache.types[type_string] = description
+        cache.dirty = True
+    return description
+
+class SchemaCache(object):
+    '''Type descriptions and NodeTags of one build of the program, loaded from
+    and saved to a JSON file'''
+
+    def __init__(self, path):
+        self.path = path
+        self.types = {}
+        self.node_tags = None
+        self.dirty = False
+
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
 
-        self._pseudo_node = pseudo_node
-        if typecast == None:
-            if self._pseudo_node:
-                pseudo_type = node.type.strip_typedefs()
-                stripped_type = pseudo_type
+        # Type codes may differ between gdb versions
+        if data.get('version') != SCHEMA_CACHE_VERSION or data.get('gdb') != gdb.VERSION:
+            return
+        self.types = data['types']
+        self.node_tags = data['node_tags']
 
-                self._type_string = get_base_datatype_string(node)
-                self._base_type = get_base_datatype(node)
-                self._node_type = pseudo_type
-                # TODO: Why does this work?
-                #if self._node_type.code != gdb.TYPE_CODE_PTR:
-                #    raise Exception("Must use a pointer for pseudo node types")
-            else:
-                self._type_string = get_base_node_type(node)
-                self._base_type = gdb.lookup_type(self._type_string)
-                self._node_type = self._base_type.pointer()
-        else:
-            self._type_string = typecast
-            self._base_type = gdb.lookup_type(self.type_string)
-            self._node_type = self._base_type.pointer()
+    def save(self):
+        if not self.dirty:
+            return
 
-        self._node = node.cast(self._node_type)
+        data = {
+            'version': SCHEMA_CACHE_VERSION,
+            'gdb': gdb.VERSION,
+            'types': self.types,
+            'node_tags': self.node_tags,
+        }
+        # Write to a temporary file first, other sessions may be reading it
+        temp_path = '%s.%d' % (self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(data, f)
+            os.replace(temp_path, self.path)
+        except OSError:
+            # Not being able to cache is no reason to fail
+            return
+        self.dirty = False
 
+def get_main_objfile():
+    '''objfile of the program being debugged, or None'''
+    filename = gdb.current_progspace().filename
+    if filename is None:
+        return None
+    for objfile in gdb.objfiles():
+        if objfile.filename == filename:
+            return objfile
+    return None
 
-        # Get methods for display
-        self._default_display_methods = DEFAULT_DISPLAY_METHODS
-        self._default_regular_visibility = ALWAYS_SHOW
-        self._default_list_visibility = NOT_NULL
-        self._default_node_visibility = NOT_NULL
-        self._default_skip_tag = False
-        self._formatter_overrides = FORMATTER_OVERRIDES.get(self.type_string)
-        #print("NodeFormatter:", self.type)
+def get_build_id():
+    '''build-id of the program being debugged, or None'''
+    objfile = get_main_objfile()
+    if objfile is None:
+        return None
+    # gdb.Objfile.build_id is only available in newer gdb versions
+    return getattr(objfile, 'build_id', None)
 
-    def is_child_node(self):
-        if self._pseudo_node:
-            return False
+def get_schema_cache():
+    '''SchemaCache of the program being debugged, or None if it cannot be
+    cached (no build-id, or caching disabled)'''
+    global schema_cache, schema_cache_loaded
 
-        t = gdb.lookup_type(self.type_string)
-        first_field = t.values()[0]
+    if not schema_cache_loaded:
+        schema_cache_loaded = True
+        build_id = None
+        if SCHEMA_CACHE_DIR is not None:
+            build_id = get_build_id()
+        if build_id is not None:
+            schema_cache = SchemaCache(os.path.join(SCHEMA_CACHE_DIR, '%s.json' % build_id))
 
-        if first_field.name == "type":
-            return False
-        elif first_field.name == "xpr":
-            return False
-        elif first_field.name == "xprstate":
-            return False
+    return schema_cache
 
-        return True
+def save_schema_cache(event=None):
+    if schema_cache is not None:
+        schema_cache.save()
+
+# gdb.events.before_prompt is only available in newer gdb versions, commands
+# save the cache themselves as well for gdb -batch
+if gdb is not None and hasattr(gdb.events, 'before_prompt'):
+    gdb.events.before_prompt.connect(save_schema_cache)
+
+INTEGER_STRUCT_FORMATS = {1: 'b', 2: 'h', 4: 'i', 8: 'q'}
+
+def is_signed_type(t):
+    # gdb.Type.is_signed is only available in newer gdb versions
+    try:
+        return t.is_signed
+    except (AttributeError, ValueError):
+        return 'unsigned' not in str(t)
+
+def make_integer_unpacker(sizeof, signed, order=None):
+    int_format = INTEGER_STRUCT_FORMATS.get(sizeof)
+    if int_format is None:
+        return None
+    if not signed:
+        int_format = int_format.upper()
+    if order is None:
+        order = target_byte_order()
+    return struct.Struct(order + int_format).unpack
+
+def field_decoder_spec(field):
+    '''how make_decoder() can format a field (a describe_field() dict) from
+    its raw bytes the same way gdb would print it, as a plain dict, or None
+    if we have to leave that to gdb'''
+    code = field['code']
+    sizeof = field['sizeof']
+
+    if code == gdb.TYPE_CODE_BOOL and sizeof == 1:
+        return {'kind': 'bool', 'sizeof': sizeof}
+
+    # One byte integers are chars to gdb, which prints them as 65 'A'
+    if code == gdb.TYPE_CODE_INT and sizeof > 1:
+        return {'kind': 'int', 'sizeof': sizeof, 'signed': field['signed']}
+
+    if code == gdb.TYPE_CODE_ENUM:
+        return {'kind': 'enum', 'sizeof': sizeof, 'signed': field['signed'], 'enum': field['enum']}
+
+    if code == gdb.TYPE_CODE_PTR:
+        # gdb prints the string for char pointers and the symbol for
+        # function pointers and pointers to (usually static) const data
+        if field['target_code'] not in [gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION]:
+            return None
+        if field['target_const']:
+            return None
+        if sizeof != lookup_type('void').pointer().sizeof:
+            return None
+        return {'kind': 'pointer', 'sizeof': sizeof}
+
+    return None
+
+def make_decoder(spec, order):
+    '''returns a function that formats raw bytes as described by a
+    field_decoder_spec(), in byte order 'order', or None. The function itself
+    may also return None for values it does not know how to print. Does not
+    need gdb, pgrender.py uses it for snapshots.'''
+    kind = spec['kind']
+
+    if kind == 'bool':
+        bool_names = {0: 'false', 1: 'true'}
+        return lambda data: bool_names.get(data[0], str(data[0]))
+
+    if kind == 'pointer':
+        unpack = make_integer_unpacker(spec['sizeof'], False, order)
+        if unpack is None:
+            return None
+        return lambda data: '0x%x' % unpack(data)[0]
+
+    unpack = make_integer_unpacker(spec['sizeof'], spec['signed'], order)
+    if unpack is None:
+        return None
+
+    if kind == 'int':
+        return lambda data: str(unpack(data)[0])
+
+    # Values that are not a single enumerator (flag combinations,
+    # garbage) are left to gdb
+    enum_names = dict((value, name) for value, name in spec['enum'])
+    return lambda data: enum_names.get(unpack(data)[0])
+
+def make_field_decoder(field):
+    '''returns a function that formats a field (a describe_field() dict) from
+    its raw bytes the same way gdb would print it, or None if we have to
+    leave that to gdb. The function itself may also return None for values
+    it does not know how to print.'''
+    spec = field_decoder_spec(field)
+    if spec is None:
+        return None
+    return make_decoder(spec, target_byte_order())
+
+# Type codes for which a value is 0 (or -1) exactly when all of its bytes are
+# 0x00 (or 0xff)
+BYTE_COMPARABLE_TYPE_CODES = []
+if gdb is not None:
+    BYTE_COMPARABLE_TYPE_CODES = [gdb.TYPE_CODE_INT, gdb.TYPE_CODE_ENUM, gdb.TYPE_CODE_BOOL,
+                                  gdb.TYPE_CODE_CHAR, gdb.TYPE_CODE_PTR]
+
+class FieldLayout(object):
+    '''Where a field lives inside its struct and how to decode it'''
+
+    def __init__(self, field):
+        self.offset = None
+        self.size = field['sizeof']
+        self.decoder_spec = None
+        self.decoder = None
+        self.byte_comparable = False
+
+        # Bit fields cannot be sliced out of the raw bytes
+        if field['bitsize'] != 0 or field['bitpos'] % 8 != 0:
+            return
+
+        self.offset = field['bitpos'] // 8
+        self.decoder_spec = field_decoder_spec(field)
+        if self.decoder_spec is not None:
+            self.decoder = make_decoder(self.decoder_spec, target_byte_order())
+        self.byte_comparable = field['code'] in BYTE_COMPARABLE_TYPE_CODES
+
+    def get_bytes(self, raw_bytes):
+        return raw_bytes[self.offset:self.offset + self.size]
+
+class NodeTypeMetadata(object):
+    '''Everything NodeFormatter needs to know about a type that does not
+    depend on the value being formatted: field order, classification,
+    formatter overrides and the resolved display method of each field'''
+
+    def __init__(self, type_string, base_type, pseudo_node=False, ignore_field_types=None):
+        self.type_string = type_string
+        self.base_type = base_type
+        self.pseudo_node = pseudo_node
+        self.formatter_overrides = FORMATTER_OVERRIDES.get(type_string)
+
+        description = get_type_description(type_string, base_type)
+
+        # Some node types are sub-types of other nodes, for example a
+        # JoinState inherits a PlanState through its first field
+        self.parent_type_string = None
+        first_field = description['fields'][0]
+        self.first_field = first_field['name']
+        if not pseudo_node and first_field['name'] not in ["type", "xpr", "xprstate"]:
+            self.parent_type_string = first_field['type']
+
+        self.sizeof = description['sizeof']
+        self.fields = []
+        # field -> name of its type, typedefs and qualifiers stripped
+        self.field_datatypes = {}
+        self.field_layouts = {}
+        for index, field in enumerate(description['fields']):
+            # TODO: should the ability to ignore fields entirely exist at all?
+            #       This seems to conflict with the visibility settings
+            if ignore_field_types is not None:
+                if any(self.is_type(field, tag) for tag in ignore_field_types):
+                    continue
+
+            if index == 0:
+                # The node['type'] field is just a tag that we already know,
+                # node['xpr'] is just a wrapper around node['type'] and the
+                # first field of child nodes is formatted by the parent
+                if field['name'] in ["type", "xpr", "xprstate"] or self.is_child_node:
+                    continue
+
+            self.fields.append(field['name'])
+            self.field_datatypes[field['name']] = field['basic_type']
+            self.field_layouts[field['name']] = FieldLayout(field)
+
+        self.list_fields = []
+        self.node_fields = []
+        self.tree_fields = []
+        self.regular_fields = []
+        for field in description['fields']:
+            if field['name'] not in self.field_datatypes:
+                continue
+            f = field['name']
+
+            # Honor overrides before all else
+            override_string = self.get_field_override(f, 'field_type')
+            if override_string == 'list_field':
+                self.list_fields.append(f)
+            elif override_string == 'node_field':
+                self.node_fields.append(f)
+            elif override_string == 'tree_field':
+                self.tree_fields.append(f)
+            elif override_string != None:
+                continue
+            elif field['is_list']:
+                self.list_fields.append(f)
+            elif field['is_node']:
+                self.node_fields.append(f)
+            else:
+                self.regular_fields.append(f)
+
+        self.display_methods = {}
+        self.write_methods = {}
+        self.visibility = {}
+        self.skip_tag = {}
+        for f in self.fields:
+            self.display_methods[f] = self.resolve_display_method(f)
+            write_method_name = DISPLAY_WRITE_METHODS.get(self.display_methods[f].__name__)
+            if write_method_name != None:
+                self.write_methods[f] = globals()[write_method_name]
+            self.visibility[f] = self.resolve_display_mode(f)
+            self.skip_tag[f] = self.get_field_override(f, 'skip_tag') or False
+
+        self._plan = None
 
     @property
-    def parent_node(self):
-        if self._parent_node == None:
-            if self.is_child_node():
-                t = gdb.lookup_type(self.type_string)
-                first_field = t.values()[0]
+    def is_child_node(self):
+        return self.parent_type_string != None
 
-                self._parent_node = NodeFormatter(self._node, str(first_field.type))
-        return self._parent_node
+    @property
+    def plan(self):
+        '''the NodeTypePlan of this type, compiled on first use'''
+        if self._plan is None:
+            self._plan = NodeTypePlan(self)
+        return self._plan
 
+    def is_type(self, field, type_name):
+        return field['base_datatype'] == str(get_base_datatype(lookup_type(type_name)))
 
     def get_datatype_override(self, field):
-        if self._formatter_overrides != None:
-            datatype_overrides = self._formatter_overrides.get('datatype_methods')
+        if self.formatter_overrides != None:
+            datatype_overrides = self.formatter_overrides.get('datatype_methods')
             if datatype_overrides != None:
-                return datatype_overrides.get(str(self.field_datatype(field)))
+                return datatype_overrides.get(self.field_datatypes[field])
         return None
 
-
     def get_field_override(self, field, override_type):
-        if self._formatter_overrides != None:
-            field_overrides = self._formatter_overrides.get('fields')
+        if self.formatter_overrides != None:
+            field_overrides = self.formatter_overrides.get('fields')
             if field_overrides != None:
                 field_override = field_overrides.get(field)
                 if field_override != None:
                     return field_override.get(override_type)
         return None
 
-    def get_display_method(self, field):
+    def resolve_display_method(self, field):
         # Individual field overrides are a higher priority than type
-        # overrides so print them first
+        # overrides so check them first
         field_override_method_name = self.get_field_override(field, 'formatter')
         if field_override_method_name != None:
             return globals()[field_override_method_name]
@@ -1446,233 +3557,330 @@ class NodeFormatter(object):
             return globals()[datatype_override_method]
 
         # Check if this datatype has a generic dumping method
-        default_type_method = self._default_display_methods['datatype_methods'].get(str(self.field_datatype(field)))
+        default_type_method = DEFAULT_DISPLAY_METHODS['datatype_methods'].get(self.field_datatypes[field])
         if default_type_method != None:
             return globals()[default_type_method]
 
         if field in self.regular_fields:
-            return globals()[self._default_display_methods['regular_fields']]
+            return globals()[DEFAULT_DISPLAY_METHODS['regular_fields']]
         elif field in self.node_fields:
-            return globals()[self._default_display_methods['node_fields']]
+            return globals()[DEFAULT_DISPLAY_METHODS['node_fields']]
         elif field in self.list_fields:
-            return globals()[self._default_display_methods['list_fields']]
+            return globals()[DEFAULT_DISPLAY_METHODS['list_fields']]
         elif field in self.tree_fields:
-            return globals()[self._default_display_methods['tree_fields']]
+            return globals()[DEFAULT_DISPLAY_METHODS['tree_fields']]
 
         raise Exception("Did not find a display method for %s[%s]" % (self.type_string, field))
 
-
-    def get_display_mode(self, field):
-        # If the global 'show_hidden' is set, then this command shal always
-        # return ALWAYS_SHOW
-        if self._default_display_methods['show_hidden'] == True:
-            return ALWAYS_SHOW
-
+    def resolve_display_mode(self, field):
         override_string = self.get_field_override(field, 'visibility')
         if override_string != None:
             return override_string
 
         if field in self.regular_fields:
-            return self._default_regular_visibility
+            return ALWAYS_SHOW
         if field in self.list_fields:
-            return self._default_list_visibility
+            return NOT_NULL
         if field in self.node_fields:
-            return self._default_node_visibility
+            return NOT_NULL
 
         return ALWAYS_SHOW
 
-    def is_skip_tag(self, field):
-        # If the global 'show_hidden' is set, always show tag
-        if self._default_display_methods['show_hidden'] == True:
-            return False
-
-        skip_tag = self.get_field_override(field, 'skip_tag')
-        if skip_tag != None:
-            return skip_tag
-
-        return self._default_skip_tag
+class FieldPlan(object):
+    '''A field of a compiled node type, with its display settings resolved'''
+
+    def __init__(self, metadata, field, level):
+        self.name = field
+        # Index of the struct that declares the field in NodeTypePlan.levels
+        self.level = level
+        self.layout = metadata.field_layouts[field]
+        self.visibility = metadata.visibility[field]
+        self.display_method = metadata.display_methods[field]
+        self.write_method = metadata.write_methods.get(field)
+        self.skip_tag = metadata.skip_tag[field]
+
+        # Regular fields printed by the default method are decoded from the
+        # raw bytes of the node when possible
+        self.decoder = None
+        if self.display_method is format_regular_field:
+            self.decoder = self.layout.decoder
 
     @property
-    def type_string(self):
-        return self._type_string
+    def snapshot_kind(self):
+        ''''node' and 'list' fields are followed by pgrender.py itself, the
+        output of 'prepared' fields is formatted when the snapshot is taken'''
+        if self.write_method is write_optional_node_field:
+            return 'node'
+        if self.write_method is write_optional_node_list:
+            return 'list'
+        return 'prepared'
+
+    def describe(self):
+        '''what pgrender.py needs to know about the field, as a plain dict'''
+        return {
+            'name': self.name,
+            'offset': self.layout.offset,
+            'size': self.layout.size,
+            'decoder': self.layout.decoder_spec if self.decoder is not None else None,
+            'byte_comparable': self.layout.byte_comparable,
+            'visibility': self.visibility,
+            'skip_tag': self.skip_tag,
+            'level': self.level,
+            'kind': self.snapshot_kind,
+        }
 
-    @property
-    def fields(self):
-        if self._all_fields == None:
-            self._all_fields = []
-            t = self._base_type
-
-            for index in range(0, len(t.values())):
-                skip = False
-
-                field = t.values()[index]
-                # TODO: should the ability to ignore fields entirely exist at all?
-                #       This seems to conflict with the visibility settings
-                # Fields that are to be ignored
-                if self._ignore_field_types is not None:
-                    for tag in self._ignore_field_types:
-                        if self.is_type(field, tag):
-                            skip = True
-
-                if index == 0:
-                    # The node['type'] field is just a tag that we already know
-                    if field.name == "type":
-                        skip = True
-                    # The node['xpr'] field is just a wrapper around node['type']
-                    elif field.name == "xpr":
-                        skip = True
-                    elif field.name == "xprstate":
-                        skip = True
-                    elif self.is_child_node():
-                        skip = True
-                if skip:
+class NodeTypePlan(object):
+    '''
+    A node type flattened together with the types it inherits through its
+    first field (SeqScan -> Scan -> Plan), in the order NodeFormatter writes
+    them:
+
+        levels          (type name, type, path) of every struct, outermost
+                        parent first. path is the list of first fields
+                        leading from the node to that struct.
+        regular_fields  FieldPlans of the regular fields, one list per level
+        complex_fields  FieldPlans of the node and list fields, parents first
+        tree_fields     FieldPlans of the tree fields, one list per level,
+                        the node itself first
+    '''
+
+    def __init__(self, metadata):
+        chain = [metadata]
+        while chain[0].is_child_node:
+            parent_type_string = chain[0].parent_type_string
+            chain.insert(0, get_type_metadata(parent_type_string, lookup_type(parent_type_string)))
+
+        self.levels = []
+        for depth, level_metadata in enumerate(chain):
+            path = []
+            for child in chain[depth + 1:]:
+                path.insert(0, child.first_field)
+            self.levels.append((level_metadata.type_string, level_metadata.base_type, path))
+
+        self.regular_fields = []
+        self.complex_fields = []
+        self.tree_fields = []
+        for level, level_metadata in enumerate(chain):
+            self.regular_fields.append([FieldPlan(level_metadata, f, level)
+                                        for f in level_metadata.regular_fields])
+            self.tree_fields.insert(0, [FieldPlan(level_metadata, f, level)
+                                        for f in level_metadata.tree_fields])
+            for f in level_metadata.fields:
+                if f in level_metadata.regular_fields or f in level_metadata.tree_fields:
                     continue
+                self.complex_fields.append(FieldPlan(level_metadata, f, level))
+
+    def describe(self):
+        '''the plan as a plain dict, for snapshots'''
+        return {
+            'regular_fields': [[f.describe() for f in fields] for fields in self.regular_fields],
+            'complex_fields': [f.describe() for f in self.complex_fields],
+            'tree_fields': [[f.describe() for f in fields] for fields in self.tree_fields],
+        }
 
-                self._all_fields.append(field.name)
+class NodeFormatter(object):
+    # Basic node information
+    _node = None
 
-        return self._all_fields
+    _type_string = None
+    _base_type = None
+    _node_type = None
 
-    @property
-    def list_fields(self):
-        if self._list_fields == None:
-            self._list_fields = []
-
-            for f in self.fields:
-                # Honor overrides before all else
-                override_string = self.get_field_override(f, 'field_type')
-                if override_string != None:
-                    if override_string == 'list_field':
-                        self._list_fields.append(f)
-                    else:
-                        continue
+    # Field layout, classification and display methods shared by every node
+    # of this type
+    _metadata = None
+    _ignore_field_types = None
+
+    # The compiled NodeTypePlan, and the node cast to each of its levels
+    _plan = None
+    _level_nodes = None
+
+    # The whole struct, read from the inferior in one go, see raw_bytes
+    _raw_bytes = None
+    _raw_value = None
+
+    _default_display_methods = None
+    def __init__(self, node, typecast=None, pseudo_node=False, raw_bytes=None):
+        self._pseudo_node = pseudo_node
+        if typecast == None:
+            if self._pseudo_node:
+                pseudo_type = node.type.strip_typedefs()
 
-                v = self._node[f]
-                for field in self._list_types:
-                    if self.is_type(v, field):
-                        self._list_fields.append(f)
+                self._type_string = get_base_datatype_string(node)
+                self._base_type = get_base_datatype(node)
+                self._node_type = pseudo_type
+                # TODO: Why does this work?
+                #if self._node_type.code != gdb.TYPE_CODE_PTR:
+                #    raise Exception("Must use a pointer for pseudo node types")
+            else:
+                tag_info = get_node_tag_info(node)
+                self._type_string = tag_info.name
+                self._base_type = tag_info.struct_type
+                if self._base_type is None:
+                    self._base_type = lookup_type(self._type_string)
+                self._node_type = self._base_type.pointer()
+        else:
+            self._type_string = typecast
+            self._base_type = lookup_type(self.type_string)
+            self._node_type = self._base_type.pointer()
 
-        return self._list_fields
+        self._node = node.cast(self._node_type)
+
+        # Get methods for display
+        self._default_display_methods = DEFAULT_DISPLAY_METHODS
+        self._metadata = get_type_metadata(self._type_string, self._base_type, self._pseudo_node)
+        #print("NodeFormatter:", self.type)
+
+        if raw_bytes is not None:
+            self._raw_bytes = raw_bytes[:self._metadata.sizeof]
 
     @property
-    def node_fields(self):
-        if self._node_fields == None:
-            self._node_fields = []
-
-            for f in self.fields:
-                override_string = self.get_field_override(f, 'field_type')
-                if override_string != None:
-                    if override_string == 'node_field':
-                        self._node_fields.append(f)
-                    else:
-                        continue
+    def raw_bytes(self):
+        '''the bytes of the whole struct, or None if it cannot be read'''
+        if self._raw_bytes is None:
+            address = None
+            t = self._node.type.strip_typedefs()
+            if t.code == gdb.TYPE_CODE_PTR:
+                if t.target().strip_typedefs().code in [gdb.TYPE_CODE_STRUCT, gdb.TYPE_CODE_UNION]:
+                    address = int(self._node)
+            elif self._node.address is not None:
+                address = int(self._node.address)
+
+            self._raw_bytes = b''
+            if address:
+                try:
+                    self._raw_bytes = read_memory(address, self._metadata.sizeof)
+                except gdb.MemoryError:
+                    pass
+
+        if self._raw_bytes == b'':
+            return None
+        return self._raw_bytes
 
-                v = self._node[f]
-                for field in self._node_types:
-                    if self.is_type(v, field):
-                        self._node_fields.append(f)
+    @property
+    def raw_value(self):
+        '''the struct as a gdb.Value built from raw_bytes, reading its fields
+        does not go back to the inferior'''
+        if self._raw_value is None:
+            self._raw_value = self._node
+            if self.raw_bytes is not None:
+                try:
+                    self._raw_value = gdb.Value(self.raw_bytes, self._base_type)
+                except TypeError:
+                    # gdb too old to build values from a buffer
+                    pass
+        return self._raw_value
 
-                if is_node(v):
-                    if f not in self.list_fields:
-                        self._node_fields.append(f)
+    def is_child_node(self):
+        return self._metadata.is_child_node
+
+    def level_node(self, level):
+        '''the node cast to the struct of a level of the plan'''
+        if self._level_nodes is None:
+            self._level_nodes = [None] * len(self._plan.levels)
+            self._level_nodes[-1] = self._node
+        if self._level_nodes[level] is None:
+            base_type = self._plan.levels[level][1]
+            self._level_nodes[level] = self._node.cast(base_type.pointer())
+        return self._level_nodes[level]
+
+    def level_raw_value(self, level):
+        '''raw_value narrowed down to the struct of a level of the plan'''
+        value = self.raw_value
+        for field in self._plan.levels[level][2]:
+            value = value[field]
+        return value
 
-        return self._node_fields
+    def get_datatype_override(self, field):
+        return self._metadata.get_datatype_override(field)
+
+    def get_field_override(self, field, override_type):
+        return self._metadata.get_field_override(field, override_type)
 
     @property
-    def tree_fields(self):
-        if self._tree_fields == None:
-            self._tree_fields = []
-            for f in self.fields:
-                override_string = self.get_field_override(f, 'field_type')
-                if override_string != None:
-                    if override_string == 'tree_field':
-                        self._tree_fields.append(f)
-                    else:
-                        continue
+    def type_string(self):
+        return self._type_string
+
+    @property
+    def fields(self):
+        return self._metadata.fields
 
-        return self._tree_fields
+    @property
+    def list_fields(self):
+        return self._metadata.list_fields
 
     @property
-    def regular_fields(self):
-        if self._regular_fields == None:
-            self._regular_fields = []
+    def node_fields(self):
+        return self._metadata.node_fields
 
-            self._regular_fields = [field for field in self.fields if field not in self.list_fields + self.node_fields + self.tree_fields]
+    @property
+    def tree_fields(self):
+        return self._metadata.tree_fields
 
-        return self._regular_fields
+    @property
+    def regular_fields(self):
+        return self._metadata.regular_fields
 
     def is_type(self, value, type_name):
         t = gdb.lookup_type(type_name)
         return (get_base_datatype(value) == get_base_datatype(t))
 
     def field_datatype(self, field):
-        return gdb.types.get_basic_type(self._node[field].type)
+        return self._metadata.field_datatypes[field]
 
     def format(self, prefix=None):
+        return render_to_string(self.write, prefix)
+
+    def write(self, writer, prefix=None):
+        self._plan = self._metadata.plan
+
+        # If the global 'show_hidden' is set, every field and tag is shown
+        show_hidden = self._default_display_methods['show_hidden'] == True
+
         retval = ''
         if prefix != None:
             retval = prefix
         retval += self.type_string + ' '
         newline_padding_chars = len(retval)
-        formatted_fields = self.format_all_regular_fields(newline_padding_chars+1)
-
-        fieldno = 1
-        for field in formatted_fields:
-            retval += field
-            if fieldno < len(formatted_fields):
-                retval += '\n' + ' ' * newline_padding_chars
-            fieldno += 1
 
-        retval += self.format_complex_fields()
+        formatted_fields = [self.format_regular_fields(fields, newline_padding_chars + 1, show_hidden)
+                            for fields in self._plan.regular_fields]
+        retval += ('\n' + ' ' * newline_padding_chars).join(formatted_fields)
+        writer.write(retval)
 
-        retval += self.format_tree_nodes()
+        for field in self._plan.complex_fields:
+            self.write_complex_field(writer, field, show_hidden)
 
-        return retval
+        # Only fall back to the tree fields of the parent if the node has
+        # none to show itself
+        for fields in self._plan.tree_fields:
+            written = writer.written
+            for field in fields:
+                self.write_complex_field(writer, field, show_hidden)
+            if writer.written != written:
+                break
 
-    def format_regular_fields(self, newline_padding_chars):
+    def format_regular_fields(self, fields, newline_padding_chars, show_hidden=False):
         # TODO: get this value from config file
         max_regular_field_chars = 140
         retval = "["
 
-        fieldcount = 0
         retline = ""
-        for field in self.regular_fields:
-            fieldcount +=1
-            display_mode = self.get_display_mode(field)
-            if display_mode == NEVER_SHOW:
+        for field in fields:
+            if self.is_regular_field_hidden(field, show_hidden):
                 continue
 
-            # Some fields don't have a meaning if they aren't given a value
-            if display_mode == NOT_NULL:
-                field_datatype = self.field_datatype(field)
-                empty_value = gdb.Value(0).cast(field_datatype)
-                if self._node[field] == empty_value:
-                    continue
-
-            # Some fields are initialized to -1 if they are not used
-            if display_mode == HIDE_INVALID:
-                field_datatype = self.field_datatype(field)
-                empty_value = gdb.Value(-1).cast(field_datatype)
-                if self._node[field] == empty_value:
-                    continue
-
             value = self.format_regular_field(field)
 
-
-            # TODO: display method did not return a value- fallback to the
-            # default display method
-            #if value == None:
-            #    continue
-
-            if fieldcount > 1:
-                # TODO: track current indentation level
-                if len(retline) > max_regular_field_chars:
-                    retval += retline + '\n' + (' ' * newline_padding_chars)
-                    retline = ''
-                elif len(retline) > 0:
-                    retline += ' '
+            # TODO: track current indentation level
+            if len(retline) > max_regular_field_chars:
+                retval += retline + '\n' + (' ' * newline_padding_chars)
+                retline = ''
+            elif len(retline) > 0:
+                retline += ' '
 
             retline += "%(field)s=%(value)s" % {
-                'field': field,
+                'field': field.name,
                 'value': value
             }
 
@@ -1681,101 +3889,1937 @@ class NodeFormatter(object):
 
         return retval
 
-    def format_regular_field(self, field):
-        display_method = self.get_display_method(field)
-        return display_method(self._node, field)
+    def is_regular_field_hidden(self, field, show_hidden=False):
+        display_mode = ALWAYS_SHOW if show_hidden else field.visibility
+        if display_mode == NEVER_SHOW:
+            return True
+
+        # Some fields don't have a meaning if they aren't given a value
+        if display_mode == NOT_NULL:
+            if self.field_equals(field, 0):
+                return True
+
+        # Some fields are initialized to -1 if they are not used
+        if display_mode == HIDE_INVALID:
+            if self.field_equals(field, -1):
+                return True
+
+        return False
+
+    def write_json(self, out):
+        self._plan = self._metadata.plan
+        show_hidden = self._default_display_methods['show_hidden'] == True
+
+        address = None
+        if self._node.type.strip_typedefs().code == gdb.TYPE_CODE_PTR:
+            address = int(self._node)
+        elif self._node.address is not None:
+            address = int(self._node.address)
 
-    def format_complex_fields(self):
-        retval = ""
-        if self.is_child_node():
-            retval += self.parent_node.format_complex_fields()
+        record = {
+            'type': self.type_string,
+            'address': '0x%x' % address if address is not None else None,
+            'fields': {},
+        }
+        for fields in self._plan.regular_fields:
+            for field in fields:
+                if not self.is_regular_field_hidden(field, show_hidden):
+                    record['fields'][field.name] = json_value(self.format_regular_field(field))
+
+        # Unlike the text output, the tree fields of every level are written
+        children = []
+        for field in self._plan.complex_fields + sum(reversed(self._plan.tree_fields), []):
+            display_mode = ALWAYS_SHOW if show_hidden else field.visibility
+            if display_mode == NEVER_SHOW:
+                continue
+
+            value, write_children = self.json_complex_field(field, display_mode)
+            if value is not NotImplemented:
+                record['fields'][field.name] = value
+            if write_children is not None:
+                children.append(write_children)
+
+        out.begin_node(record)
+        for write_children in children:
+            write_children(out)
+        out.end_node()
+
+    def json_complex_field(self, field, display_mode):
+        '''the JSON output of a node or list field: (value, write_children).
+        value goes into the "fields" of the node unless it is NotImplemented,
+        write_children(out), if not None, writes the nodes below it'''
+        node = self.level_node(field.level)
+        json_methods = DISPLAY_JSON_METHODS.get(field.display_method.__name__)
+        if json_methods is None:
+            text = field.display_method(node, field.name, skip_tag=True,
+                                        print_null=(display_mode == ALWAYS_SHOW))
+            if text.strip() == '':
+                return NotImplemented, None
+            return text.strip(), None
+
+        value = json_methods[0](node, field.name)
+        if value is NotImplemented:
+            return NotImplemented, lambda out: json_methods[1](out, node, field.name)
+        if value is None and display_mode != ALWAYS_SHOW:
+            return NotImplemented, None
+        return value, None
+
+    def capture(self, snapshot, prefix=''):
+        '''add the node, and the nodes below it, to a SnapshotWriter. Fields
+        pgrender.py cannot format from the raw bytes are formatted here.'''
+        self._plan = self._metadata.plan
+        show_hidden = self._default_display_methods['show_hidden'] == True
+        address = int(self._node)
+
+        if self.raw_bytes is None:
+            capture_prepared_node(snapshot, address, self.type_string,
+                                  lambda writer: self.write(writer, prefix), self.write_json)
+            return
 
-        for field in self.fields:
-            if field in self.regular_fields:
+        # level:name -> None for hidden regular fields, the formatted value
+        # of other regular fields, or the output of complex fields
+        prepared = {}
+        for fields in self._plan.regular_fields:
+            for field in fields:
+                if field.decoder is not None and \
+                        field.decoder(field.layout.get_bytes(self.raw_bytes)) is not None:
+                    continue
+                key = '%d:%s' % (field.level, field.name)
+                if self.is_regular_field_hidden(field, show_hidden):
+                    prepared[key] = None
+                else:
+                    prepared[key] = str(self.format_regular_field(field))
+
+        followed = []
+        for field in self._plan.complex_fields + sum(self._plan.tree_fields, []):
+            display_mode = ALWAYS_SHOW if show_hidden else field.visibility
+            if display_mode == NEVER_SHOW:
                 continue
-            if field in self.tree_fields:
+            if field.snapshot_kind != 'prepared':
+                followed.append(field)
                 continue
-            retval += self.format_complex_field(field)
 
-        return retval
+            output = {'text': render_to_string(self.write_complex_field, field, show_hidden)}
+            value, write_children = self.json_complex_field(field, display_mode)
+            if value is not NotImplemented:
+                output['json_value'] = value
+            if write_children is not None:
+                def write_child(out):
+                    out.begin_node({})
+                    write_children(out)
+                    out.end_node()
+                output['json_child'] = list(capture_json(write_child)['children'].values())[0]
+            prepared['%d:%s' % (field.level, field.name)] = output
+
+        snapshot.add_type(self.type_string, self._plan, prefix)
+        snapshot.record(SNAPSHOT_NODE, address, self.type_string, self.raw_bytes, prepared)
+
+        for field in followed:
+            value = self.level_raw_value(field.level)[field.name]
+            if int(value) == 0:
+                continue
+            if field.snapshot_kind == 'node':
+                capture_node(snapshot, value)
+            elif is_a(value, 'OidList') or is_a(value, 'IntList'):
+                capture_values(snapshot, value)
+            else:
+                capture_list(snapshot, value)
+
+    def child_fields(self):
+        '''(FieldPlan, is a regular field) of every field of the node, in the
+        order of the JSON output, for the pretty-printers'''
+        self._plan = self._metadata.plan
+        fields = [(field, True) for field in sum(self._plan.regular_fields, [])]
+        complex_fields = self._plan.complex_fields + sum(reversed(self._plan.tree_fields), [])
+        fields += [(field, False) for field in complex_fields]
+        return fields
+
+    def child_value(self, field, is_regular):
+        '''a field as a pretty-printer child: None if it is hidden, the
+        formatted text of regular fields with a formatter of their own, and
+        the gdb.Value of the field otherwise. Node and list fields are left
+        as pointers, which are only read if the frontend expands them.'''
+        show_hidden = self._default_display_methods['show_hidden'] == True
+        if is_regular:
+            if self.is_regular_field_hidden(field, show_hidden):
+                return None
+            if field.display_method is not format_regular_field:
+                return str(self.format_regular_field(field))
+            return self.level_node(field.level)[field.name]
+
+        display_mode = ALWAYS_SHOW if show_hidden else field.visibility
+        if display_mode == NEVER_SHOW:
+            return None
+        value = self.level_node(field.level)[field.name]
+        if display_mode != ALWAYS_SHOW and value.type.strip_typedefs().code == gdb.TYPE_CODE_PTR \
+                and int(value) == 0:
+            return None
+        return value
+
+    def field_equals(self, field, value):
+        '''compare a field (a FieldPlan) with 0 or -1, from the raw bytes when
+        possible'''
+        layout = field.layout
+        if layout.byte_comparable and self.raw_bytes is not None:
+            fill = b'\x00'
+            if value == -1:
+                fill = b'\xff'
+            return layout.get_bytes(self.raw_bytes) == fill * layout.size
+
+        field_value = self.level_raw_value(field.level)[field.name]
+        return field_value == gdb.Value(value).cast(field_value.type)
+
+    def format_regular_field(self, field):
+        # Custom display methods get the node itself, as they always did
+        if field.display_method is not format_regular_field:
+            return field.display_method(self.level_node(field.level), field.name)
+
+        if field.decoder is not None and self.raw_bytes is not None:
+            value = field.decoder(field.layout.get_bytes(self.raw_bytes))
+            if value is not None:
+                return value
 
-    def format_complex_field(self, field):
-        display_mode = self.get_display_mode(field)
+        return format_regular_field(self.level_raw_value(field.level), field.name)
+
+    def write_complex_field(self, writer, field, show_hidden=False):
+        display_mode = ALWAYS_SHOW if show_hidden else field.visibility
         print_null = False
         if display_mode == NEVER_SHOW:
-            return ""
+            return
         elif display_mode == ALWAYS_SHOW:
             print_null = True
 
-        skip_tag = self.is_skip_tag(field)
-
-        display_method = self.get_display_method(field)
-        return display_method(self._node, field, skip_tag=skip_tag, print_null=print_null)
-
-    def format_all_regular_fields(self, offset):
-        formatted_fields = []
-        if self.parent_node != None:
-            formatted_fields += self.parent_node.format_all_regular_fields(offset)
-
-        formatted_fields.append(self.format_regular_fields(offset))
-        return formatted_fields
+        skip_tag = field.skip_tag and not show_hidden
 
+        node = self.level_node(field.level)
+        if field.write_method != None:
+            field.write_method(writer, node, field.name, skip_tag=skip_tag, print_null=print_null)
+        else:
+            writer.write(field.display_method(node, field.name, skip_tag=skip_tag, print_null=print_null))
 
     def ignore_type(self, field):
         if self._ignore_field_types is None:
             self._ignore_field_types = []
         self._ignore_field_types.append(field)
 
-        # reset list of all fields
-        self._list_fields = None
-        self._regular_fields = None
-        self._all_fields = None
-
-    def format_tree_nodes(self):
-        retval = ""
-        for field in self.tree_fields:
-            retval += self.format_complex_field(field)
-
-        if retval == "" and self.is_child_node():
-            retval += self.parent_node.format_tree_nodes()
-
-        return retval
+        # The shared metadata does not know about ignored types, so this
+        # formatter gets a private copy
+        self._metadata = NodeTypeMetadata(self._type_string, self._base_type,
+                                          self._pseudo_node, self._ignore_field_types)
 
 class LabelNodeFormatter(NodeFormatter):
     def __init__(self, node, typecast=None, pseudo_node=False, label=''):
         self._label = label
         super().__init__(node, typecast, pseudo_node)
-    def format(self):
-        return super().format(prefix=self._label)
+    def write(self, writer, prefix=None):
+        super().write(writer, prefix=self._label)
 
 class PlanStateFormatter(NodeFormatter):
-    def format(self):
-        return super().format(prefix='-> ')
+    def write(self, writer, prefix=None):
+        super().write(writer, prefix='-> ')
 
-class PgPrintCommand(gdb.Command):
-    "print PostgreSQL structures"
+class PgPrintProfiler(object):
+    '''
+    Count and time the work done by one pgprint: calls into the gdb module
+    (lookup_type, parse_and_eval, read_memory, Value methods, ...), calls of
+    the functions and methods of this file, and time spent per node type.
+
+    Subscripting a gdb.Value is not a call as far as sys.setprofile is
+    concerned, so field accesses are not counted directly; they show up as
+    time in the function doing them.
+    '''
+
+    def __init__(self):
+        self.filename = PgPrintProfiler.__init__.__code__.co_filename
+        # don't profile the profiler
+        self.ignored = set(f.__code__ for f in vars(PgPrintProfiler).values()
+                           if hasattr(f, '__code__'))
+        # function name -> [calls, cumulative seconds]
+        self.functions = {}
+        # gdb API name -> calls
+        self.gdb_calls = {}
+        # node type -> [nodes, self seconds, cumulative seconds]
+        self.node_types = {}
+        self.total_time = 0
+        self._frames = []
+        # code object -> number of its frames on self._frames, so recursive
+        # functions only count the time of their outermost call
+        self._active = {}
+        self._nodes = []
+        self._start = None
+
+    def start(self):
+        self._start = time.perf_counter()
+        sys.setprofile(self._profile)
+
+    def stop(self):
+        sys.setprofile(None)
+        self.total_time = time.perf_counter() - self._start
+
+    def _profile(self, frame, event, arg):
+        if event == 'call':
+            code = frame.f_code
+            if code.co_filename == self.filename and code not in self.ignored:
+                self._frames.append((frame, time.perf_counter()))
+                self._active[code] = self._active.get(code, 0) + 1
+        elif event == 'return':
+            if self._frames and self._frames[-1][0] is frame:
+                start = self._frames.pop()[1]
+                code = frame.f_code
+                self._active[code] -= 1
+                name = self.function_name(frame)
+                stats = self.functions.get(name)
+                if stats is None:
+                    stats = self.functions[name] = [0, 0]
+                stats[0] += 1
+                if self._active[code] == 0:
+                    stats[1] += time.perf_counter() - start
+        elif event == 'c_call':
+            name = self.gdb_function_name(arg)
+            if name is not None:
+                self.gdb_calls[name] = self.gdb_calls.get(name, 0) + 1
+
+    def function_name(self, frame):
+        code = frame.f_code
+        instance = frame.f_locals.get('self') if code.co_varnames[:1] == ('self',) else None
+        if instance is not None:
+            return '%s.%s' % (type(instance).__name__, code.co_name)
+        return code.co_name
+
+    def gdb_function_name(self, function):
+        if getattr(function, '__module__', None) == 'gdb':
+            return 'gdb.%s' % function.__name__
+        owner = getattr(function, '__self__', None)
+        if owner is not None and type(owner).__module__ == 'gdb':
+            return 'gdb.%s.%s' % (type(owner).__name__, function.__name__)
+        return None
+
+    def begin_node(self, name):
+        self._nodes.append([name, time.perf_counter(), 0])
+
+    def end_node(self):
+        name, start, children = self._nodes.pop()
+        elapsed = time.perf_counter() - start
+        stats = self.node_types.get(name)
+        if stats is None:
+            stats = self.node_types[name] = [0, 0, 0]
+        stats[0] += 1
+        stats[1] += elapsed - children
+        # don't count the time of a node type nested in itself twice
+        for outer in self._nodes:
+            if outer[0] == name:
+                break
+        else:
+            stats[2] += elapsed
+        if self._nodes:
+            self._nodes[-1][2] += elapsed
+
+    def report(self, limit=20):
+        lines = ['pgprint profile: %.3fs total (includes profiling overhead)' % self.total_time]
+
+        lines.append('')
+        lines.append('%-40s %10s %12s %12s' % ('node type', 'nodes', 'self (s)', 'cumul (s)'))
+        rows = sorted(self.node_types.items(), key=lambda i: -i[1][1])
+        for name, (count, own, cumulative) in rows[:limit]:
+            lines.append('%-40s %10d %12.4f %12.4f' % (name, count, own, cumulative))
+
+        lines.append('')
+        lines.append('%-40s %10s %12s %12s' % ('function', 'calls', 'cumul (s)', 'per call (ms)'))
+        rows = sorted(self.functions.items(), key=lambda i: -i[1][1])
+        for name, (count, cumulative) in rows[:limit]:
+            lines.append('%-40s %10d %12.4f %12.4f' % (name, count, cumulative, cumulative * 1000 / count))
+
+        lines.append('')
+        lines.append('%-40s %10s' % ('gdb API', 'calls'))
+        rows = sorted(self.gdb_calls.items(), key=lambda i: -i[1])
+        for name, count in rows[:limit]:
+            lines.append('%-40s %10d' % (name, count))
+
+        return '\n'.join(lines) + '\n'
+
+# pgsnapshot files start with SNAPSHOT_MAGIC, followed by one record per node
+# (a SNAPSHOT_RECORD header, the raw data and a JSON object), the schema as
+# JSON and finally SNAPSHOT_TRAILER: the offset of the schema and the magic
+# again. Numbers in the records are little endian, whatever the target is.
+SNAPSHOT_MAGIC = b'GDBPGSN1'
+SNAPSHOT_VERSION = 1
+# kind, address, type id, length of the data, length of the JSON
+SNAPSHOT_RECORD = struct.Struct('<cQIII')
+SNAPSHOT_TRAILER = struct.Struct('<Q8s')
+
+# Record kinds
+SNAPSHOT_NODE = b'N'        # raw bytes of the struct, prepared fields as JSON
+SNAPSHOT_LIST = b'L'        # List of nodes: the element pointers
+SNAPSHOT_VALUES = b'V'      # OidList or IntList: the values
+SNAPSHOT_PREPARED = b'P'    # text and JSON output, formatted in gdb
+SNAPSHOT_TRUNCATED = b'T'   # left out, JSON says why
+
+class SnapshotWriter(object):
+    '''Writes a pgsnapshot file: the raw bytes of every node reached, and
+    what pgrender.py needs to format them the same way pgprint does'''
+
+    def __init__(self, output):
+        self._output = output
+        # Number of bytes written so far
+        self.written = 0
+        self._type_ids = {}
+        # type name -> NodeTypePlan.describe() and prefix
+        self._types = {}
+        # Addresses of the nodes and lists written, and of the nodes left out
+        self.nodes = set()
+        self.lists = set()
+        self.truncated = set()
+        self._write(SNAPSHOT_MAGIC)
+
+    def _write(self, data):
+        self.written += len(data)
+        self._output.write(data)
+
+    def add_type(self, name, plan, prefix):
+        if name not in self._types:
+            description = plan.describe()
+            description['prefix'] = prefix
+            self._types[name] = description
+
+    def record(self, kind, address, type_name, data=b'', extra=None):
+        type_id = self._type_ids.get(type_name)
+        if type_id is None:
+            type_id = self._type_ids[type_name] = len(self._type_ids)
+        extra_data = b''
+        if extra is not None:
+            extra_data = json.dumps(extra).encode()
+
+        self._write(SNAPSHOT_RECORD.pack(kind, address, type_id, len(data), len(extra_data)))
+        self._write(data)
+        self._write(extra_data)
+
+    def close(self, expression, root, root_is_node):
+        type_names = [None] * len(self._type_ids)
+        for name, type_id in self._type_ids.items():
+            type_names[type_id] = name
+
+        schema = {
+            'version': SNAPSHOT_VERSION,
+            'expression': expression,
+            'root': root,
+            'root_is_node': root_is_node,
+            'byte_order': target_byte_order(),
+            'show_hidden': DEFAULT_DISPLAY_METHODS['show_hidden'] == True,
+            'type_names': type_names,
+            'types': self._types,
+        }
+        offset = self.written
+        self._write(json.dumps(schema).encode())
+        self._write(SNAPSHOT_TRAILER.pack(offset, SNAPSHOT_MAGIC))
+
+def render_prepared(write_method, *args):
+    '''render_to_string() for snapshots: prepared output is formatted as if
+    nothing had been printed before it'''
+    visited_nodes.clear()
+    visited_node_paths.clear()
+    return render_to_string(write_method, *args)
+
+def capture_json(write_method):
+    '''call write_method with a JsonNodeWriter, returns what it wrote as a
+    Python object'''
+    visited_nodes.clear()
+    visited_node_paths.clear()
+    output = io.StringIO()
+    out = JsonNodeWriter(output.write)
+    write_method(out)
+    out.close()
+    return json.loads(output.getvalue())
+
+def capture_prepared_node(snapshot, address, type_name, write_text, write_json):
+    snapshot.record(SNAPSHOT_PREPARED, address, type_name,
+                    extra={'text': render_prepared(write_text), 'json': capture_json(write_json)})
+
+def capture_node(snapshot, node):
+    '''add a node, and the nodes below it, to a SnapshotWriter, walking them
+    the way write_node() does'''
+    global recursion_depth
+
+    if str(node) == '0x0':
+        return
+    address = int(node)
+    if address in snapshot.nodes:
+        return
+
+    tag_info = get_node_tag_info(node)
+    reason = truncation_reason()
+    if reason is not None:
+        if address not in snapshot.truncated and address not in snapshot.lists:
+            snapshot.truncated.add(address)
+            snapshot.record(SNAPSHOT_TRUNCATED, address, tag_info.name, extra={'reason': reason})
+        return
+    snapshot.nodes.add(address)
+
+    recursion_depth += 1
+    try:
+        if tag_info.name == 'List':
+            capture_list(snapshot, node)
+        elif tag_info.name in ['OidList', 'IntList']:
+            capture_values(snapshot, node)
+        elif tag_info.write_method is write_plan_state_node:
+            NodeFormatter(node).capture(snapshot, '-> ')
+        elif tag_info.write_method is write_generic_node:
+            NodeFormatter(node).capture(snapshot)
+        else:
+            json_method = NODE_TAG_JSON_METHODS.get(tag_info.name)
+            if json_method is None:
+                json_method = lambda out, node: NodeFormatter(node).write_json(out)
+            capture_prepared_node(snapshot, address, tag_info.name,
+                                  lambda writer: tag_info.write_method(writer, node),
+                                  lambda out: json_method(out, node))
+    finally:
+        recursion_depth -= 1
+
+def capture_list(snapshot, lst):
+    '''add a List of nodes, and its elements, to a SnapshotWriter, walking
+    them the way write_node_list() does'''
+    address = int(lst)
+    if address in snapshot.lists:
+        return
+    snapshot.lists.add(address)
+
+    elements = list(iterate_node_list(lst))
+    snapshot.record(SNAPSHOT_LIST, address, 'List',
+                    struct.pack('<%dQ' % len(elements), *[int(e) for e in elements]))
+    for element in elements:
+        capture_node(snapshot, element)
+
+def capture_values(snapshot, lst):
+    '''add an OidList or IntList to a SnapshotWriter'''
+    address = int(lst)
+    if address in snapshot.lists:
+        return
+    snapshot.lists.add(address)
+
+    values = read_oid_list(lst)
+    snapshot.record(SNAPSHOT_VALUES, address, get_node_tag_info(lst).name,
+                    struct.pack('<%dq' % len(values), *values))
+
+def capture_root(snapshot, value):
+    '''add what pgprint would print for 'value' to a SnapshotWriter, returns
+    (address, is a node)'''
+    if is_node(value):
+        capture_node(snapshot, value)
+        return int(value), True
+
+    address = 0
+    if value.type.strip_typedefs().code == gdb.TYPE_CODE_PTR:
+        address = int(value)
+    elif value.address is not None:
+        address = int(value.address)
+    formatter = NodeFormatter(value, pseudo_node=True)
+    capture_prepared_node(snapshot, address, formatter.type_string, formatter.write, formatter.write_json)
+    return address, False
+
+# The smallest chunk size of an AllocSet freelist is 1 << ALLOC_MINBITS, each
+# freelist after that doubles it
+ALLOC_MINBITS = 3
+
+# Give up on a list of blocks after this many entries, it is probably
+# garbage looping on itself
+MAX_MEMORY_CONTEXT_LIST_LENGTH = 10000000
+
+# Every free chunk is a memory read of its own, stop counting the chunks of a
+# freelist after this many
+MAX_FREELIST_CHUNKS = 10000
+
+# NodeTags of memory contexts
+MEMORY_CONTEXT_TYPES = ['AllocSetContext', 'SlabContext', 'GenerationContext', 'BumpContext']
+
+class StructLayout(object):
+    '''The FieldLayouts of a struct, to pick fields out of its raw bytes
+    read with a single read_memory()'''
+
+    def __init__(self, type_name):
+        description = get_type_description(type_name, lookup_type(type_name))
+        self.sizeof = description['sizeof']
+        self.fields = {}
+        for field in description['fields']:
+            self.fields[field['name']] = FieldLayout(field)
+        self.pointer_size = lookup_type('void').pointer().sizeof
+        self._unpackers = {}
+
+    def has_field(self, name):
+        return name in self.fields and self.fields[name].offset is not None
+
+    def integer(self, raw_bytes, name, signed=False):
+        layout = self.fields[name]
+        unpack = self._unpackers.get(name)
+        if unpack is None:
+            unpack = make_integer_unpacker(layout.size, signed)
+            self._unpackers[name] = unpack
+        return unpack(layout.get_bytes(raw_bytes))[0]
+
+    def pointer(self, raw_bytes, name, index=0):
+        '''a pointer field, or element 'index' of an array of pointers'''
+        unpack = self._unpackers.get(None)
+        if unpack is None:
+            unpack = make_integer_unpacker(self.pointer_size, False)
+            self._unpackers[None] = unpack
+        offset = self.fields[name].offset + index * self.pointer_size
+        return unpack(raw_bytes[offset:offset + self.pointer_size])[0]
+
+    def double(self, raw_bytes, name):
+        return struct.unpack(target_byte_order() + 'd', self.fields[name].get_bytes(raw_bytes))[0]
+
+    def format(self, raw_bytes, name):
+        '''a field the way gdb would print it, such as the name of an enum
+        value, or None if FieldLayout does not know how'''
+        layout = self.fields[name]
+        if layout.decoder is None:
+            return None
+        return layout.decoder(layout.get_bytes(raw_bytes))
+
+class MemoryUsage(object):
+    '''Blocks, free chunks and bytes of one context or a subtree of them'''
 
     def __init__(self):
-        super(PgPrintCommand, self).__init__("pgprint", gdb.COMMAND_SUPPORT,
+        self.contexts = 0
+        self.blocks = 0
+        self.free_chunks = 0
+        self.total = 0
+        self.free = 0
+        # Set if a freelist was longer than MAX_FREELIST_CHUNKS, free and
+        # free_chunks are then too low
+        self.freelists_truncated = False
+
+    @property
+    def used(self):
+        return self.total - self.free
+
+    def add(self, other):
+        self.contexts += other.contexts
+        self.blocks += other.blocks
+        self.free_chunks += other.free_chunks
+        self.total += other.total
+        self.free += other.free
+        self.freelists_truncated = self.freelists_truncated or other.freelists_truncated
+
+    def __str__(self):
+        # The format of MemoryContextStats()
+        text = '%d total in %d blocks; %d free (%d chunks); %d used' % (
+            self.total, self.blocks, self.free, self.free_chunks, self.used)
+        if self.freelists_truncated:
+            text += ' (free chunks counted up to %d per freelist)' % MAX_FREELIST_CHUNKS
+        return text
+
+class MemoryContextInfo(object):
+    '''A memory context found by MemoryContextWalker'''
+
+    def __init__(self, address, parent):
+        self.address = address
+        self.parent = parent
+        self.depth = 0
+        if parent is not None:
+            self.depth = parent.depth + 1
+        self.type_name = None
+        self.name = '<unreadable>'
+        self.ident = None
+        self.firstchild = 0
+        self.nextchild = 0
+        self.children = []
+        self.own = MemoryUsage()
+        self.own.contexts = 1
+        # Rolled up from own and the subtrees of the children
+        self.subtree = MemoryUsage()
+
+    def label(self):
+        if self.ident is not None:
+            return '%s: %s' % (self.name, self.ident)
+        return self.name
+
+    def path(self):
+        names = []
+        context = self
+        while context is not None:
+            names.insert(0, context.name)
+            context = context.parent
+        return '/'.join(names)
+
+class MemoryContextWalker(object):
+    '''
+    Reads a tree of memory contexts through firstchild and nextchild, and
+    what each of them holds the way MemoryContextStats() counts it. Every
+    context, block and free chunk takes a single memory read, fields are
+    decoded from the raw bytes. AllocSet contexts are counted block by
+    block, other kinds only report mem_allocated where there is one.
+    '''
+
+    def __init__(self):
+        self.context_layout = StructLayout('MemoryContextData')
+        self.read_size = self.context_layout.sizeof
+        self.names = {}
+
+        self.aset_layout = None
+        try:
+            self.aset_layout = StructLayout('AllocSetContext')
+            self.block_layout = StructLayout('AllocBlockData')
+            self.freelists = self.aset_layout.fields['freelist'].size // self.aset_layout.pointer_size
+            self.read_size = max(self.read_size, self.aset_layout.sizeof)
+
+            # A free chunk points to the next one with the 'aset' field of
+            # its header, or the link after a MemoryChunk header since 16
+            try:
+                lookup_type('AllocFreeListLink')
+                self.chunk_header_size = lookup_type('MemoryChunk').sizeof
+                self.chunk_link_offset = self.chunk_header_size
+            except gdb.error:
+                chunk_layout = StructLayout('AllocChunkData')
+                self.chunk_header_size = chunk_layout.sizeof
+                link = 'aset' if chunk_layout.has_field('aset') else 'sharedHeader'
+                self.chunk_link_offset = chunk_layout.fields[link].offset
+        except (gdb.error, KeyError):
+            self.aset_layout = None
+
+    def read_name(self, address):
+        '''context names are mostly string constants, read each one once'''
+        if address == 0:
+            return None
+        name = self.names.get(address)
+        if name is None:
+            try:
+                data, truncated = read_c_string(address, DEFAULT_DISPLAY_METHODS['max_string_length'])
+                name = data.decode(errors='replace') + ('...' if truncated else '')
+            except gdb.MemoryError:
+                name = '<unreadable 0x%x>' % address
+            self.names[address] = name
+        return name
+
+    def read_context(self, address, parent):
+        context = MemoryContextInfo(address, parent)
+        try:
+            try:
+                raw = read_memory(address, self.read_size)
+            except gdb.MemoryError:
+                # Smaller kind of context at the end of a mapping
+                raw = read_memory(address, self.context_layout.sizeof)
+        except gdb.MemoryError:
+            return context
+
+        layout = self.context_layout
+        tag_info = get_node_tag_table().get(layout.integer(raw, 'type'))
+        context.type_name = tag_info.name if tag_info is not None else None
+        context.name = self.read_name(layout.pointer(raw, 'name')) or ''
+        if layout.has_field('ident'):
+            context.ident = self.read_name(layout.pointer(raw, 'ident'))
+        context.firstchild = layout.pointer(raw, 'firstchild')
+        context.nextchild = layout.pointer(raw, 'nextchild')
+
+        try:
+            if context.type_name == 'AllocSetContext' and self.aset_layout is not None \
+                    and len(raw) >= self.aset_layout.sizeof:
+                self.read_allocset_usage(raw, context.own)
+            elif layout.has_field('mem_allocated'):
+                context.own.total = layout.integer(raw, 'mem_allocated')
+        except gdb.MemoryError:
+            pass
+        return context
+
+    def read_allocset_usage(self, raw, usage):
+        '''count the blocks and free chunks of an AllocSet, as AllocSetStats()'''
+        block_layout = self.block_layout
+        block = self.aset_layout.pointer(raw, 'blocks')
+        while block != 0 and usage.blocks < MAX_MEMORY_CONTEXT_LIST_LENGTH:
+            data = read_memory(block, block_layout.sizeof)
+            endptr = block_layout.pointer(data, 'endptr')
+            usage.blocks += 1
+            usage.total += endptr - block
+            usage.free += endptr - block_layout.pointer(data, 'freeptr')
+            block = block_layout.pointer(data, 'next')
+
+        unpack_pointer = make_integer_unpacker(self.aset_layout.pointer_size, False)
+        for index in range(self.freelists):
+            chunk_size = 1 << (ALLOC_MINBITS + index)
+            chunk = self.aset_layout.pointer(raw, 'freelist', index)
+            length = 0
+            while chunk != 0:
+                if length == MAX_FREELIST_CHUNKS:
+                    usage.freelists_truncated = True
+                    break
+                usage.free_chunks += 1
+                usage.free += chunk_size + self.chunk_header_size
+                length += 1
+                chunk = unpack_pointer(read_memory(chunk + self.chunk_link_offset,
+                                                   self.aset_layout.pointer_size))[0]
+
+    def walk(self, address):
+        '''read the tree below the context at 'address', returns the
+        MemoryContextInfo of every context, parents before children'''
+        root = self.read_context(address, None)
+        contexts = [root]
+        seen = set([address])
+        stack = [root]
+        while stack:
+            parent = stack.pop()
+            child = parent.firstchild
+            while child != 0 and child not in seen:
+                seen.add(child)
+                context = self.read_context(child, parent)
+                parent.children.append(context)
+                contexts.append(context)
+                stack.append(context)
+                child = context.nextchild
+
+        # Children come after their parent, so going backwards every subtree
+        # is complete before it is added to its parent
+        for context in reversed(contexts):
+            context.subtree.add(context.own)
+            if context.parent is not None:
+                context.parent.subtree.add(context.subtree)
+        return contexts
+
+def write_memory_context_tree(write, root, max_depth=None, max_children=100):
+    '''one line per context, indented by depth. Past max_depth, and after
+    max_children siblings, the rest is summed up in one line the way
+    MemoryContextStats() does.'''
+    stack = [root]
+    while stack:
+        context = stack.pop()
+        if isinstance(context, tuple):
+            depth, count, usage = context
+            write('\t' * depth + '%d more child contexts containing %s\n' % (count, usage))
+            continue
+
+        line = '%s: %s' % (context.label(), context.own)
+        if context.children:
+            line += ' [%d contexts: %s]' % (context.subtree.contexts, context.subtree)
+        write('\t' * context.depth + line + '\n')
+
+        shown = context.children[:max_children]
+        if max_depth is not None and context.depth + 1 >= max_depth:
+            shown = []
+        hidden = context.children[len(shown):]
+        if hidden:
+            rest = MemoryUsage()
+            for child in hidden:
+                rest.add(child.subtree)
+            stack.append((context.depth + 1, len(hidden), rest))
+        stack.extend(reversed(shown))
+
+@contextlib.contextmanager
+def suspended_pretty_printers():
+    '''print values without the gdbpg pretty-printers'''
+    global pretty_printers_suspended
+
+    pretty_printers_suspended += 1
+    try:
+        yield
+    finally:
+        pretty_printers_suspended -= 1
+
+def is_node_struct_type(t):
+    '''does struct type 't' start with a NodeTag, directly or through the
+    node it inherits (Expr xpr, Plan plan, ...). Stricter than type_is_node(),
+    as plenty of structs that are not nodes have a 'type' field.'''
+    t = t.strip_typedefs()
+    if t.code != gdb.TYPE_CODE_STRUCT or t.tag is None:
+        return False
+
+    result = node_struct_types.get(t.tag)
+    if result is None:
+        fields = t.fields()
+        result = False
+        if len(fields) > 0:
+            first = fields[0].type.strip_typedefs()
+            if fields[0].name == 'type':
+                result = first.code == gdb.TYPE_CODE_ENUM and first.tag == 'NodeTag'
+            else:
+                result = is_node_struct_type(first)
+        node_struct_types[t.tag] = result
+    return result
+
+# List elements read from the inferior at a time by NodeListPrettyPrinter
+PRETTY_PRINTER_LIST_CHUNK = 64
+
+class NodePrettyPrinter(object):
+    '''Pretty-printer of a node pointer: the node type and address, with the
+    fields pgprint would show as children. Children are produced one at a
+    time, so frontends only read the fields they display, and node and list
+    fields are pretty-printed again only when expanded.'''
+
+    def __init__(self, node, tag_info):
+        self.node = node
+        self.tag_info = tag_info
+
+    def to_string(self):
+        return '%s 0x%x' % (self.tag_info.name, int(self.node))
+
+    def children(self):
+        with suspended_pretty_printers():
+            formatter = NodeFormatter(self.node)
+            fields = formatter.child_fields()
+
+        for field, is_regular in fields:
+            # gdb prints each child before asking for the next one, which
+            # has to go through the pretty-printers
+            with suspended_pretty_printers():
+                value = formatter.child_value(field, is_regular)
+            if value is not None:
+                yield field.name, value
+
+class NodeListPrettyPrinter(object):
+    '''Pretty-printer of a List, IntList or OidList pointer: an array of
+    node pointers or integers, read a chunk at a time as they are asked for'''
+
+    def __init__(self, lst, tag_info):
+        self.lst = lst
+        self.tag_info = tag_info
+
+    def to_string(self):
+        with suspended_pretty_printers():
+            length = int(cast(self.lst, 'List')['length'])
+        return '%s 0x%x [length=%d]' % (self.tag_info.name, int(self.lst), length)
+
+    def display_hint(self):
+        return 'array'
+
+    def read_elements(self, start, count):
+        if self.tag_info.name == 'List':
+            return list(iterate_node_list(self.lst, start, count))
+        return read_oid_list(self.lst, start, count)
+
+    def children(self):
+        with suspended_pretty_printers():
+            length = int(cast(self.lst, 'List')['length'])
+
+        for start in range(0, length, PRETTY_PRINTER_LIST_CHUNK):
+            with suspended_pretty_printers():
+                elements = self.read_elements(start, PRETTY_PRINTER_LIST_CHUNK)
+            for index, element in enumerate(elements):
+                yield '[%d]' % (start + index), element
+
+# Outside of gdb there are no pretty-printers to register
+PrettyPrinterBase = gdb.printing.PrettyPrinter if gdb is not None else object
+
+class NodePrettyPrinters(PrettyPrinterBase):
+    '''The 'gdbpg' pretty-printers of node pointers and node structs, for
+    'print' and for IDE frontends. 'nodes' and 'lists' can be turned off
+    separately with 'disable pretty-printer global gdbpg;lists'.'''
+
+    def __init__(self):
+        super(NodePrettyPrinters, self).__init__('gdbpg', [gdb.printing.SubPrettyPrinter('nodes'),
+                                                           gdb.printing.SubPrettyPrinter('lists')])
+
+    def __call__(self, value):
+        if pretty_printers_suspended or not self.enabled:
+            return None
+
+        t = value.type.strip_typedefs()
+        if t.code == gdb.TYPE_CODE_PTR:
+            if not is_node_struct_type(t.target()):
+                return None
+        elif is_node_struct_type(t) and value.address is not None:
+            # A node struct (print *plan) is shown like a pointer to it
+            value = value.address
+        else:
+            return None
+
+        with suspended_pretty_printers():
+            try:
+                if int(value) == 0:
+                    return None
+                tag_info = get_node_tag_table().get(int(cast(value, 'Node')['type']))
+            except (gdb.error, gdb.MemoryError):
+                return None
+
+        # Not a valid tag (garbage memory), or no struct to format it with
+        if tag_info is None or tag_info.struct_type is None:
+            return None
+
+        if tag_info.name in ListNodes:
+            if self.subprinters[1].enabled:
+                return NodeListPrettyPrinter(value, tag_info)
+        elif self.subprinters[0].enabled:
+            return NodePrettyPrinter(value, tag_info)
+        return None
+
+def positive_int(text):
+    '''argparse type of limits that must be at least 1'''
+    try:
+        value = int(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid int value: %r' % text)
+    if value <= 0:
+        raise argparse.ArgumentTypeError('must be a positive number: %r' % text)
+    return value
+
+def positive_float(text):
+    '''argparse type of limits that must be above 0'''
+    try:
+        value = float(text)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid float value: %r' % text)
+    if not value > 0:
+        raise argparse.ArgumentTypeError('must be a positive number: %r' % text)
+    return value
+
+class GdbArgumentParser(argparse.ArgumentParser):
+    '''argparse for gdb commands: report errors to gdb instead of exiting'''
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('add_help', False)
+        super(GdbArgumentParser, self).__init__(*args, **kwargs)
+
+    def error(self, message):
+        raise gdb.GdbError("%s\n%s" % (message, self.format_usage().strip()))
+
+    def exit(self, status=0, message=None):
+        raise gdb.GdbError(message or self.format_usage().strip())
+
+def make_pgprint_parser(prog='pgprint'):
+    '''the options shared by pgprint and pgexpand'''
+    parser = GdbArgumentParser(prog=prog)
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the output to FILE instead of the console')
+    parser.add_argument('--format', choices=['text', 'json', 'ndjson'], default='text',
+                        help='text for people, json (one document) or ndjson (one '
+                             'node per line) for programs')
+    parser.add_argument('--depth', type=positive_int, metavar='N',
+                        help='do not print nodes nested deeper than N (default %d)'
+                             % DEFAULT_DISPLAY_METHODS['max_recursion_depth'])
+    parser.add_argument('--max-list-items', type=positive_int, metavar='N',
+                        help='print only the first and last N/2 elements of a list')
+    parser.add_argument('--max-bytes', type=positive_int, metavar='N',
+                        help='stop printing nodes after N characters of output')
+    parser.add_argument('--max-seconds', type=positive_float, metavar='S',
+                        help='stop printing nodes after S seconds')
+    parser.add_argument('--profile', action='store_true',
+                        help='report where the time went: per node type, per '
+                             'function and per gdb API call')
+    parser.add_argument('--profile-limit', type=positive_int, default=20, metavar='N',
+                        help='number of rows in each --profile table (default 20)')
+    return parser
+
+# Outside of gdb (pgrender.py) there are no commands to define
+GdbCommand = gdb.Command if gdb is not None else object
+
+class PgPrintCommand(GdbCommand):
+    "print PostgreSQL structures"
+
+    def __init__(self, name="pgprint"):
+        super(PgPrintCommand, self).__init__(name, gdb.COMMAND_SUPPORT,
                                              gdb.COMPLETE_NONE, False)
 
+    def make_parser(self):
+        parser = make_pgprint_parser()
+        parser.add_argument('--from-file', metavar='FILE',
+                            help='also print the expressions listed in FILE, one per line')
+        parser.add_argument('expressions', nargs='*', metavar='expression')
+        return parser
+
+    def read_expressions(self, args):
+        '''the expressions on the command line followed by those of
+        --from-file, where empty lines and lines starting with # are skipped'''
+        expressions = list(args.expressions)
+        if args.from_file is not None:
+            try:
+                with open(args.from_file) as f:
+                    for line in f:
+                        line = line.strip()
+                        if line != '' and not line.startswith('#'):
+                            expressions.append(line)
+            except OSError as e:
+                raise gdb.GdbError("pgprint: %s" % e)
+
+        if not expressions:
+            raise gdb.GdbError("pgprint: no expression given")
+        return expressions
+
     def invoke(self, arg, from_tty):
-        global recursion_depth
+        global recursion_depth, print_limits
 
-        arg_list = gdb.string_to_argv(arg)
-        if len(arg_list) != 1:
-            print("usage: pgprint var")
+        args = self.make_parser().parse_args(gdb.string_to_argv(arg))
+        recursion_depth = 0
+        visited_nodes.clear()
+        visited_node_paths.clear()
+        del subtree_captures[:]
+
+        print_limits = PrintLimits(args.depth, args.max_list_items, args.max_bytes, args.max_seconds)
+        try:
+            with suspended_pretty_printers():
+                self.profile_expression(args)
+        finally:
+            print_limits = PrintLimits()
+        save_schema_cache()
+
+    def profile_expression(self, args):
+        global active_profiler
+
+        if not args.profile:
+            self.print_expression(args)
             return
+
+        active_profiler = PgPrintProfiler()
+        active_profiler.start()
+        try:
+            self.print_expression(args)
+        finally:
+            active_profiler.stop()
+            profiler, active_profiler = active_profiler, None
+        gdb.write(profiler.report(args.profile_limit))
+
+    def print_expression(self, args):
+        # Every expression is evaluated before anything is printed. They
+        # share visited_nodes, so what they have in common is printed once.
+        values = [(e, gdb.parse_and_eval(e)) for e in self.read_expressions(args)]
+
+        def write_value_text(writer, l):
+            if not is_node(l):
+                print("not a node type")
+                print("running experimental dump...")
+                formatter = NodeFormatter(l, pseudo_node=True)
+                formatter.write(writer)
+            else:
+                write_node(writer, l)
+
+        def write_value_json(writer, l):
+            if not is_node(l):
+                NodeFormatter(l, pseudo_node=True).write_json(writer)
+            else:
+                write_node_json(writer, l)
+
+        def write_text(writer):
+            if len(values) == 1:
+                write_value_text(writer, values[0][1])
+                return
+
+            for index, (expression, l) in enumerate(values):
+                if index > 0:
+                    writer.write('\n')
+                writer.begin_label('[%s] ' % expression)
+                write_value_text(writer, l)
+                writer.end_label()
+
+        def write_json(writer):
+            if len(values) == 1:
+                write_value_json(writer, values[0][1])
+                return
+
+            writer.begin_node({'type': 'Expressions', 'address': None, 'fields': {}})
+            for expression, l in values:
+                writer.begin_child(expression)
+                write_value_json(writer, l)
+                writer.end_child()
+            writer.end_node()
+
+        self.print_output(args, write_text, write_json)
+
+    def print_output(self, args, write_text, write_json):
+        '''write to the console or --output, in the --format asked for'''
+        output = None
+        write = None
+        if args.output != None:
+            output = open(args.output, 'w')
+            write = output.write
+
+        try:
+            if args.format == 'text':
+                writer = OutputWriter(write)
+                print_limits.start(writer)
+                write_text(writer)
+                writer.write('\n')
+            else:
+                writer = JsonNodeWriter(write, ndjson=(args.format == 'ndjson'))
+                print_limits.start(writer)
+                write_json(writer)
+            writer.close()
+        finally:
+            if output != None:
+                output.close()
+
+class PgSnapshotCommand(GdbCommand):
+    '''save the nodes reachable from an expression to a file, which
+    pgrender.py can print without gdb'''
+
+    def __init__(self):
+        super(PgSnapshotCommand, self).__init__("pgsnapshot", gdb.COMMAND_SUPPORT,
+                                                gdb.COMPLETE_NONE, False)
+
+    def make_parser(self):
+        parser = GdbArgumentParser(prog='pgsnapshot')
+        parser.add_argument('--depth', type=positive_int, metavar='N',
+                            help='do not save nodes nested deeper than N (default %d)'
+                                 % DEFAULT_DISPLAY_METHODS['max_recursion_depth'])
+        parser.add_argument('--max-seconds', type=positive_float, metavar='S',
+                            help='stop saving nodes after S seconds')
+        parser.add_argument('expression')
+        parser.add_argument('file')
+        return parser
+
+    def invoke(self, arg, from_tty):
+        global recursion_depth, print_limits
+
+        args = self.make_parser().parse_args(gdb.string_to_argv(arg))
+        l = gdb.parse_and_eval(args.expression)
         recursion_depth = 0
+        visited_nodes.clear()
+        visited_node_paths.clear()
+        del subtree_captures[:]
+
+        print_limits = PrintLimits(args.depth, max_seconds=args.max_seconds)
+        try:
+            with open(args.file, 'wb') as output, suspended_pretty_printers():
+                snapshot = SnapshotWriter(output)
+                print_limits.start(snapshot)
+                root, root_is_node = capture_root(snapshot, l)
+                snapshot.close(args.expression, root, root_is_node)
+        finally:
+            print_limits = PrintLimits()
+            visited_nodes.clear()
+            visited_node_paths.clear()
+
+        gdb.write('%d nodes, %d bytes written to %s\n' % (len(snapshot.nodes), snapshot.written, args.file))
+        save_schema_cache()
+
+class PgExpandCommand(PgPrintCommand):
+    '''print a subtree left out of the output of pgprint, given its handle
+    (such as $n12). Takes the same options as pgprint.'''
+
+    def __init__(self):
+        super(PgExpandCommand, self).__init__("pgexpand")
+
+    def make_parser(self):
+        parser = make_pgprint_parser('pgexpand')
+        parser.add_argument('handle')
+        return parser
+
+    def print_expression(self, args):
+        match = re.match(r'^\$?n([0-9]+)$', args.handle)
+        if match is None:
+            raise gdb.GdbError("pgexpand: %s is not a handle such as $n12" % args.handle)
+        subtree = elided_subtrees.get(int(match.group(1)))
+        if subtree is None:
+            raise gdb.GdbError("pgexpand: unknown handle %s, handles are forgotten when "
+                               "the inferior runs, and after %d newer ones"
+                               % (args.handle, MAX_ELIDED_SUBTREES))
+
+        value = subtree.value()
+        if subtree.start is None:
+            self.print_output(args, lambda writer: write_node(writer, value),
+                              lambda writer: write_node_json(writer, value))
+            return
+
+        def write_json(writer):
+            writer.begin_node({'type': 'List', 'address': '0x%x' % subtree.address,
+                               'fields': {'length': int(value['length']),
+                                          'start': subtree.start, 'end': subtree.end}})
+            writer.begin_list('items')
+            write_node_list_json(writer, value, subtree.start, subtree.end)
+            writer.end_list()
+            writer.end_node()
+
+        self.print_output(args, lambda writer: write_node_list(writer, value, subtree.start, subtree.end),
+                          write_json)
+
+def frame_level(frame):
+    '''the number of a frame, as in 'bt' (Frame.level() is gdb 11+)'''
+    level = 0
+    frame = frame.newer()
+    while frame is not None:
+        level += 1
+        frame = frame.newer()
+    return level
+
+def frame_node_variables(frame):
+    '''(name, value) of the arguments and locals of a frame that point to a
+    node, innermost block first. NULL and optimized out ones are skipped.'''
+    try:
+        block = frame.block()
+    except RuntimeError:
+        # No debug info for this frame
+        return []
+
+    variables = []
+    seen = set()
+    while block is not None:
+        for symbol in block:
+            if not (symbol.is_argument or symbol.is_variable) or symbol.name in seen:
+                continue
+            # Shadowed by a variable of an inner block
+            seen.add(symbol.name)
+
+            t = symbol.type.strip_typedefs()
+            if t.code != gdb.TYPE_CODE_PTR or not is_node_struct_type(t.target()):
+                continue
+            try:
+                value = frame.read_var(symbol, block)
+                if value.is_optimized_out or int(value) == 0:
+                    continue
+            except (gdb.error, gdb.MemoryError, ValueError):
+                continue
+            variables.append((symbol.name, value))
+
+        if block.function is not None:
+            break
+        block = block.superblock
+    return variables
+
+class PgBacktraceCommand(PgPrintCommand):
+    '''print the nodes pointed to by the arguments and locals of every frame,
+    from the selected one outwards. Nodes reachable from several frames are
+    printed once, the other frames refer to them. Takes the same options as
+    pgprint.'''
+
+    def __init__(self):
+        super(PgBacktraceCommand, self).__init__("pgbt")
+
+    def make_parser(self):
+        parser = make_pgprint_parser('pgbt')
+        parser.add_argument('--frames', type=positive_int, metavar='N',
+                            help='only look at the N frames from the selected one outwards')
+        return parser
+
+    def collect_frames(self, args):
+        '''(level, function, node variables) of the frames to print'''
+        frames = []
+        frame = gdb.selected_frame()
+        level = frame_level(frame)
+        while frame is not None:
+            if args.frames is not None and len(frames) >= args.frames:
+                break
+            frames.append((level, frame.name() or '??', frame_node_variables(frame)))
+            frame = frame.older()
+            level += 1
+        return frames
+
+    def print_expression(self, args):
+        frames = self.collect_frames(args)
+
+        def write_text(writer):
+            # address -> frame and variable it was printed for
+            roots = {}
+            first_frame = True
+            for level, function, variables in frames:
+                if not variables:
+                    continue
+                if not first_frame:
+                    writer.write('\n')
+                first_frame = False
+
+                writer.write('#%-3d %s' % (level, function))
+                writer.indent()
+                for name, value in variables:
+                    writer.write('\n')
+                    writer.begin_label('[%s] ' % name)
+                    address = int(value)
+                    if address in roots and address in visited_nodes:
+                        writer.write(format_node_reference(address, visited_nodes[address], roots[address]))
+                    else:
+                        roots.setdefault(address, '#%d %s' % (level, name))
+                        write_node(writer, value)
+                    writer.end_label()
+                writer.dedent()
+
+        def write_json(writer):
+            writer.begin_node({'type': 'Backtrace', 'address': None, 'fields': {}})
+            writer.begin_list('frames')
+            for level, function, variables in frames:
+                if not variables:
+                    continue
+                writer.begin_node({'type': 'Frame', 'address': None,
+                                   'fields': {'level': level, 'function': function}})
+                for name, value in variables:
+                    writer.begin_child(name)
+                    write_node_json(writer, value)
+                    writer.end_child()
+                writer.end_node()
+            writer.end_list()
+            writer.end_node()
+
+        self.print_output(args, write_text, write_json)
+
+class PgMemoryContextCommand(GdbCommand):
+    '''print the tree of memory contexts below TopMemoryContext (or the
+    given context) with what each of them, and each subtree, holds, followed
+    by the heaviest subtrees'''
+
+    def __init__(self):
+        super(PgMemoryContextCommand, self).__init__("pgmemctx", gdb.COMMAND_SUPPORT,
+                                                     gdb.COMPLETE_NONE, False)
+
+    def make_parser(self):
+        parser = GdbArgumentParser(prog='pgmemctx')
+        parser.add_argument('-o', '--output', metavar='FILE',
+                            help='write the output to FILE instead of the console')
+        parser.add_argument('--depth', type=positive_int, metavar='N',
+                            help='only list contexts up to N levels deep, the totals '
+                                 'still count everything')
+        parser.add_argument('--max-children', type=positive_int, default=100, metavar='N',
+                            help='list only the first N children of a context (default 100)')
+        parser.add_argument('--top', type=positive_int, default=10, metavar='N',
+                            help='number of heaviest subtrees to report (default 10)')
+        parser.add_argument('root', nargs='?', default='TopMemoryContext')
+        return parser
+
+    def invoke(self, arg, from_tty):
+        args = self.make_parser().parse_args(gdb.string_to_argv(arg))
+        with suspended_pretty_printers():
+            root = gdb.parse_and_eval(args.root)
+            if root.type.strip_typedefs().code != gdb.TYPE_CODE_PTR:
+                root = root.address
+            if int(root) == 0:
+                raise gdb.GdbError("pgmemctx: %s is NULL" % args.root)
+
+            walker = MemoryContextWalker()
+            type_name = walker.read_context(int(root), None).type_name
+            if type_name not in MEMORY_CONTEXT_TYPES:
+                raise gdb.GdbError("pgmemctx: %s is not a memory context (%s)"
+                                   % (args.root, type_name or 'no valid NodeTag'))
+
+            start = time.time()
+            contexts = walker.walk(int(root))
+            elapsed = time.time() - start
+
+        output = None
+        write = gdb.write
+        if args.output is not None:
+            output = open(args.output, 'w')
+            write = output.write
+        try:
+            self.write_report(write, contexts, args)
+            write('%d contexts read in %.2f s\n' % (len(contexts), elapsed))
+        finally:
+            if output is not None:
+                output.close()
+        save_schema_cache()
+
+    def write_report(self, write, contexts, args):
+        write_memory_context_tree(write, contexts[0], args.depth, args.max_children)
+        write('Grand total: %s\n' % contexts[0].subtree)
+
+        # The root is the grand total already
+        heaviest = sorted(contexts[1:], key=lambda c: c.subtree.total, reverse=True)[:args.top]
+        if heaviest:
+            write('\nHeaviest subtrees:\n')
+            write('%14s %14s %9s  %s\n' % ('total', 'used', 'contexts', 'path'))
+            for context in heaviest:
+                write('%14d %14d %9d  %s\n' % (context.subtree.total, context.subtree.used,
+                                               context.subtree.contexts, context.path()))
+
+def read_tuple_pointers(base, stride, offset, indexes):
+    '''the pointers 'offset' bytes into the elements 'indexes' (ascending) of
+    an array of 'stride' byte elements. Neighbouring elements are read
+    together, up to TUPLE_POINTER_READ_SIZE bytes at a time, so a sample
+    spread over a large array reads only around the elements it picks.'''
+    pointer_size = lookup_type('void').pointer().sizeof
+    unpack = make_integer_unpacker(pointer_size, False)
+    pointers = []
+    position = 0
+    while position < len(indexes):
+        first = indexes[position]
+        end = position + 1
+        while end < len(indexes) and (indexes[end] - first + 1) * stride <= TUPLE_POINTER_READ_SIZE:
+            end += 1
+        data = read_memory(base + first * stride, (indexes[end - 1] - first + 1) * stride)
+        for index in indexes[position:end]:
+            start = (index - first) * stride + offset
+            pointers.append(unpack(data[start:start + pointer_size])[0])
+        position = end
+    return pointers
+
+def tuple_kind(t):
+    ''''heap' or 'minimal' for HeapTuple and MinimalTuple, None otherwise'''
+    t = t.strip_typedefs()
+    if t.code != gdb.TYPE_CODE_PTR:
+        return None
+    return {'HeapTupleData': 'heap', 'MinimalTupleData': 'minimal'}.get(t.target().strip_typedefs().tag)
+
+def write_tuple_table(write, names, rows, max_width):
+    '''rows of formatted values as an aligned table, the way psql does'''
+    def cut(text):
+        if len(text) > max_width:
+            return text[:max_width - 3] + '...'
+        return text
+
+    rows = [[cut(value) for value in row] for row in rows]
+    widths = [len(name) for name in names]
+    for row in rows:
+        widths = [max(width, len(value)) for width, value in zip(widths, row)]
+
+    write(' ' + ' | '.join(name.ljust(width) for name, width in zip(names, widths)).rstrip() + '\n')
+    write('-' + '-+-'.join('-' * width for width in widths) + '-\n')
+    for row in rows:
+        write(' ' + ' | '.join(value.ljust(width) for value, width in zip(row, widths)).rstrip() + '\n')
 
-        l = gdb.parse_and_eval(arg_list[0])
+class PgTuplesCommand(GdbCommand):
+    '''print the tuples buffered by a Tuplestorestate or a Tuplesortstate, or
+    those of an array of HeapTuples or MinimalTuples, as a table or as CSV'''
 
-        if not is_node(l):
-            print("not a node type")
-            print("running experimental dump...")
-            formatter = NodeFormatter(l, pseudo_node=True)
-            print(formatter.format())
+    def __init__(self):
+        super(PgTuplesCommand, self).__init__("pgtuples", gdb.COMMAND_SUPPORT,
+                                              gdb.COMPLETE_NONE, False)
+
+    def make_parser(self):
+        parser = GdbArgumentParser(prog='pgtuples')
+        parser.add_argument('-o', '--output', metavar='FILE',
+                            help='write the output to FILE instead of the console')
+        parser.add_argument('--format', choices=['table', 'csv'], default='table')
+        parser.add_argument('--desc', metavar='EXPRESSION',
+                            help='TupleDesc of the tuples, needed unless a Tuplesortstate '
+                                 'has one')
+        parser.add_argument('--count', type=positive_int, metavar='N',
+                            help='number of tuples in the array the expression points to')
+        parser.add_argument('--limit', type=positive_int, default=100, metavar='N',
+                            help='print at most N tuples (default 100)')
+        parser.add_argument('--sample', type=positive_int, metavar='N',
+                            help='pick N tuples spread evenly over all of them, instead '
+                                 'of the first ones')
+        parser.add_argument('--max-width', type=positive_int, default=60, metavar='N',
+                            help='cut table cells at N characters (default 60)')
+        parser.add_argument('expression')
+        return parser
+
+    def find_tuples(self, value, args):
+        '''(kind, number of tuples, TupleDesc or None, addresses) of the
+        tuples of value, where kind is 'heap' or 'minimal' and addresses(indexes)
+        returns the address of the tuples at those indexes'''
+        t = value.type.strip_typedefs()
+        pointer_size = lookup_type('void').pointer().sizeof
+
+        if t.code == gdb.TYPE_CODE_ARRAY:
+            low, high = t.range()
+            base = int(value.address)
+            kind = tuple_kind(t.target())
+            count = high - low + 1
+        elif t.code == gdb.TYPE_CODE_PTR:
+            tag = t.target().strip_typedefs().tag
+            if tag == 'Tuplestorestate':
+                base = int(value['memtuples'])
+                count = int(value['memtupcount'])
+                return 'minimal', count, None, lambda indexes: read_tuple_pointers(
+                    base, pointer_size, 0, indexes)
+
+            if tag == 'Tuplesortstate':
+                desc = None
+                try:
+                    desc = value['tupDesc']
+                except gdb.error:
+                    # PostgreSQL 15 moved it to the argument of the sort
+                    desc = value['base']['arg'].cast(lookup_type('TupleDesc'))
+                sort_tuple = StructLayout('SortTuple')
+                base = int(value['memtuples'])
+                count = int(value['memtupcount'])
+                return 'minimal', count, desc, lambda indexes: read_tuple_pointers(
+                    base, sort_tuple.sizeof, sort_tuple.fields['tuple'].offset, indexes)
+
+            kind = tuple_kind(t)
+            if kind is not None:
+                return kind, 1, None, lambda indexes: [int(value)]
+
+            base = int(value)
+            kind = tuple_kind(t.target())
+            count = args.count
+            if kind is not None and count is None:
+                raise gdb.GdbError("pgtuples: give the number of tuples with --count")
         else:
-            print(format_node(l))
+            kind = None
+
+        if kind is None:
+            raise gdb.GdbError("pgtuples: %s is not a Tuplestorestate, a Tuplesortstate or an "
+                               "array of HeapTuple or MinimalTuple" % args.expression)
+        return kind, count, None, lambda indexes: read_tuple_pointers(base, pointer_size, 0, indexes)
+
+    def invoke(self, arg, from_tty):
+        args = self.make_parser().parse_args(gdb.string_to_argv(arg))
+        with suspended_pretty_printers():
+            kind, count, desc, addresses = self.find_tuples(gdb.parse_and_eval(args.expression), args)
+            if args.desc is not None:
+                desc = gdb.parse_and_eval(args.desc)
+            if desc is None or int(desc) == 0:
+                raise gdb.GdbError("pgtuples: give the TupleDesc of the tuples with --desc")
+
+            indexes = list(range(count))
+            if args.sample is not None and args.sample < count:
+                indexes = sorted(set(i * count // args.sample for i in range(args.sample)))
+            indexes = indexes[:args.limit]
+
+            columns = tuple_desc_columns(desc)
+            reader = TupleReader(columns)
+            read = reader.read_heap_tuple if kind == 'heap' else reader.read_minimal_tuple
+            rows = []
+            if indexes:
+                for index, address in zip(indexes, addresses(indexes)):
+                    try:
+                        values = read(address)
+                    except gdb.MemoryError:
+                        values = ['<cannot access memory at 0x%x>' % address] + [''] * (len(columns) - 1)
+                    rows.append((index, values))
+
+        output = None
+        write = gdb.write
+        if args.output is not None:
+            output = open(args.output, 'w', newline='' if args.format == 'csv' else None)
+            write = output.write
+        try:
+            self.write_rows(write, args, columns, rows)
+            if args.format == 'table':
+                write('(%d of %d tuples)\n' % (len(rows), count))
+        finally:
+            if output is not None:
+                output.close()
+        save_schema_cache()
+
+    def write_rows(self, write, args, columns, rows):
+        shown = [i for i, column in enumerate(columns) if not column.dropped]
+        names = ['#'] + [columns[i].name for i in shown]
+
+        if args.format == 'table':
+            table = [[str(index)] + ['NULL' if values[i] is None else values[i] for i in shown]
+                     for index, values in rows]
+            write_tuple_table(write, names, table, args.max_width)
+            return
+
+        # Text values lose the quotes the decoders put around them, NULLs
+        # are empty fields
+        def csv_value(column, value):
+            if value is None:
+                return ''
+            if column.datum_type is not None and len(value) >= 2 and value.startswith('"') and \
+                    column.datum_type['decoder'] in (decode_text_datum, decode_name_datum):
+                return value[1:].rsplit('"', 1)[0]
+            return value
+
+        out = csv.writer(CsvWriteAdapter(write))
+        out.writerow(names)
+        for index, values in rows:
+            out.writerow([index] + [csv_value(columns[i], values[i]) for i in shown])
+
+class CsvWriteAdapter(object):
+    '''a file-like object for csv.writer, writing with a function'''
 
-PgPrintCommand()
+    def __init__(self, write):
+        self.write = write
+
+class PgExprCommand(GdbCommand):
+    '''print expression trees as compact infix text, one line per
+    expression, or per element of a List such as quals or a targetlist'''
+
+    def __init__(self):
+        super(PgExprCommand, self).__init__("pgexpr", gdb.COMMAND_SUPPORT,
+                                            gdb.COMPLETE_NONE, False)
+
+    def make_parser(self):
+        parser = GdbArgumentParser(prog='pgexpr')
+        parser.add_argument('-o', '--output', metavar='FILE',
+                            help='write the output to FILE instead of the console')
+        parser.add_argument('expressions', nargs='+', metavar='expression')
+        return parser
+
+    def invoke(self, arg, from_tty):
+        args = self.make_parser().parse_args(gdb.string_to_argv(arg))
+
+        output = None
+        write = gdb.write
+        if args.output is not None:
+            output = open(args.output, 'w')
+            write = output.write
+        try:
+            with suspended_pretty_printers():
+                renderer = ExprRenderer()
+                for expression in args.expressions:
+                    self.write_expression(write, renderer, expression, len(args.expressions) > 1)
+        finally:
+            if output is not None:
+                output.close()
+        save_schema_cache()
+
+    def write_expression(self, write, renderer, expression, labelled):
+        value = gdb.parse_and_eval(expression)
+        if not is_node(value):
+            raise gdb.GdbError("pgexpr: %s is not a node" % expression)
+        prefix = '[%s] ' % expression if labelled else ''
+
+        if int(value) == 0:
+            write('%sNULL\n' % prefix)
+        elif get_node_tag_info(value).name == 'List':
+            for index, element in enumerate(expr_list_elements(int(value))):
+                write('%s[%d] %s\n' % (prefix, index, renderer.render(element)))
+        else:
+            write('%s%s\n' % (prefix, renderer.render(int(value))))
+
+# Children of plan nodes besides lefttree and righttree, as List fields and as
+# single node fields. Fields the server does not have are skipped.
+PLAN_CHILD_LISTS = {
+    'Append': ['appendplans'],
+    'MergeAppend': ['mergeplans'],
+    'BitmapAnd': ['bitmapplans'],
+    'BitmapOr': ['bitmapplans'],
+    'ModifyTable': ['plans'],
+    'Sequence': ['subplans'],
+}
+PLAN_CHILD_NODES = {
+    'SubqueryScan': ['subplan'],
+}
+
+# The same for plan states, which keep them in arrays: (array field, length
+# field)
+PLANSTATE_CHILD_ARRAYS = {
+    'AppendState': [('appendplans', 'as_nplans')],
+    'MergeAppendState': [('mergeplans', 'ms_nplans')],
+    'BitmapAndState': [('bitmapplans', 'nplans')],
+    'BitmapOrState': [('bitmapplans', 'nplans')],
+    'ModifyTableState': [('mt_plans', 'mt_nplans')],
+    'SequenceState': [('subplans', 'numSubplans')],
+}
+PLANSTATE_CHILD_NODES = {
+    'SubqueryScanState': ['subplan'],
+}
+
+# Fields shown after the costs, by the plan type that has them (a node has
+# the fields of the types it starts with, a HashJoin those of Join)
+EXPLAIN_DETAIL_FIELDS = {
+    'Plan': ['plan_node_id'],
+    'Scan': ['scanrelid'],
+    'Join': ['jointype'],
+    'Agg': ['aggstrategy'],
+    'Motion': ['motionType'],
+}
+
+# Plan types each plan node type starts with, SeqScan -> [SeqScan, Scan, Plan]
+plan_type_chains = {}
+
+def plan_type_chain(type_name):
+    chain = plan_type_chains.get(type_name)
+    if chain is None:
+        chain = [type_name]
+        while chain[-1] != 'Plan':
+            description = get_type_description(chain[-1], lookup_type(chain[-1]))
+            first_field = description['fields'][0]
+            if first_field['type'] in chain or first_field['name'] == 'type':
+                break
+            chain.append(first_field['type'])
+        plan_type_chains[type_name] = chain
+    return chain
+
+class PlanExplainer(object):
+    '''Prints a Plan or PlanState tree as EXPLAIN does, one line per node,
+    reading only the fields it shows: costs, rows and width, a few details,
+    the slice of Motions and the counts of the node's Instrumentation'''
+
+    def __init__(self, write, subplans=None):
+        self.write = write
+        # Plans of the PlannedStmt, for the plan_id of initPlan SubPlans
+        self.subplans = subplans or []
+        self.visited = set()
+
+    def explain(self, address, depth=0, label=None):
+        '''explain a Plan or a PlanState and the nodes below it'''
+        # A node at a time, so deep plans do not run out of Python stack
+        stack = [(address, depth, label)]
+        while stack:
+            address, depth, label = stack.pop()
+            children = self.explain_node(address, depth, label)
+            stack.extend(reversed(children))
+
+    def write_line(self, depth, text):
+        if depth == 0:
+            self.write('%s\n' % text)
+        else:
+            self.write('%s->  %s\n' % ('      ' * (depth - 1) + '  ', text))
+
+    def write_label(self, depth, label):
+        self.write('%s%s\n' % ('      ' * (depth - 1) + '  ', label))
+
+    def explain_node(self, address, depth, label):
+        '''write the line of one node, returns its children as (address,
+        depth, label)'''
+        if label is not None:
+            self.write_label(depth, label)
+            depth += 1
+            # an initPlan whose plan we do not have
+            if address is None:
+                return []
+        if address == 0:
+            self.write_line(depth, 'NULL')
+            return []
+        if address in self.visited:
+            self.write_line(depth, '@0x%x (see above)' % address)
+            return []
+        self.visited.add(address)
+
+        try:
+            node = RawNode(address)
+            if node.type_name is None or node.layout is None:
+                self.write_line(depth, '<invalid node 0x%x>' % address)
+                return []
+            if STATE_NODE in node.tag_info.categories:
+                return self.explain_state(node, depth)
+            return self.explain_plan(node, depth)
+        except gdb.MemoryError:
+            self.write_line(depth, '<cannot access memory at 0x%x>' % address)
+            return []
+
+    def describe(self, plan, actual=None):
+        '''type, costs, actual counts and details of a plan node'''
+        layout = get_struct_layout('Plan')
+        text = '%s  (cost=%.2f..%.2f rows=%.0f width=%d)' % (
+            plan.type_name, layout.double(plan.raw, 'startup_cost'), layout.double(plan.raw, 'total_cost'),
+            layout.double(plan.raw, 'plan_rows'), layout.integer(plan.raw, 'plan_width', signed=True))
+        if actual is not None:
+            text += ' %s' % actual
+
+        details = []
+        for type_name in reversed(plan_type_chain(plan.type_name)):
+            for field in EXPLAIN_DETAIL_FIELDS.get(type_name, []):
+                type_layout = get_struct_layout(type_name)
+                if not type_layout.has_field(field):
+                    continue
+                value = type_layout.format(plan.raw, field)
+                if value is None:
+                    value = str(type_layout.integer(plan.raw, field, signed=True))
+                details.append('%s=%s' % (field, value))
+        if plan.type_name == 'Motion' and plan.layout.has_field('motionID'):
+            details.append('slice%d' % plan.integer('motionID'))
+        if details:
+            text += '  [%s]' % ' '.join(details)
+        return text
+
+    def describe_instrument(self, address):
+        '''the actual counts of an Instrumentation, per loop as EXPLAIN
+        ANALYZE shows them'''
+        layout = get_struct_layout('Instrumentation')
+        raw = read_memory(address, layout.sizeof)
+        tuples = layout.double(raw, 'ntuples')
+        loops = layout.double(raw, 'nloops')
+        startup = layout.double(raw, 'startup')
+        seconds = layout.double(raw, 'total')
+        # The loop being executed has not been added to the totals yet
+        if layout.has_field('running') and raw[layout.fields['running'].offset]:
+            tuples += layout.double(raw, 'tuplecount')
+            loops += 1
+        if loops == 0:
+            return '(never executed)'
+        text = '(actual'
+        if seconds > 0:
+            text += ' time=%.3f..%.3f' % (startup * 1000.0 / loops, seconds * 1000.0 / loops)
+        return text + ' rows=%.0f loops=%.0f)' % (tuples / loops, loops)
+
+    def subplan_label(self, subplan):
+        '''the name of a SubPlan, such as InitPlan 1 (returns $0)'''
+        if subplan.layout.has_field('plan_name') and subplan.pointer('plan_name') != 0:
+            return read_c_string(subplan.pointer('plan_name'), 128)[0].decode(errors='replace')
+        return 'SubPlan %d' % subplan.integer('plan_id')
+
+    def subplan_children(self, subplan_address, depth):
+        '''the label and the plan of an initPlan SubPlan'''
+        subplan = RawNode(subplan_address)
+        label = self.subplan_label(subplan)
+        plan_id = subplan.integer('plan_id')
+        if 0 < plan_id <= len(self.subplans):
+            return [(self.subplans[plan_id - 1], depth, label)]
+        return [(None, depth, label)]
+
+    def explain_plan(self, node, depth):
+        self.write_line(depth, self.describe(node))
+
+        layout = get_struct_layout('Plan')
+        children = []
+        for subplan in expr_list_elements(layout.pointer(node.raw, 'initPlan')):
+            children.extend(self.subplan_children(subplan, depth + 1))
+        for field in ['lefttree', 'righttree']:
+            if layout.pointer(node.raw, field) != 0:
+                children.append((layout.pointer(node.raw, field), depth + 1, None))
+        for field in PLAN_CHILD_LISTS.get(node.type_name, []):
+            if node.layout.has_field(field):
+                children.extend((child, depth + 1, None) for child in expr_list_elements(node.pointer(field)))
+        for field in PLAN_CHILD_NODES.get(node.type_name, []):
+            if node.layout.has_field(field) and node.pointer(field) != 0:
+                children.append((node.pointer(field), depth + 1, None))
+        return children
+
+    def explain_state(self, node, depth):
+        layout = get_struct_layout('PlanState')
+        plan = RawNode(layout.pointer(node.raw, 'plan'))
+        if plan.layout is None or PLAN_NODE not in plan.tag_info.categories:
+            self.write_line(depth, '%s <invalid plan 0x%x>' % (node.type_name, plan.address))
+            return []
+        actual = None
+        if layout.pointer(node.raw, 'instrument') != 0:
+            actual = self.describe_instrument(layout.pointer(node.raw, 'instrument'))
+        self.write_line(depth, self.describe(plan, actual))
+
+        children = []
+        for field in ['initPlan', 'subPlan']:
+            for state in expr_list_elements(layout.pointer(node.raw, field)):
+                subplan_state = RawNode(state)
+                label = self.subplan_label(RawNode(subplan_state.pointer('subplan')))
+                children.append((subplan_state.pointer('planstate'), depth + 1, label))
+        for field in ['lefttree', 'righttree']:
+            if layout.pointer(node.raw, field) != 0:
+                children.append((layout.pointer(node.raw, field), depth + 1, None))
+        for array_field, length_field in PLANSTATE_CHILD_ARRAYS.get(node.type_name, []):
+            if not (node.layout.has_field(array_field) and node.layout.has_field(length_field)):
+                continue
+            base = node.pointer(array_field)
+            length = node.integer(length_field)
+            if base != 0 and length > 0:
+                pointer_size = node.layout.pointer_size
+                children.extend((child, depth + 1, None)
+                                for child in read_tuple_pointers(base, pointer_size, 0, list(range(length))))
+        for field in PLANSTATE_CHILD_NODES.get(node.type_name, []):
+            if node.layout.has_field(field) and node.pointer(field) != 0:
+                children.append((node.pointer(field), depth + 1, None))
+        return children
+
+class PgExplainCommand(GdbCommand):
+    '''print a plan the way EXPLAIN does, one line per node with its costs,
+    rows, width, slice and, for plan states, actual counts'''
+
+    def __init__(self):
+        super(PgExplainCommand, self).__init__("pgexplain", gdb.COMMAND_SUPPORT,
+                                               gdb.COMPLETE_NONE, False)
+
+    def make_parser(self):
+        parser = GdbArgumentParser(prog='pgexplain')
+        parser.add_argument('-o', '--output', metavar='FILE',
+                            help='write the output to FILE instead of the console')
+        parser.add_argument('expression', help='a PlannedStmt, Plan or PlanState')
+        return parser
+
+    def invoke(self, arg, from_tty):
+        args = self.make_parser().parse_args(gdb.string_to_argv(arg))
+
+        value = gdb.parse_and_eval(args.expression)
+        if not is_node(value) or int(value) == 0:
+            raise gdb.GdbError("pgexplain: %s is not a node" % args.expression)
+        if not (is_plannode(value) or is_statenode(value) or get_node_tag_info(value).name == 'PlannedStmt'):
+            raise gdb.GdbError("pgexplain: %s is not a PlannedStmt, Plan or PlanState" % args.expression)
+
+        output = None
+        write = gdb.write
+        if args.output is not None:
+            output = open(args.output, 'w')
+            write = output.write
+        try:
+            with suspended_pretty_printers():
+                self.explain(write, value)
+        finally:
+            if output is not None:
+                output.close()
+        save_schema_cache()
+
+    def explain(self, write, value):
+        # Plan states find the plans of their SubPlans through their
+        # SubPlanStates, plans need the subplans of the PlannedStmt
+        address = int(value)
+        subplans = []
+        if get_node_tag_info(value).name == 'PlannedStmt':
+            stmt = cast(value, 'PlannedStmt')
+            subplans = expr_list_elements(int(stmt['subplans']))
+            address = int(stmt['planTree'])
+        PlanExplainer(write, subplans).explain(address)
+
+if gdb is not None:
+    PgPrintCommand()
+    PgExpandCommand()
+    PgBacktraceCommand()
+    PgMemoryContextCommand()
+    PgTuplesCommand()
+    PgExprCommand()
+    PgExplainCommand()
+    PgSnapshotCommand()
+    gdb.printing.register_pretty_printer(None, NodePrettyPrinters(), replace=True)
@@ -0,0 +1,524 @@
+#!/usr/bin/env python3
+'''
+Print a snapshot saved by pgsnapshot, without gdb, the same way pgprint
+prints the nodes it holds:
+
+    (gdb) pgsnapshot plan /tmp/plan.snapshot
+    $ python3 pgrender.py /tmp/plan.snapshot
+    $ python3 pgrender.py --format json --max-list-items 10 /tmp/plan.snapshot
+
+gdbpg.py has to be next to this file.
+'''
+import argparse
+import json
+import struct
+import sys
+
+from gdbpg import (ALWAYS_SHOW, HIDE_INVALID, NEVER_SHOW, NOT_NULL, SNAPSHOT_LIST,
+                   SNAPSHOT_MAGIC, SNAPSHOT_NODE, SNAPSHOT_RECORD, SNAPSHOT_TRAILER,
+                   SNAPSHOT_TRUNCATED, SNAPSHOT_VALUES, SNAPSHOT_VERSION, DEFAULT_DISPLAY_METHODS,
+                   JsonNodeWriter, OutputWriter, PrintLimits, add_indent, format_node_reference, json_value,
+                   list_window, make_decoder, make_integer_unpacker, positive_float,
+                   positive_int)
+
+class SnapshotRecord(object):
+    '''A node, list or value list of a snapshot'''
+
+    def __init__(self, kind, address, type_name, data, extra):
+        self.kind = kind
+        self.address = address
+        self.type_name = type_name
+        self.data = data
+        self.extra = extra
+
+    def elements(self):
+        '''the element pointers of a List, or the values of an OidList'''
+        element_format = 'Q' if self.kind == SNAPSHOT_LIST else 'q'
+        return list(struct.unpack('<%d%s' % (len(self.data) // 8, element_format), self.data))
+
+class SnapshotField(object):
+    '''A field of a node type, as described by FieldPlan.describe()'''
+
+    def __init__(self, description, byte_order):
+        self.name = description['name']
+        self.key = '%d:%s' % (description['level'], description['name'])
+        self.offset = description['offset']
+        self.size = description['size']
+        self.visibility = description['visibility']
+        self.skip_tag = description['skip_tag']
+        self.kind = description['kind']
+
+        self.decoder = None
+        if description['decoder'] is not None:
+            self.decoder = make_decoder(description['decoder'], byte_order)
+        self._unpack_pointer = None
+        if self.kind != 'prepared':
+            self._unpack_pointer = make_integer_unpacker(self.size, False, byte_order)
+
+    def get_bytes(self, data):
+        return data[self.offset:self.offset + self.size]
+
+    def pointer(self, data):
+        return self._unpack_pointer(self.get_bytes(data))[0]
+
+class SnapshotType(object):
+    '''A node type, as described by NodeTypePlan.describe()'''
+
+    def __init__(self, description, byte_order):
+        self.prefix = description['prefix']
+        self.regular_fields = [[SnapshotField(f, byte_order) for f in fields]
+                               for fields in description['regular_fields']]
+        self.complex_fields = [SnapshotField(f, byte_order) for f in description['complex_fields']]
+        self.tree_fields = [[SnapshotField(f, byte_order) for f in fields]
+                            for fields in description['tree_fields']]
+
+class Snapshot(object):
+    '''A pgsnapshot file, read back'''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        trailer_start = len(data) - SNAPSHOT_TRAILER.size
+        if not data.startswith(SNAPSHOT_MAGIC) or trailer_start < len(SNAPSHOT_MAGIC):
+            raise ValueError('%s is not a pgsnapshot file' % path)
+        schema_start, magic = SNAPSHOT_TRAILER.unpack_from(data, trailer_start)
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not complete' % path)
+
+        schema = json.loads(data[schema_start:trailer_start].decode())
+        if schema['version'] != SNAPSHOT_VERSION:
+            raise ValueError('%s is a version %s snapshot, this is version %s'
+                             % (path, schema['version'], SNAPSHOT_VERSION))
+        self.expression = schema['expression']
+        self.root = schema['root']
+        self.root_is_node = schema['root_is_node']
+        self.show_hidden = schema['show_hidden']
+        self.types = dict((name, SnapshotType(description, schema['byte_order']))
+                          for name, description in schema['types'].items())
+
+        # address -> SnapshotRecord
+        self.records = {}
+        position = len(SNAPSHOT_MAGIC)
+        while position < schema_start:
+            kind, address, type_id, data_length, extra_length = \
+                SNAPSHOT_RECORD.unpack_from(data, position)
+            position += SNAPSHOT_RECORD.size
+            record_data = data[position:position + data_length]
+            position += data_length
+            extra = {}
+            if extra_length > 0:
+                extra = json.loads(data[position:position + extra_length].decode())
+            position += extra_length
+
+            # A node left out in one place may have been saved in another
+            if kind == SNAPSHOT_TRUNCATED and address in self.records:
+                continue
+            self.records[address] = SnapshotRecord(kind, address, schema['type_names'][type_id],
+                                                   record_data, extra)
+
+def write_json_record(out, record):
+    '''write a node as captured by capture_json(), and the nodes nested in
+    it, to a JsonNodeWriter'''
+    out.begin_node(dict((k, v) for k, v in record.items() if k != 'children'))
+    for name, child in record.get('children', {}).items():
+        if isinstance(child, list):
+            out.begin_list(name)
+            for item in child:
+                write_json_record(out, item)
+            out.end_list()
+        else:
+            out.begin_child(name)
+            write_json_record(out, child)
+            out.end_child()
+    out.end_node()
+
+class SnapshotRenderer(object):
+    '''Formats the nodes of a Snapshot the way write_node() and
+    write_node_json() format them in gdb'''
+
+    def __init__(self, snapshot, limits):
+        self.snapshot = snapshot
+        self.limits = limits
+        self.show_hidden = snapshot.show_hidden
+        self.depth = 0
+        # Nodes already written, address -> node type, and where
+        self.visited = {}
+        self.visited_paths = {}
+
+    def truncation_reason(self, record):
+        if record.kind == SNAPSHOT_TRUNCATED:
+            return record.extra['reason']
+        if self.depth >= self.limits.max_depth:
+            return 'max_depth_exceeded'
+        return self.limits.exhausted()
+
+    def iterate_list(self, record):
+        '''the elements of a List within the limits: yields their addresses,
+        and (start, end, reason) in place of those left out'''
+        elements = record.elements()
+        head, tail = list_window(len(elements), self.limits.max_list_items)
+
+        index = 0
+        reason = None
+        for start, end in [(0, head), (tail, len(elements))]:
+            for address in elements[start:end]:
+                reason = self.limits.exhausted()
+                if reason is not None:
+                    break
+                if index < start:
+                    yield (index, start, 'max_list_items_exceeded')
+                    index = start
+                yield address
+                index += 1
+            if reason is not None:
+                break
+
+        if index < len(elements):
+            yield (index, len(elements), reason or 'max_list_items_exceeded')
+
+    def limited_values(self, record):
+        '''the values of an OidList or IntList within max_list_items'''
+        values = record.elements()
+        head, tail = list_window(len(values), self.limits.max_list_items)
+        if head == len(values):
+            return values
+        return values[:head] + ['<%d items elided>' % (tail - head)] + values[tail:]
+
+    def regular_field_value(self, record, field):
+        '''the formatted value of a regular field, None if it is hidden'''
+        if field.key in record.extra:
+            return record.extra[field.key]
+
+        display_mode = ALWAYS_SHOW if self.show_hidden else field.visibility
+        if display_mode == NEVER_SHOW:
+            return None
+        data = field.get_bytes(record.data)
+        if display_mode == NOT_NULL and data == b'\x00' * field.size:
+            return None
+        if display_mode == HIDE_INVALID and data == b'\xff' * field.size:
+            return None
+        return field.decoder(data)
+
+    # Text output
+
+    def format_node(self, address):
+        output = []
+        writer = OutputWriter(output.append)
+        self.write_node(writer, address)
+        writer.close()
+        return ''.join(output)
+
+    def write_node(self, writer, address):
+        if address == 0:
+            writer.write('(NULL)')
+            return
+
+        record = self.snapshot.records.get(address)
+        if record is None:
+            writer.write('0x%x <not_in_snapshot>' % address)
+            return
+
+        reason = self.truncation_reason(record)
+        if reason is not None:
+            writer.write('%s 0x%x <%s>' % (record.type_name, address, reason))
+            return
+
+        if address in self.visited:
+            writer.write(format_node_reference(address, self.visited[address],
+                                               self.visited_paths[address]))
+            return
+        self.visited[address] = record.type_name
+        self.visited_paths[address] = writer.label_path()
+
+        self.depth += 1
+        try:
+            if record.kind == SNAPSHOT_NODE:
+                self.write_fields(writer, record)
+            elif record.kind == SNAPSHOT_LIST:
+                self.write_node_list(writer, address)
+            elif record.kind == SNAPSHOT_VALUES:
+                values = self.limited_values(record)
+                writer.write('%s: [%s]' % (record.type_name, ', '.join(str(v) for v in values)))
+            else:
+                writer.write(record.extra['text'])
+        finally:
+            self.depth -= 1
+
+    def write_node_list(self, writer, address):
+        if address == 0:
+            writer.write('(NULL)')
+            return
+
+        first = True
+        for item in self.iterate_list(self.snapshot.records[address]):
+            if not first:
+                writer.write('\n')
+            if isinstance(item, tuple):
+                start, end, reason = item
+                writer.write('List 0x%x [%d:%d] <%s, %d items elided>'
+                             % (address, start, end, reason, end - start))
+            else:
+                self.write_node(writer, item)
+            first = False
+
+    def write_fields(self, writer, record):
+        node_type = self.snapshot.types[record.type_name]
+
+        retval = node_type.prefix + record.type_name + ' '
+        newline_padding_chars = len(retval)
+
+        formatted_fields = [self.format_regular_fields(record, fields, newline_padding_chars + 1)
+                            for fields in node_type.regular_fields]
+        retval += ('\n' + ' ' * newline_padding_chars).join(formatted_fields)
+        writer.write(retval)
+
+        for field in node_type.complex_fields:
+            self.write_complex_field(writer, record, field)
+
+        # Only fall back to the tree fields of the parent if the node has
+        # none to show itself
+        for fields in node_type.tree_fields:
+            written = writer.written
+            for field in fields:
+                self.write_complex_field(writer, record, field)
+            if writer.written != written:
+                break
+
+    def format_regular_fields(self, record, fields, newline_padding_chars):
+        max_regular_field_chars = 140
+        retval = "["
+
+        retline = ""
+        for field in fields:
+            value = self.regular_field_value(record, field)
+            if value is None:
+                continue
+
+            if len(retline) > max_regular_field_chars:
+                retval += retline + '\n' + (' ' * newline_padding_chars)
+                retline = ''
+            elif len(retline) > 0:
+                retline += ' '
+
+            retline += "%s=%s" % (field.name, value)
+
+        retval += retline
+        retval += ']'
+
+        return retval
+
+    def write_complex_field(self, writer, record, field):
+        display_mode = ALWAYS_SHOW if self.show_hidden else field.visibility
+        if display_mode == NEVER_SHOW:
+            return
+        print_null = display_mode == ALWAYS_SHOW
+        skip_tag = field.skip_tag and not self.show_hidden
+
+        if field.kind == 'prepared':
+            writer.write(record.extra[field.key]['text'])
+        elif field.kind == 'node':
+            self.write_optional_node_field(writer, field.pointer(record.data), field.name,
+                                           skip_tag, print_null)
+        else:
+            self.write_optional_node_list(writer, field.pointer(record.data), field.name,
+                                          skip_tag, print_null)
+
+    def write_optional_node_field(self, writer, address, fieldname, skip_tag, print_null, indent=1):
+        if address != 0:
+            writer.indent(indent)
+            writer.write('\n')
+            if skip_tag:
+                self.write_node(writer, address)
+            else:
+                writer.begin_label('[%s] ' % fieldname)
+                self.write_node(writer, address)
+                writer.end_label()
+            writer.dedent(indent)
+        elif print_null:
+            writer.indent(indent)
+            writer.write("\n[%s] (NULL)" % fieldname)
+            writer.dedent(indent)
+
+    def write_optional_node_list(self, writer, address, fieldname, skip_tag, print_null, indent=1):
+        if address == 0:
+            if print_null:
+                writer.indent(indent)
+                writer.write("\n[%s] (NIL)" % fieldname)
+                writer.dedent(indent)
+            return
+
+        if self.snapshot.records[address].type_name in ['OidList', 'IntList']:
+            retval = self.format_node(address)
+            if not skip_tag:
+                retval = '[%s] %s' % (fieldname, retval)
+            writer.write(add_indent(retval, indent, True))
+            return
+
+        indent_add = 0
+        if not skip_tag:
+            writer.indent(indent)
+            writer.write('\n[%s]' % fieldname)
+            writer.dedent(indent)
+            indent_add = 1
+
+        writer.write('\n')
+        writer.indent(indent + indent_add)
+        self.write_node_list(writer, address)
+        writer.dedent(indent + indent_add)
+
+    # JSON output
+
+    def write_node_json(self, out, address):
+        if address == 0:
+            out.leaf({'type': None, 'address': '0x0'})
+            return
+
+        record = self.snapshot.records.get(address)
+        if record is None:
+            out.leaf({'type': None, 'address': '0x%x' % address, 'truncated': 'not_in_snapshot'})
+            return
+
+        reason = self.truncation_reason(record)
+        if reason is not None:
+            out.leaf({'type': record.type_name, 'address': '0x%x' % address, 'truncated': reason})
+            return
+
+        if address in self.visited:
+            out.leaf({'type': self.visited[address], 'address': '0x%x' % address, 'ref': True})
+            return
+        self.visited[address] = record.type_name
+
+        self.depth += 1
+        try:
+            if record.kind == SNAPSHOT_NODE:
+                self.write_fields_json(out, record)
+            elif record.kind == SNAPSHOT_LIST:
+                out.begin_node({'type': 'List', 'address': '0x%x' % address,
+                                'fields': {'length': len(record.elements())}})
+                out.begin_list('items')
+                self.write_node_list_json(out, address)
+                out.end_list()
+                out.end_node()
+            elif record.kind == SNAPSHOT_VALUES:
+                out.leaf({'type': record.type_name, 'address': '0x%x' % address,
+                          'fields': {'items': self.limited_values(record)}})
+            else:
+                write_json_record(out, record.extra['json'])
+        finally:
+            self.depth -= 1
+
+    def write_node_list_json(self, out, address):
+        for item in self.iterate_list(self.snapshot.records[address]):
+            if isinstance(item, tuple):
+                start, end, reason = item
+                out.leaf({'type': 'List', 'address': '0x%x' % address, 'truncated': reason,
+                          'start': start, 'end': end})
+            else:
+                self.write_node_json(out, item)
+
+    def write_fields_json(self, out, record):
+        node_type = self.snapshot.types[record.type_name]
+
+        node = {'type': record.type_name, 'address': '0x%x' % record.address, 'fields': {}}
+        for fields in node_type.regular_fields:
+            for field in fields:
+                value = self.regular_field_value(record, field)
+                if value is not None:
+                    node['fields'][field.name] = json_value(value)
+
+        # Unlike the text output, the tree fields of every level are written
+        children = []
+        for field in node_type.complex_fields + sum(reversed(node_type.tree_fields), []):
+            display_mode = ALWAYS_SHOW if self.show_hidden else field.visibility
+            if display_mode == NEVER_SHOW:
+                continue
+
+            if field.kind == 'prepared':
+                prepared = record.extra[field.key]
+                if 'json_value' in prepared:
+                    node['fields'][field.name] = prepared['json_value']
+                if 'json_child' in prepared:
+                    children.append((field, prepared['json_child']))
+                continue
+
+            address = field.pointer(record.data)
+            if address == 0:
+                if display_mode == ALWAYS_SHOW:
+                    node['fields'][field.name] = None
+            elif field.kind == 'list' and \
+                    self.snapshot.records[address].type_name in ['OidList', 'IntList']:
+                node['fields'][field.name] = self.limited_values(self.snapshot.records[address])
+            else:
+                children.append((field, address))
+
+        out.begin_node(node)
+        for field, child in children:
+            if field.kind == 'prepared':
+                out.begin_child(field.name)
+                write_json_record(out, child)
+                out.end_child()
+            elif field.kind == 'node':
+                out.begin_child(field.name)
+                self.write_node_json(out, child)
+                out.end_child()
+            else:
+                out.begin_list(field.name)
+                self.write_node_list_json(out, child)
+                out.end_list()
+        out.end_node()
+
+    def write(self, write, output_format):
+        '''write the whole snapshot, starting from its root'''
+        root = self.snapshot.root
+        if output_format == 'text':
+            writer = OutputWriter(write)
+            self.limits.start(writer)
+            if self.snapshot.root_is_node:
+                self.write_node(writer, root)
+            else:
+                writer.write(self.snapshot.records[root].extra['text'])
+            writer.write('\n')
+        else:
+            writer = JsonNodeWriter(write, ndjson=(output_format == 'ndjson'))
+            self.limits.start(writer)
+            if self.snapshot.root_is_node:
+                self.write_node_json(writer, root)
+            else:
+                write_json_record(writer, self.snapshot.records[root].extra['json'])
+        writer.close()
+
+def main():
+    parser = argparse.ArgumentParser(description='print a snapshot saved by pgsnapshot')
+    parser.add_argument('-o', '--output', metavar='FILE',
+                        help='write the output to FILE instead of stdout')
+    parser.add_argument('--format', choices=['text', 'json', 'ndjson'], default='text',
+                        help='text for people, json (one document) or ndjson (one '
+                             'node per line) for programs')
+    parser.add_argument('--depth', type=positive_int, metavar='N',
+                        help='do not print nodes nested deeper than N (default %d)'
+                             % DEFAULT_DISPLAY_METHODS['max_recursion_depth'])
+    parser.add_argument('--max-list-items', type=positive_int, metavar='N',
+                        help='print only the first and last N/2 elements of a list')
+    parser.add_argument('--max-bytes', type=positive_int, metavar='N',
+                        help='stop printing nodes after N characters of output')
+    parser.add_argument('--max-seconds', type=positive_float, metavar='S',
+                        help='stop printing nodes after S seconds')
+    parser.add_argument('snapshot')
+    args = parser.parse_args()
+
+    try:
+        snapshot = Snapshot(args.snapshot)
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    limits = PrintLimits(args.depth, args.max_list_items, args.max_bytes, args.max_seconds)
+    renderer = SnapshotRenderer(snapshot, limits)
+    if args.output is None:
+        renderer.write(sys.stdout.write, args.format)
+    else:
+        with open(args.output, 'w') as output:
+            renderer.write(output.write, args.format)
+
+if __name__ == '__main__':
+    main()
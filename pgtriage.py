@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+'''
+Triage the core files of a Greenplum (or PostgreSQL) incident in parallel:
+every core is opened by a gdb -batch worker of its own, which sources
+gdbpg.py, dumps the requested structures with pgprint and collects the
+segment, slice, signal and backtrace of the core. The results are merged
+into one report per core and a summary across all of them:
+
+    python3 pgtriage.py --binary bin/postgres --dump queryDesc->plannedstmt \\
+        --frame standard_ExecutorRun cores/*/core.*
+    python3 pgtriage.py --jobs-file jobs.json --output-dir /tmp/triage
+
+A jobs file is a JSON list of jobs such as
+
+    {"binary": "bin/postgres", "core": "seg0/core.1234",
+     "dumps": [{"expression": "queryDesc->plannedstmt", "frame": "standard_ExecutorRun"},
+               {"expression": "node", "frame": 2}]}
+
+where "frame" is a frame number or the name of a function (its innermost
+frame is used), and defaults to the innermost frame.
+'''
+import argparse
+import concurrent.futures
+import json
+import os
+import shlex
+import signal
+import subprocess
+import sys
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+def parse_frame(selector):
+    if selector is None or not selector.isdigit():
+        return selector
+    return int(selector)
+
+def load_jobs(args):
+    jobs = []
+    if args.jobs_file:
+        with open(args.jobs_file) as f:
+            jobs.extend(json.load(f))
+
+    if args.cores and not args.binary:
+        raise SystemExit('--binary is needed for the cores given on the command line')
+    dumps = [{'expression': e, 'frame': parse_frame(args.frame)} for e in args.dump or []]
+    for core in args.cores:
+        jobs.append({'binary': args.binary, 'core': core, 'dumps': dumps})
+    return jobs
+
+def run_job(args, index, job):
+    '''run the gdb worker of one job, returns its results'''
+    name = '%03d-%s' % (index, os.path.basename(job['core']))
+    config = {
+        'binary': os.path.abspath(job['binary']),
+        'core': os.path.abspath(job['core']),
+        'dumps': job.get('dumps', []),
+        'pgprint_options': shlex.split(args.pgprint_options or ''),
+        'output_prefix': os.path.join(args.output_dir, name),
+        'results': os.path.join(args.output_dir, '%s.json' % name),
+    }
+    command = [args.gdb, '-batch', '-nx',
+               '-ex', 'python TRIAGE_JOB = %r' % json.dumps(config),
+               '-x', os.path.join(REPO_DIR, 'gdbpg.py'),
+               '-x', os.path.join(REPO_DIR, 'pgtriage_gdb.py')]
+
+    results = {'binary': job['binary'], 'core': job['core'], 'name': name}
+    try:
+        process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                 timeout=args.timeout)
+    except subprocess.TimeoutExpired:
+        results['error'] = 'gdb did not finish within %d seconds' % args.timeout
+        return results
+
+    try:
+        with open(config['results']) as f:
+            results.update(json.load(f))
+    except (OSError, ValueError):
+        output = process.stdout.decode(errors='replace').strip().splitlines()
+        results['error'] = 'gdb failed: %s' % (output[-1] if output else 'exit status %d' % process.returncode)
+    return results
+
+def signal_name(signo):
+    if signo is None:
+        return '-'
+    try:
+        return signal.Signals(signo).name
+    except ValueError:
+        return str(signo)
+
+def format_optional(value):
+    if value is None:
+        return '-'
+    return str(value)
+
+def format_plan_node(node):
+    return '%s #%d' % (node['type'], node['plan_node_id'])
+
+def active_plan_nodes(results):
+    '''the plan nodes being executed, innermost first'''
+    return [frame['plan_node'] for frame in results.get('backtrace', []) if frame['plan_node']]
+
+def write_core_report(results, path):
+    lines = [
+        'core:    %s' % results['core'],
+        'binary:  %s' % results['binary'],
+    ]
+    if 'error' in results:
+        lines.append('error:   %s' % results['error'])
+    else:
+        lines.append('segment: %s  slice: %s  signal: %s' %
+                     (format_optional(results['segment']), format_optional(results['slice']),
+                      signal_name(results['signal'])))
+        lines.append('')
+        lines.append('backtrace:')
+        for frame in results['backtrace']:
+            line = '  #%-3d %s' % (frame['level'], frame['function'] or '??')
+            if frame['plan_node']:
+                line += '  [%s %s]' % (format_plan_node(frame['plan_node']), frame['plan_node']['address'])
+            lines.append(line)
+
+        for dump in results['dumps']:
+            lines.append('')
+            title = dump['expression']
+            if dump['frame'] is not None:
+                title += ' (frame %s)' % dump['frame']
+            lines.append('== %s ==' % title)
+            if 'error' in dump:
+                lines.append('error: %s' % dump['error'])
+                continue
+            with open(dump['file']) as f:
+                lines.append(f.read().rstrip('\n'))
+
+    with open(path, 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+def summary(all_results):
+    '''one line per core, then how many cores were executing each plan node'''
+    lines = ['%-32s %7s %5s %-8s %s' % ('core', 'segment', 'slice', 'signal',
+                                        'active plan nodes (innermost first)')]
+    node_cores = {}
+    for results in sorted(all_results, key=lambda r: (r.get('segment') is None, r.get('segment'), r['name'])):
+        if 'error' in results:
+            lines.append('%-32s %s' % (results['name'], results['error']))
+            continue
+
+        nodes = [format_plan_node(node) for node in active_plan_nodes(results)]
+        lines.append('%-32s %7s %5s %-8s %s' % (results['name'], format_optional(results['segment']),
+                                                format_optional(results['slice']),
+                                                signal_name(results['signal']), ', '.join(nodes) or '-'))
+        for node in set(nodes):
+            key = (results['slice'], node)
+            node_cores[key] = node_cores.get(key, 0) + 1
+
+    lines.append('')
+    lines.append('%5s %-40s %6s' % ('slice', 'plan node', 'cores'))
+    for (slice_id, node), count in sorted(node_cores.items(), key=lambda i: (-i[1], str(i[0]))):
+        lines.append('%5s %-40s %6d' % (format_optional(slice_id), node, count))
+    return '\n'.join(lines) + '\n'
+
+def main():
+    parser = argparse.ArgumentParser(description='dump PostgreSQL structures from many core files at once')
+    parser.add_argument('cores', nargs='*', help='core files of --binary')
+    parser.add_argument('--binary', help='program that dumped the cores given on the command line')
+    parser.add_argument('--dump', action='append', metavar='EXPRESSION',
+                        help='pgprint EXPRESSION in every core (can be repeated)')
+    parser.add_argument('--frame', metavar='FRAME',
+                        help='evaluate the --dump expressions in this frame: a number, or a '
+                             'function name for its innermost frame')
+    parser.add_argument('--jobs-file', metavar='FILE', help='JSON list of jobs, see above')
+    parser.add_argument('--pgprint-options', metavar='OPTIONS',
+                        help='options for every pgprint, such as "--max-list-items 20"')
+    parser.add_argument('-j', '--workers', type=int, default=os.cpu_count(),
+                        help='gdb processes to run at the same time (default: number of CPUs)')
+    parser.add_argument('--timeout', type=int, default=600,
+                        help='seconds to give each gdb (default 600)')
+    parser.add_argument('--gdb', default='gdb', help='gdb binary to use')
+    parser.add_argument('--output-dir', default='triage',
+                        help='where to write the reports (default ./triage)')
+    args = parser.parse_args()
+
+    jobs = load_jobs(args)
+    if not jobs:
+        parser.error('no cores given')
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    all_results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        futures = [pool.submit(run_job, args, index, job) for index, job in enumerate(jobs)]
+        for future in concurrent.futures.as_completed(futures):
+            results = future.result()
+            write_core_report(results, os.path.join(args.output_dir, '%s.txt' % results['name']))
+            print('%s: %s' % (results['core'], results.get('error', 'done')))
+            all_results.append(results)
+
+    report = summary(all_results)
+    with open(os.path.join(args.output_dir, 'summary.txt'), 'w') as f:
+        f.write(report)
+    print('')
+    print(report, end='')
+    print('reports written to %s' % args.output_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
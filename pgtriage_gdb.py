@@ -0,0 +1,111 @@
+'''
+Runs inside gdb, after gdbpg.py has been sourced: opens one core file of a
+pgtriage.py job, dumps the structures it asks for with pgprint and collects
+what the cross-segment summary needs (segment, slice, signal, backtrace and
+the plan nodes being executed). The job is passed as a JSON string in
+TRIAGE_JOB, the results are written as JSON to job['results'].
+'''
+import json
+
+job = json.loads(TRIAGE_JOB)
+
+def evaluate_int(expression):
+    '''the value of an integer expression, or None if the program does not
+    have it (not a Greenplum build, optimized out, ...)'''
+    try:
+        return int(gdb.parse_and_eval(expression))
+    except (gdb.error, gdb.MemoryError):
+        return None
+
+def select_frame(selector):
+    '''select a frame by number, or the innermost frame of a function'''
+    if isinstance(selector, int):
+        gdb.execute('frame %d' % selector, to_string=True)
+        return
+
+    frame = gdb.newest_frame()
+    while frame is not None:
+        if frame.name() == selector:
+            frame.select()
+            return
+        frame = frame.older()
+    raise gdb.error('no frame of %s' % selector)
+
+def active_plan_node(frame):
+    '''the plan or plan state node a frame is working on (the 'node'
+    argument of the executor functions), or None'''
+    with suspended_pretty_printers():
+        return read_active_plan_node(frame)
+
+def read_active_plan_node(frame):
+    for name in ['node', 'pstate', 'planstate']:
+        try:
+            value = frame.read_var(name)
+        except (ValueError, gdb.error):
+            continue
+        try:
+            if not is_node(value) or str(value) == '0x0':
+                continue
+            if not (is_plannode(value) or is_statenode(value)):
+                continue
+            node = {'type': get_node_tag_info(value).name, 'address': '0x%x' % int(value)}
+            if is_statenode(value):
+                value = cast(value, 'PlanState')['plan']
+            node['plan_node_id'] = int(cast(value, 'Plan')['plan_node_id'])
+            return node
+        except (gdb.error, gdb.MemoryError):
+            continue
+    return None
+
+def backtrace():
+    frames = []
+    frame = gdb.newest_frame()
+    level = 0
+    while frame is not None:
+        frames.append({
+            'level': level,
+            'function': frame.name(),
+            'plan_node': active_plan_node(frame),
+        })
+        frame = frame.older()
+        level += 1
+    return frames
+
+def quote_argument(text):
+    '''quote text as a single argument for gdb.string_to_argv()'''
+    return '"%s"' % text.replace('\\', '\\\\').replace('"', '\\"')
+
+def dump(index, request):
+    '''pgprint one expression of the job to a file of its own'''
+    path = '%s.%d.txt' % (job['output_prefix'], index)
+    result = {'expression': request['expression'], 'frame': request.get('frame'), 'file': path}
+    try:
+        if request.get('frame') is not None:
+            select_frame(request['frame'])
+        else:
+            gdb.newest_frame().select()
+        options = ' '.join(quote_argument(option) for option in job['pgprint_options'])
+        gdb.execute('pgprint %s --output %s %s' % (options, quote_argument(path),
+                                                   quote_argument(request['expression'])),
+                    to_string=True)
+    except gdb.error as e:
+        result['error'] = str(e)
+    return result
+
+gdb.execute('set confirm off')
+gdb.execute('set pagination off')
+gdb.execute('file %s' % quote_argument(job['binary']))
+gdb.execute('core-file %s' % quote_argument(job['core']))
+
+results = {
+    'binary': job['binary'],
+    'core': job['core'],
+    'segment': evaluate_int('GpIdentity.segindex'),
+    'slice': evaluate_int('currentSliceId'),
+    'signal': evaluate_int('$_siginfo.si_signo'),
+    'backtrace': backtrace(),
+    'dumps': [dump(index, request) for index, request in enumerate(job['dumps'])],
+}
+
+with open(job['results'], 'w') as f:
+    json.dump(results, f)
@@ -0,0 +1,180 @@
+'''
+Tests of the Datum and tuple decoding of gdbpg.py, on the bytes PostgreSQL
+stores. These parts do not need gdb:
+
+    python3 -m pytest tests
+'''
+import os
+import struct
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import gdbpg
+
+INT4OID = 23
+TEXTOID = 25
+
+def numeric_short(digits, weight, dscale, negative=False):
+    '''NumericShort bytes: a 2 byte header with a 6 bit signed weight'''
+    header = 0x8000 | (dscale << 7) | (weight & 0x7f)
+    if negative:
+        header |= 0x2000
+    return struct.pack('<H%dh' % len(digits), header, *digits)
+
+def numeric_long(digits, weight, dscale, negative=False):
+    '''NumericLong bytes: sign and dscale, then a 2 byte weight'''
+    header = (0x4000 if negative else 0) | dscale
+    return struct.pack('<Hh%dh' % len(digits), header, weight, *digits)
+
+def array_payload(elemtype, dims, lbounds, items, null_bitmap=False):
+    '''the bytes of a fixed length ArrayType after its varlena header, items
+    are int4 and None is NULL'''
+    ndim = len(dims)
+    data = struct.pack('<iiI', ndim, 0, elemtype)
+    data += struct.pack('<%di' % ndim, *dims) + struct.pack('<%di' % ndim, *lbounds)
+    if null_bitmap:
+        bitmap = bytearray((len(items) + 7) // 8)
+        for index, item in enumerate(items):
+            if item is not None:
+                bitmap[index // 8] |= 1 << (index % 8)
+        data += bytes(bitmap)
+    # The values start MAXALIGNed from the start of the varlena
+    padding = (-(len(data) + gdbpg.VARHDRSZ)) % gdbpg.MAXIMUM_ALIGNOF
+    data += b'\0' * padding
+    if null_bitmap:
+        data = data[:4] + struct.pack('<i', len(data) + gdbpg.VARHDRSZ) + data[8:]
+    for item in items:
+        if item is not None:
+            data += struct.pack('<i', item)
+    return data
+
+class Column(object):
+    '''stands in for a TupleDescColumn'''
+
+    def __init__(self, typid):
+        self.typid = typid
+        self.datum_type = gdbpg.DATUM_TYPES[typid]
+        self.len = self.datum_type['len']
+        self.align = self.datum_type['align']
+
+class NumericTest(unittest.TestCase):
+
+    def test_short(self):
+        self.assertEqual(gdbpg.decode_numeric_datum(numeric_short([123, 4500], 0, 2), '<'), '123.45')
+
+    def test_short_negative_weight(self):
+        self.assertEqual(gdbpg.decode_numeric_datum(numeric_short([12], -1, 4, negative=True), '<'),
+                         '-0.0012')
+
+    def test_long(self):
+        self.assertEqual(gdbpg.decode_numeric_datum(numeric_long([1234, 5678, 9000], 1, 1), '<'),
+                         '12345678.9')
+
+    def test_long_negative_weight(self):
+        self.assertEqual(gdbpg.decode_numeric_datum(numeric_long([1], -2, 8, negative=True), '<'),
+                         '-0.00000001')
+
+    def test_zero(self):
+        self.assertEqual(gdbpg.decode_numeric_datum(numeric_short([], 0, 0), '<'), '0')
+
+    def test_special(self):
+        self.assertEqual(gdbpg.decode_numeric_datum(struct.pack('<H', 0xc000), '<'), 'NaN')
+        self.assertEqual(gdbpg.decode_numeric_datum(struct.pack('<H', 0xd000), '<'), 'Infinity')
+        self.assertEqual(gdbpg.decode_numeric_datum(struct.pack('<H', 0xf000), '<'), '-Infinity')
+
+class DateTimeTest(unittest.TestCase):
+
+    def test_date(self):
+        self.assertEqual(gdbpg.decode_date_datum(struct.pack('<i', 0), '<'), '2000-01-01')
+        self.assertEqual(gdbpg.decode_date_datum(struct.pack('<i', -1), '<'), '1999-12-31')
+
+    def test_date_infinities(self):
+        self.assertEqual(gdbpg.decode_date_datum(struct.pack('<i', 2 ** 31 - 1), '<'), 'infinity')
+        self.assertEqual(gdbpg.decode_date_datum(struct.pack('<i', -2 ** 31), '<'), '-infinity')
+
+    def test_timestamp(self):
+        data = struct.pack('<q', 86400 * 1000000 + 500000)
+        self.assertEqual(gdbpg.decode_timestamp_datum(data, '<'), '2000-01-02 00:00:00.500000')
+        self.assertEqual(gdbpg.decode_timestamptz_datum(struct.pack('<q', 0), '<'),
+                         '2000-01-01 00:00:00+00')
+
+    def test_timestamp_infinities(self):
+        self.assertEqual(gdbpg.decode_timestamp_datum(struct.pack('<q', 2 ** 63 - 1), '<'), 'infinity')
+        self.assertEqual(gdbpg.decode_timestamp_datum(struct.pack('<q', -2 ** 63), '<'), '-infinity')
+
+    def test_big_endian(self):
+        self.assertEqual(gdbpg.decode_date_datum(struct.pack('>i', 1), '>'), '2000-01-02')
+
+class ArrayTest(unittest.TestCase):
+
+    def test_one_dimension(self):
+        data = array_payload(INT4OID, [3], [1], [1, 2, 3])
+        self.assertEqual(gdbpg.decode_array_datum(data, '<'), '{1,2,3}')
+
+    def test_nulls_and_lower_bound(self):
+        data = array_payload(INT4OID, [3], [0], [1, None, 3], null_bitmap=True)
+        self.assertEqual(gdbpg.decode_array_datum(data, '<'), '[0:2]={1,NULL,3}')
+
+    def test_two_dimensions(self):
+        data = array_payload(INT4OID, [2, 2], [1, 1], [1, 2, 3, 4])
+        self.assertEqual(gdbpg.decode_array_datum(data, '<'), '{{1,2},{3,4}}')
+
+    def test_short_varlena_elements(self):
+        data = struct.pack('<iiIii', 1, 0, TEXTOID, 2, 1)
+        data += b'\0' * ((-(len(data) + gdbpg.VARHDRSZ)) % gdbpg.MAXIMUM_ALIGNOF)
+        # 'ab', then '' as the last element
+        data += b'\x07ab' + b'\x03'
+        self.assertEqual(gdbpg.decode_array_datum(data, '<'), '{"ab",""}')
+
+    def test_empty(self):
+        self.assertEqual(gdbpg.decode_array_datum(struct.pack('<iiI', 0, 0, INT4OID), '<'), '{}')
+
+class VarlenaTest(unittest.TestCase):
+
+    def test_short_header(self):
+        # 1 byte header: (total length << 1) | 1 on little endian
+        self.assertEqual(gdbpg.parse_varlena_header(b'\x07ab', '<'), ('plain', 1, 3))
+        self.assertEqual(gdbpg.parse_varlena_header(b'\x83ab', '>'), ('plain', 1, 3))
+
+    def test_4_byte_header(self):
+        self.assertEqual(gdbpg.parse_varlena_header(struct.pack('<I', 7 << 2) + b'abc', '<'),
+                         ('plain', 4, 7))
+        self.assertEqual(gdbpg.parse_varlena_header(struct.pack('>I', 7) + b'abc', '>'), ('plain', 4, 7))
+
+    def test_compressed_and_external(self):
+        self.assertEqual(gdbpg.parse_varlena_header(struct.pack('<I', (100 << 2) | 2), '<'),
+                         ('compressed', 8, 100))
+        self.assertEqual(gdbpg.parse_varlena_header(b'\x01\x12', '<'), ('external', 2, None))
+
+    def test_header_size(self):
+        self.assertEqual(gdbpg.varlena_header_size(0x07, '<'), 1)
+        self.assertEqual(gdbpg.varlena_header_size(0x01, '<'), 2)
+        self.assertEqual(gdbpg.varlena_header_size(0x1c, '<'), 4)
+
+class TupleAttributeTest(unittest.TestCase):
+
+    def decode(self, data, offset, typid):
+        return gdbpg.decode_tuple_attribute(data, offset, Column(typid), '<', 8)
+
+    def test_short_varlena_at_the_end(self):
+        self.assertEqual(self.decode(b'\0' * 24 + b'\x05a', 24, TEXTOID), ('"a"', 26))
+        self.assertEqual(self.decode(b'\0' * 24 + b'\x03', 24, TEXTOID), ('""', 25))
+        self.assertEqual(self.decode(b'\0' * 24 + b'\x07ab', 24, TEXTOID), ('"ab"', 27))
+
+    def test_4_byte_varlena_is_aligned(self):
+        data = b'\0' * 25 + b'\0' * 3 + struct.pack('<I', 7 << 2) + b'abc'
+        self.assertEqual(self.decode(data, 25, TEXTOID), ('"abc"', 35))
+
+    def test_cut_off(self):
+        self.assertEqual(self.decode(b'\0' * 24 + struct.pack('<I', 100 << 2) + b'ab', 24, TEXTOID),
+                         ('"ab"...', None))
+        self.assertEqual(self.decode(b'\0' * 24 + b'\x1c\0', 24, TEXTOID), ('...', None))
+        self.assertEqual(self.decode(b'\0' * 24 + b'\1\0', 24, INT4OID), ('...', None))
+
+    def test_fixed_length(self):
+        self.assertEqual(self.decode(b'\0' * 4 + struct.pack('<i', -5), 1, INT4OID), ('-5', 8))
+
+if __name__ == '__main__':
+    unittest.main()